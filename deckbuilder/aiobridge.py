@@ -0,0 +1,115 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Optional, TypeVar
+
+from deckbuilder.promise import Promise, PromiseEventLoop, PromiseOrX, CancellationToken, get_event_loop
+
+T = TypeVar('T')
+
+_background_loop: Optional[asyncio.AbstractEventLoop] = None
+_background_mutex = threading.Lock()
+
+
+class AsyncioEventLoop(PromiseEventLoop):
+	"""
+	Promise event loop hosted on an asyncio loop: scheduled callbacks run as asyncio callbacks,
+	so promises bound to it settle without anyone blocking in run_until_completion.
+	"""
+	def __init__(self, aio_loop: Optional[asyncio.AbstractEventLoop] = None, token: Optional[CancellationToken] = None):
+		super().__init__(token)
+		self.aio_loop: asyncio.AbstractEventLoop = aio_loop or asyncio.get_running_loop()
+		self._process_pending: bool = False
+
+	def schedule(self, fn):
+		super().schedule(fn)
+		if not self._process_pending:
+			self._process_pending = True
+			self.aio_loop.call_soon(self._run)
+
+	def schedule_thread(self, fn):
+		super().schedule_thread(fn)
+		self.aio_loop.call_soon_threadsafe(self._run)
+
+	def unhandled_rejection(self, promise: PromiseOrX, reason: Any) -> None:
+		self.aio_loop.call_exception_handler({
+			"message": f"Unhandled rejection: {reason}",
+			"exception": reason if isinstance(reason, BaseException) else None,
+		})
+
+	def wait(self):
+		raise RuntimeError("event loop is hosted on asyncio, await the promise instead")
+
+	def _run(self):
+		self._process_pending = False
+		self.process()
+
+
+def background_loop() -> asyncio.AbstractEventLoop:
+	"""
+	Returns an asyncio loop running on its own thread, started on first use.
+	Awaitables yielded by code that is not itself running under asyncio are executed there.
+	"""
+	global _background_loop
+	with _background_mutex:
+		if _background_loop is None:
+			loop = asyncio.new_event_loop()
+			threading.Thread(target=loop.run_forever, name="asyncio-bridge", daemon=True).start()
+			_background_loop = loop
+		return _background_loop
+
+
+def from_awaitable(awaitable: Awaitable[T]) -> Promise[T]:
+	"""
+	Wraps an asyncio future or coroutine into a promise bound to the current event loop.
+	"""
+	loop = get_event_loop()
+	if isinstance(loop, AsyncioEventLoop):
+		aio_loop = loop.aio_loop
+	elif asyncio.isfuture(awaitable):
+		aio_loop = awaitable.get_loop()
+	else:
+		aio_loop = background_loop()
+
+	def worker(resolve, reject):
+		def done(future: asyncio.Future):
+			if future.cancelled():
+				loop.schedule_thread(lambda: reject(asyncio.CancelledError()))
+			elif future.exception() is not None:
+				exc = future.exception()
+				loop.schedule_thread(lambda: reject(exc))
+			else:
+				result = future.result()
+				loop.schedule_thread(lambda: resolve(result))
+
+		def start():
+			future = asyncio.ensure_future(awaitable, loop=aio_loop)
+			future.add_done_callback(done)
+
+		aio_loop.call_soon_threadsafe(start)
+	return Promise(worker)
+
+
+def to_future(promise: Promise[T]) -> 'asyncio.Future[T]':
+	"""
+	Returns an asyncio future on the running loop that settles together with the promise.
+	Unless the promise's event loop is hosted on asyncio, something else has to keep processing it.
+	"""
+	aio_loop = asyncio.get_running_loop()
+	future = aio_loop.create_future()
+
+	def settle(succ, val):
+		if future.cancelled():
+			return
+		if succ:
+			future.set_result(val)
+		else:
+			future.set_exception(val if isinstance(val, BaseException) else RuntimeError(val))
+
+	def listener(succ, val):
+		aio_loop.call_soon_threadsafe(settle, succ, val)
+
+	if isinstance(promise._loop, AsyncioEventLoop) and promise._loop.aio_loop is aio_loop:
+		promise._listen(listener)
+	else:
+		promise._loop.schedule_thread(lambda: promise._listen(listener))
+	return future
@@ -0,0 +1,167 @@
+import argparse
+import shutil
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+from deckbuilder.promise import Promise, PromiseEventLoop, asyncify, set_event_loop
+
+
+def bench_chain(size: int) -> None:
+	promise = Promise.resolve(0)
+	for _ in range(size):
+		promise = promise.then(lambda val: val + 1)
+	assert promise.run_until_completion() == size
+
+
+def bench_chain_promises(size: int) -> None:
+	promise = Promise.resolve(0)
+	for _ in range(size):
+		promise = promise.then(lambda val: Promise.resolve(val + 1))
+	assert promise.run_until_completion() == size
+
+
+def bench_fan_out(size: int) -> None:
+	promises = [Promise.resolve(idx) for idx in range(size)]
+	assert len(Promise.all(promises).run_until_completion()) == size
+
+
+def bench_catch(size: int) -> None:
+	promise = Promise.reject(ValueError())
+	for _ in range(size):
+		promise = promise.catch(lambda err: Promise.reject(err))
+	promise = promise.catch(lambda err: size)
+	assert promise.run_until_completion() == size
+
+
+def bench_asyncify(size: int) -> None:
+	@asyncify
+	def worker():
+		total = 0
+		for idx in range(size):
+			total += yield Promise.resolve(idx)
+		return total
+	assert worker().run_until_completion() == size * (size - 1) // 2
+
+
+def bench_asyncify_nested(size: int) -> None:
+	@asyncify
+	def leaf(idx):
+		value = yield Promise.resolve(idx)
+		return value
+
+	@asyncify
+	def worker():
+		total = 0
+		for idx in range(size):
+			total += yield leaf(idx)
+		return total
+	assert worker().run_until_completion() == size * (size - 1) // 2
+
+
+Benchmarks: Dict[str, Callable[[int], None]] = {
+	"chain": bench_chain,
+	"chain-promises": bench_chain_promises,
+	"fan-out": bench_fan_out,
+	"catch": bench_catch,
+	"asyncify": bench_asyncify,
+	"asyncify-nested": bench_asyncify_nested,
+}
+
+
+def measure(fn: Callable[[int], None], size: int, repeat: int) -> Tuple[float, int]:
+	"""
+	Returns the best time per step in microseconds and the peak traced memory per step in bytes.
+	"""
+	best = float("inf")
+	for _ in range(repeat):
+		previous = set_event_loop(PromiseEventLoop())
+		try:
+			time_begin = time.perf_counter()
+			fn(size)
+			best = min(best, time.perf_counter() - time_begin)
+		finally:
+			set_event_loop(previous)
+	previous = set_event_loop(PromiseEventLoop())
+	try:
+		tracemalloc.start()
+		fn(size)
+		_, peak = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+	finally:
+		set_event_loop(previous)
+	return best / size * 1e6, peak // size
+
+
+def run_promise_benchmarks(args: argparse.Namespace) -> None:
+	for name in args.names or Benchmarks.keys():
+		if name not in Benchmarks:
+			raise SystemExit(f"unknown benchmark '{name}'")
+		per_step, memory = measure(Benchmarks[name], args.size, args.repeat)
+		print(f"{name:<16} {per_step:8.2f} us/step {memory:8d} B/step peak")
+
+
+def run_render_benchmark(args: argparse.Namespace) -> None:
+	from deckbuilder.blobstore import BlobStore
+	from deckbuilder.build import BuildContext
+	from deckbuilder.executor import DeckInstantiator
+	from deckbuilder.process import worker_pool, TaskCommand, TaskRender
+	from deckbuilder.renderer import RenderConfig, DeckRenderer, BackendWebDriver, BackendCLI, BackendStub
+	from deckbuilder.xmlbuilder import XMLParser
+
+	worker_pool.configure(TaskRender, args.workers)
+	worker_pool.configure(TaskCommand, args.workers)
+	# the stub is left out of the defaults, it measures everything except the browser
+	defaults = ["navigate", "harness", "cli"]
+	modes = {
+		"navigate": RenderConfig(args.chrome_bin, args.workers, False, BackendWebDriver),
+		"harness": RenderConfig(args.chrome_bin, args.workers, True, BackendWebDriver),
+		"cli": RenderConfig(args.chrome_bin, args.workers, False, BackendCLI),
+		"stub": RenderConfig(args.chrome_bin, args.workers, False, BackendStub),
+	}
+	with BuildContext(args.deck):
+		db = DeckInstantiator(XMLParser(args.deck).parse()).run()
+		out_dir = tempfile.mkdtemp(prefix="deckbuilder-benchmark-")
+		store = BlobStore(out_dir)
+		try:
+			for mode in args.modes or defaults:
+				if mode not in modes:
+					raise SystemExit(f"unknown render mode '{mode}'")
+				cfg = modes[mode]
+				# the first pass starts Chrome and loads the harness, it is not measured
+				DeckRenderer(cfg, store).render(db)
+				best = float("inf")
+				sheets = 0
+				for _ in range(args.repeat):
+					time_begin = time.perf_counter()
+					info = DeckRenderer(cfg, store).render(db)
+					best = min(best, time.perf_counter() - time_begin)
+					sheets = sum(len(deck.sheets) * 2 for deck in info.decks)
+				print(f"{mode:<16} {best / max(sheets, 1) * 1000:8.1f} ms/sheet {sheets / best:8.2f} sheets/s over {sheets} sheets")
+		finally:
+			shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def main(argv: List[str] = None) -> None:
+	parser = argparse.ArgumentParser(description="Deckbuilder microbenchmarks")
+	commands = parser.add_subparsers(dest="command", required=True)
+	promise = commands.add_parser("promise", help="promise and event loop overhead")
+	promise.add_argument("names", nargs="*", help=f"benchmarks to run, one of {', '.join(Benchmarks.keys())}")
+	promise.add_argument("--size", type=int, default=10000, help="steps per run")
+	promise.add_argument("--repeat", type=int, default=5, help="runs per benchmark, the best is reported")
+	render = commands.add_parser("render", help="sheet render latency and throughput of each render mode")
+	render.add_argument("deck", help="deck file to render")
+	render.add_argument("modes", nargs="*", help="modes to compare: navigate, harness, cli or stub, all but stub by default")
+	render.add_argument("--repeat", type=int, default=3, help="runs per mode, the best is reported")
+	render.add_argument("--workers", type=int, default=1, help="Chrome drivers or processes in flight")
+	render.add_argument("--chrome-bin", default="chrome", help="Chrome executable for the cli mode")
+	args = parser.parse_args(argv)
+	if args.command == "promise":
+		run_promise_benchmarks(args)
+	else:
+		run_render_benchmark(args)
+
+
+if __name__ == "__main__":
+	main()
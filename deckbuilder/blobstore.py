@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional
+
+from deckbuilder.utils import sha1file
+
+BlobSuffix = ".png"
+# blobs used more recently than this are never evicted, pins only protect the blobs of this process
+EvictionGrace = 10 * 60
+
+
+class BlobStore:
+	"""
+	Rendered images, stored once under the hash of their contents and shared by every deck and build.
+	Files are moved in from the store's own temporary directory, so storing one is a rename, never a copy.
+	Once the store grows past its size limit, the images used longest ago are deleted,
+	except for those that builds still running have stored. Several processes may share a store:
+	a blob's modification time is refreshed on every use, and blobs used within the grace period are kept,
+	since pins are only seen by the process that took them.
+	"""
+	def __init__(self, path: str, max_bytes: int = 0, grace: float = EvictionGrace):
+		self.path: str = os.path.abspath(path)
+		self.blob_dir: str = os.path.join(self.path, "blobs")
+		# work files are kept on the same file system as the blobs, so they can be renamed into place
+		self.temp_dir: str = os.path.join(self.path, "tmp")
+		self.max_bytes: int = max_bytes
+		self.grace: float = grace
+		self._mutex = threading.Lock()
+		# sizes of the stored blobs, least recently used first
+		self._blobs: 'OrderedDict[str, int]' = OrderedDict()
+		self._pins: Dict[str, int] = dict()
+		self.total_bytes: int = 0
+		self.stored: int = 0
+		self.reused: int = 0
+		self.evicted: int = 0
+		os.makedirs(self.blob_dir, exist_ok=True)
+		os.makedirs(self.temp_dir, exist_ok=True)
+		self._scan()
+
+	def _scan(self) -> None:
+		"""
+		Picks up the blobs of earlier runs. A blob's modification time is the last time it was used.
+		"""
+		found = []
+		for prefix in os.listdir(self.blob_dir):
+			prefix_dir = os.path.join(self.blob_dir, prefix)
+			if not os.path.isdir(prefix_dir):
+				continue
+			for filename in os.listdir(prefix_dir):
+				if not filename.endswith(BlobSuffix):
+					continue
+				stat = os.stat(os.path.join(prefix_dir, filename))
+				found.append((stat.st_mtime, filename[:-len(BlobSuffix)], stat.st_size))
+		for _, hash, size in sorted(found):
+			self._add(hash, size)
+
+	def blob_path(self, hash: str) -> str:
+		return os.path.join(self.blob_dir, hash[:2], hash + BlobSuffix)
+
+	def blob_hash(self, path: str) -> str:
+		return os.path.basename(path)[:-len(BlobSuffix)]
+
+	def _use(self, path: str) -> Optional[int]:
+		"""
+		Marks a blob as used, for later scans and for other processes sharing the store,
+		and returns its size, or None if it is not on disk.
+		"""
+		try:
+			os.utime(path)
+			return os.stat(path).st_size
+		except FileNotFoundError:
+			return None
+
+	def _add(self, hash: str, size: int) -> None:
+		if hash not in self._blobs:
+			self._blobs[hash] = size
+			self.total_bytes += size
+
+	def _drop(self, hash: str) -> None:
+		if hash in self._blobs:
+			self.total_bytes -= self._blobs.pop(hash)
+
+	def _pin(self, hash: str) -> None:
+		self._pins[hash] = self._pins.get(hash, 0) + 1
+		self._blobs.move_to_end(hash)
+
+	def acquire(self, hash: str) -> Optional[str]:
+		"""
+		Pins a stored blob and returns its path, or returns None if the store does not have it.
+		The file is what counts, not the index: other processes sharing the store add and evict blobs too.
+		"""
+		target_path = self.blob_path(hash)
+		with self._mutex:
+			size = self._use(target_path)
+			if size is None:
+				self._drop(hash)
+				return None
+			self._add(hash, size)
+			self._pin(hash)
+			self.reused += 1
+		return target_path
+
+	def put(self, path: str, digest: Optional[str] = None) -> str:
+		"""
+		Moves a file into the store and returns the path it is stored at. The file is hashed unless its digest is given.
+		The blob stays pinned, safe from eviction, until it is released.
+		"""
+		hash = digest or sha1file(path)
+		target_path = self.blob_path(hash)
+		with self._mutex:
+			# the time of use has to survive restarts, the store is scanned in this order
+			size = self._use(target_path)
+			known = size is not None
+			if known:
+				self.reused += 1
+			else:
+				self._drop(hash)
+				os.makedirs(os.path.dirname(target_path), exist_ok=True)
+				size = os.path.getsize(path)
+				# other builds may be reading the same blob, it is only ever replaced atomically with identical contents
+				os.replace(path, target_path)
+				self.stored += 1
+			self._add(hash, size)
+			self._pin(hash)
+		if known:
+			os.unlink(path)
+		return target_path
+
+	def release(self, hashes: Iterable[str]) -> None:
+		"""
+		Unpins blobs a build has stored, once per put. Blobs are evicted first, if the store is over its limit,
+		so that a build's own images are still there for whoever asked for it, and only later builds evict them.
+		"""
+		self.collect()
+		with self._mutex:
+			for hash in hashes:
+				count = self._pins.get(hash, 0) - 1
+				if count > 0:
+					self._pins[hash] = count
+				else:
+					self._pins.pop(hash, None)
+
+	def collect(self) -> None:
+		if self.max_bytes <= 0:
+			return
+		recent = time.time() - self.grace
+		with self._mutex:
+			for hash in list(self._blobs.keys()):
+				if self.total_bytes <= self.max_bytes:
+					break
+				if hash in self._pins:
+					continue
+				target_path = self.blob_path(hash)
+				try:
+					if os.stat(target_path).st_mtime > recent:
+						# used since, by this process or another one sharing the store
+						self._blobs.move_to_end(hash)
+						continue
+					os.unlink(target_path)
+					self.evicted += 1
+				except FileNotFoundError:
+					# evicted by another process
+					pass
+				self._drop(hash)
+
+	def metrics(self) -> Dict[str, Any]:
+		with self._mutex:
+			return {
+				"blobs": len(self._blobs),
+				"bytes": self.total_bytes,
+				"max_bytes": self.max_bytes,
+				"pinned": len(self._pins),
+				"stored": self.stored,
+				"reused": self.reused,
+				"evicted": self.evicted,
+			}
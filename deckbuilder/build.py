@@ -0,0 +1,53 @@
+import itertools
+import threading
+from typing import Optional, Tuple
+
+from deckbuilder.promise import PromiseEventLoop, EventLoop, CancellationToken, set_event_loop
+
+build_ids = itertools.count(1)
+
+_current = threading.local()
+
+
+class BuildContext:
+	"""
+	Per-build state: the event loop the build's promises run on and its task counters.
+	Entering the context binds it to the current thread.
+	A build that exits with an error is cancelled, so its remaining tasks stop early.
+	"""
+	def __init__(self, description: str, loop: Optional[PromiseEventLoop] = None):
+		self.id: int = next(build_ids)
+		self.description: str = description
+		self.loop: PromiseEventLoop = loop or PromiseEventLoop()
+		self.token: CancellationToken = self.loop.token
+		self.task_index: int = 0
+		self._mutex: threading.Lock = threading.Lock()
+		self._previous: Optional[Tuple[Optional[BuildContext], Optional[PromiseEventLoop]]] = None
+
+	def cancel(self, reason: str) -> None:
+		self.token.cancel(reason)
+
+	def next_task_label(self) -> str:
+		with self._mutex:
+			self.task_index += 1
+			return f"{self.id}:{self.task_index}"
+
+	def __enter__(self) -> 'BuildContext':
+		self._previous = (getattr(_current, "build", None), set_event_loop(self.loop))
+		_current.build = self
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+		if exc_type is not None:
+			self.cancel(str(exc_val) or exc_type.__name__)
+		build, loop = self._previous
+		_current.build = build
+		set_event_loop(loop)
+		self._previous = None
+
+
+default_build = BuildContext("default", EventLoop)
+
+
+def current_build() -> BuildContext:
+	return getattr(_current, "build", None) or default_build
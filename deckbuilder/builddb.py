@@ -0,0 +1,76 @@
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+# bumped whenever a change to rendering can make the same sheet come out differently
+RenderVersion = 1
+SchemaVersion = 2
+
+Schema = """
+CREATE TABLE IF NOT EXISTS sheets (
+	key TEXT PRIMARY KEY,
+	hash TEXT NOT NULL,
+	built REAL NOT NULL
+);
+"""
+
+
+class BuildDB:
+	"""
+	Remembers what earlier builds rendered, in an SQLite database next to the blob store.
+	A sheet is looked up by a key covering everything that goes into its image, so a restarted server,
+	or another machine sharing the store, reuses every sheet whose inputs have not changed.
+	"""
+	def __init__(self, path: str):
+		self.path: str = path
+		self._mutex = threading.Lock()
+		# builds run on several threads, all of them go through this connection under the mutex
+		self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+		self.hits: int = 0
+		self.misses: int = 0
+		with self._mutex, self.conn:
+			# the rollback journal, unlike WAL, also works when the store is shared over a network file system
+			self.conn.execute("PRAGMA journal_mode=DELETE")
+			version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+			if version != SchemaVersion:
+				self.conn.execute("DROP TABLE IF EXISTS sheets")
+				# per deck records of the first schema, which nothing read
+				self.conn.execute("DROP TABLE IF EXISTS decks")
+			self.conn.executescript(Schema)
+			self.conn.execute(f"PRAGMA user_version={SchemaVersion}")
+
+	def find_sheet(self, key: str) -> Optional[str]:
+		"""
+		Returns the hash of the image last rendered for the sheet key, if any.
+		"""
+		with self._mutex:
+			row = self.conn.execute("SELECT hash FROM sheets WHERE key=?", (key,)).fetchone()
+			if row is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			return row[0]
+
+	def record_build(self, sheets: Dict[str, str]) -> None:
+		"""
+		Stores the sheets of a successful build in one transaction.
+		"""
+		now = time.time()
+		with self._mutex, self.conn:
+			self.conn.executemany(
+				"INSERT OR REPLACE INTO sheets (key, hash, built) VALUES (?, ?, ?)",
+				[(key, hash, now) for key, hash in sheets.items()]
+			)
+
+	def forget_sheets(self, hashes: List[str]) -> None:
+		"""
+		Drops the sheet keys that point to images no longer in the store.
+		"""
+		with self._mutex, self.conn:
+			self.conn.executemany("DELETE FROM sheets WHERE hash=?", [(hash,) for hash in hashes])
+
+	def metrics(self) -> Dict[str, Any]:
+		with self._mutex:
+			sheets = self.conn.execute("SELECT COUNT(*) FROM sheets").fetchone()[0]
+			return {"sheets": sheets, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,135 @@
+"""
+Reference server for the remote image cache, run with python -m deckbuilder.cacheserver.
+
+The protocol is plain HTTP over two kinds of resources:
+	GET/PUT /keys/<key>    the hash of the image rendered for a sheet key, as text
+	GET/HEAD/PUT /blobs/<hash>    the PNG image with the given SHA-1
+Unknown keys and images are 404. An uploaded image whose contents do not match its hash is rejected with 400.
+"""
+import argparse
+import os
+import re
+import sys
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import List, Optional
+
+from deckbuilder.blobstore import BlobStore
+from deckbuilder.utils import HashingWriter
+
+HashPattern = re.compile(r"[0-9a-f]{40}")
+# sheet keys, and the keys of their lower resolution tiers
+KeyPattern = re.compile(r"[0-9a-f]{40}(@[0-9.]+)?")
+MaxBlobSize = 512 * 1024 * 1024
+ReadSize = 64 * 1024
+
+
+class CacheServer(ThreadingHTTPServer):
+	def __init__(self, address, store: BlobStore):
+		super().__init__(address, CacheRequestHandler)
+		self.store: BlobStore = store
+		self.key_dir: str = os.path.join(store.path, "keys")
+		os.makedirs(self.key_dir, exist_ok=True)
+
+	def key_path(self, key: str) -> str:
+		return os.path.join(self.key_dir, key[:2], key)
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+	server: CacheServer
+	protocol_version = "HTTP/1.1"
+
+	def send_body(self, code: int, data: bytes = b"", content_type: str = "text/plain") -> None:
+		self.send_response(code)
+		self.send_header("Content-type", content_type)
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		if self.command != "HEAD":
+			self.wfile.write(data)
+
+	def parse_path(self) -> Optional[List[str]]:
+		parts = self.path.strip("/").split("/")
+		if len(parts) != 2:
+			return None
+		kind, name = parts
+		if kind == "keys" and KeyPattern.fullmatch(name):
+			return parts
+		if kind == "blobs" and HashPattern.fullmatch(name):
+			return parts
+		return None
+
+	def do_HEAD(self):
+		self.do_GET()
+
+	def do_GET(self):
+		parts = self.parse_path()
+		if parts is None:
+			return self.send_body(404)
+		kind, name = parts
+		path = self.server.key_path(name) if kind == "keys" else self.server.store.acquire(name)
+		if path is None or not os.path.isfile(path):
+			return self.send_body(404)
+		try:
+			with open(path, 'rb') as fp:
+				data = fp.read()
+		finally:
+			if kind == "blobs":
+				self.server.store.release([name])
+		self.send_body(200, data, "text/plain" if kind == "keys" else "image/png")
+
+	def do_PUT(self):
+		parts = self.parse_path()
+		length = int(self.headers.get("Content-Length", 0))
+		if parts is None:
+			self.rfile.read(length)
+			return self.send_body(404)
+		if length > MaxBlobSize:
+			self.close_connection = True
+			return self.send_body(413)
+		kind, name = parts
+		temp_path = os.path.join(self.server.store.temp_dir, f"upload-{os.getpid()}-{id(self)}")
+		writer = HashingWriter(open(temp_path, 'wb'))
+		try:
+			left = length
+			while left > 0:
+				data = self.rfile.read(min(left, ReadSize))
+				if not data:
+					raise ConnectionError("upload ended early")
+				writer.write(data)
+				left -= len(data)
+			writer.close()
+			if kind == "keys":
+				with open(temp_path, 'rb') as fp:
+					if not HashPattern.fullmatch(fp.read().decode("ascii", "replace").strip()):
+						return self.send_body(400, b"not an image hash")
+				os.makedirs(os.path.dirname(self.server.key_path(name)), exist_ok=True)
+				os.replace(temp_path, self.server.key_path(name))
+			else:
+				if writer.hexdigest() != name:
+					return self.send_body(400, b"contents do not match the hash")
+				self.server.store.put(temp_path, name)
+				self.server.store.release([name])
+			self.send_body(204)
+		finally:
+			writer.close()
+			if os.path.exists(temp_path):
+				os.unlink(temp_path)
+
+
+def main(argv: List[str] = None) -> None:
+	parser = argparse.ArgumentParser(description="Remote image cache for deckbuilder")
+	parser.add_argument("--host", default="localhost", help="address to listen on, 0.0.0.0 to share the cache over the network")
+	parser.add_argument("--port", type=int, default=17353, help="port to listen on")
+	parser.add_argument("--path", default=".remote-cache", help="directory the images are kept in")
+	parser.add_argument("--max-mb", type=float, default=0, help="size the cache is kept under, unlimited by default")
+	args = parser.parse_args(argv)
+	store = BlobStore(args.path, int(args.max_mb * 1024 * 1024))
+	server = CacheServer((args.host, args.port), store)
+	print(f"Serving the image cache in {store.path} on http://{args.host}:{args.port}/")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		sys.exit(0)
+
+
+if __name__ == "__main__":
+	main()
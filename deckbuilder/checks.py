@@ -0,0 +1,345 @@
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+from typing import Any, Callable, Dict, List
+
+from deckbuilder.promise import Promise, PromiseEventLoop, asyncify, set_event_loop
+from deckbuilder.renderinfo import DecksInfo, DeckSheetInfo
+
+
+def summarize_sheet(sheet: DeckSheetInfo) -> Dict[str, Any]:
+	"""
+	Everything a client gets for a sheet. Images are compared by their file name, which is the hash of their contents.
+	"""
+	return {
+		"face": os.path.basename(sheet.face),
+		"back": os.path.basename(sheet.back),
+		"size": (sheet.width, sheet.height, sheet.count),
+		"cards": [(card.index, card.name, card.description, card.deck) for card in sheet.cards_info],
+		"tiers": [(tier.scale, os.path.basename(tier.face), os.path.basename(tier.back)) for tier in sheet.tiers],
+	}
+
+
+def summarize(info: DecksInfo) -> Dict[str, Any]:
+	return {
+		"decks": [
+			{
+				"name": deck.name,
+				"stack": deck.stack,
+				"sheets": [summarize_sheet(sheet) for sheet in deck.sheets],
+				"atlas": deck.atlas,
+				"atlas_sheets": deck.atlas_sheets,
+			}
+			for deck in info.decks
+		],
+		"atlases": [
+			{"name": atlas.name, "sheets": [summarize_sheet(sheet) for sheet in atlas.sheets]}
+			for atlas in info.atlases
+		],
+	}
+
+
+AtlasDeckRows = 2000
+
+AtlasDeck = """<?xml version="1.0" encoding="UTF-8" ?>
+<deckbuilder>
+	<style name="s" size="20" halign="center" valign="center"/>
+	{decks}
+</deckbuilder>
+"""
+
+AtlasMember = """<deck name="{name}" width="100" height="150" atlas="shared">
+		<cards>
+			<csv path="{name}.csv" filter="card.keep = 'yes'"/>
+			<render>
+				<face><draw-text x="0" y="0" width="100" height="150" style="s" text="{name} ${{card.name}}"/></face>
+			</render>
+		</cards>
+		<back-default><draw-rect x="0" y="0" width="100" height="150" color="#336699"/></back-default>
+	</deck>"""
+
+
+def write_atlas_deck(out_dir: str) -> str:
+	"""
+	Writes a deck file whose decks share an atlas. Their sources are read at the same time and finish
+	in no particular order, which must not change how the atlas is laid out.
+	"""
+	os.makedirs(out_dir, exist_ok=True)
+	names = ["alpha", "beta", "gamma"]
+	for name in names:
+		with open(os.path.join(out_dir, f"{name}.csv"), 'w', encoding="utf-8") as out:
+			out.write("name,keep\n")
+			for idx in range(AtlasDeckRows):
+				out.write(f"{name}{idx},{'yes' if idx % 500 == 0 else 'no'}\n")
+	path = os.path.join(out_dir, "atlas.xml")
+	with open(path, 'w', encoding="utf-8") as out:
+		out.write(AtlasDeck.format(decks="\n\t".join(AtlasMember.format(name=name) for name in names)))
+	return path
+
+
+def run_parallel_check(args: argparse.Namespace) -> None:
+	"""
+	Builds the decks one after another, then many times at once, the way the server runs simultaneous requests,
+	and checks that every concurrent build gives exactly the result of the serial one.
+	A generated deck with an atlas is always among them.
+	"""
+	from deckbuilder.blobstore import BlobStore
+	from deckbuilder.build import BuildContext
+	from deckbuilder.pipeline import BuildPipeline
+	from deckbuilder.process import worker_pool, TaskIO, TaskRender
+	from deckbuilder.renderer import RenderConfig, BackendStub
+
+	worker_pool.configure(TaskIO, args.workers)
+	worker_pool.configure(TaskRender, args.workers)
+	cfg = RenderConfig("chrome", args.workers, False, BackendStub)
+	out_dir = tempfile.mkdtemp(prefix="deckbuilder-check-")
+	try:
+		decks = [write_atlas_deck(os.path.join(out_dir, "atlas"))] + [os.path.abspath(deck) for deck in args.decks]
+		expected: Dict[str, Any] = dict()
+		for deck in decks:
+			with BuildContext(deck):
+				expected[deck] = summarize(BuildPipeline(deck, cfg, BlobStore(os.path.join(out_dir, "serial"))).run())
+
+		# every concurrent build shares one store, as they do in the server
+		store = BlobStore(os.path.join(out_dir, "parallel"))
+		results: List[Any] = [None] * args.builds
+		start = threading.Barrier(args.builds)
+
+		def build(idx: int) -> None:
+			deck = decks[idx % len(decks)]
+			start.wait()
+			try:
+				with BuildContext(deck, PromiseEventLoop()):
+					results[idx] = summarize(BuildPipeline(deck, cfg, store).run())
+			except Exception as err:
+				results[idx] = err
+
+		threads = [threading.Thread(target=build, args=(idx,)) for idx in range(args.builds)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		failures = 0
+		for idx, result in enumerate(results):
+			deck = decks[idx % len(decks)]
+			if isinstance(result, Exception):
+				print(f"build {idx} of {deck} failed: {result}")
+				failures += 1
+			elif result != expected[deck]:
+				print(f"build {idx} of {deck} differs from the serial build")
+				failures += 1
+		print(f"{args.builds - failures} of {args.builds} concurrent builds match the serial builds")
+		if failures:
+			raise SystemExit(1)
+	finally:
+		shutil.rmtree(out_dir, ignore_errors=True)
+
+
+class CheckFailed(AssertionError):
+	pass
+
+
+def expect(actual: Any, expected: Any) -> None:
+	if actual != expected:
+		raise CheckFailed(f"expected {expected!r}, got {actual!r}")
+
+
+class RecordingEventLoop(PromiseEventLoop):
+	"""
+	Collects unhandled rejections instead of raising them, so checks can count them.
+	"""
+	def __init__(self):
+		super().__init__()
+		self.unhandled: List[Any] = []
+
+	def unhandled_rejection(self, promise, reason: Any) -> None:
+		self.unhandled.append(reason)
+
+
+def settle(loop: PromiseEventLoop) -> None:
+	loop.process()
+
+
+def check_then_order(loop: RecordingEventLoop) -> None:
+	log = []
+	promise, resolve, _ = Promise.deferred()
+	for idx in range(3):
+		promise.then(lambda val, idx=idx: log.append((idx, val)))
+	chain = Promise.resolve(1)
+	for step in range(3):
+		chain = chain.then(lambda val, step=step: log.append(("step", step, val)) or val + 1)
+	resolve("a")
+	settle(loop)
+	expect([entry for entry in log if entry[0] != "step"], [(0, "a"), (1, "a"), (2, "a")])
+	expect([entry for entry in log if entry[0] == "step"], [("step", 0, 1), ("step", 1, 2), ("step", 2, 3)])
+
+
+def check_then_flattens(loop: RecordingEventLoop) -> None:
+	inner, resolve, _ = Promise.deferred()
+	result = Promise.resolve(1).then(lambda val: inner).then(lambda val: val * 2)
+	resolve(Promise.resolve(21))
+	expect(result.run_until_completion(), 42)
+
+
+def check_rejection_through_then(loop: RecordingEventLoop) -> None:
+	error = ValueError("boom")
+	log = []
+	result = (
+		Promise.reject(error)
+		.then(lambda val: log.append("skipped"))
+		.then(lambda val: log.append("skipped too"))
+		.then(None, lambda err: ("caught", err))
+	)
+	expect(result.run_until_completion(), ("caught", error))
+	expect(log, [])
+	# a missing success handler passes the value through
+	expect(Promise.resolve(5).then(None, lambda err: -1).run_until_completion(), 5)
+	# a handler that raises rejects the derived promise with its error
+	failing = Promise.resolve(1).then(lambda val: 1 // 0)
+	expect(type(failing.catch(lambda err: err).run_until_completion()), ZeroDivisionError)
+	expect(loop.unhandled, [])
+
+
+def check_settles_once(loop: RecordingEventLoop) -> None:
+	promise, resolve, reject = Promise.deferred()
+	resolve(1)
+	resolve(2)
+	reject(ValueError())
+	expect(promise.run_until_completion(), 1)
+
+
+def check_all_order(loop: RecordingEventLoop) -> None:
+	deferred = [Promise.deferred() for _ in range(4)]
+	result = Promise.all([promise for promise, _, _ in deferred] + [7])
+	for idx, (_, resolve, _) in reversed(list(enumerate(deferred))):
+		resolve(idx)
+		settle(loop)
+	expect(result.run_until_completion(), [0, 1, 2, 3, 7])
+	expect(Promise.all([]).run_until_completion(), [])
+
+
+def check_all_first_failure(loop: RecordingEventLoop) -> None:
+	first = ValueError("first")
+	second = ValueError("second")
+	a, resolve_a, _ = Promise.deferred()
+	b, _, reject_b = Promise.deferred()
+	c, _, reject_c = Promise.deferred()
+	result = Promise.all([a, b, c]).catch(lambda err: err)
+	settle(loop)
+	reject_c(first)
+	settle(loop)
+	reject_b(second)
+	resolve_a(1)
+	expect(result.run_until_completion(), first)
+	settle(loop)
+	expect(loop.unhandled, [])
+
+
+def check_unhandled_rejection(loop: RecordingEventLoop) -> None:
+	error = ValueError("nobody listens")
+	Promise.reject(error)
+	settle(loop)
+	expect(loop.unhandled, [error])
+	# a handler attached in the same round still counts
+	late = Promise.reject(ValueError("late"))
+	late.catch(lambda err: None)
+	# so does a chain that ends in a handler
+	Promise.reject(ValueError("chained")).then(lambda val: val).catch(lambda err: None)
+	# and waiting on the promise
+	try:
+		Promise.reject(ValueError("awaited")).run_until_completion()
+	except ValueError:
+		pass
+	settle(loop)
+	expect(loop.unhandled, [error])
+	# a derived promise nobody handles is reported, once
+	Promise.reject(error).then(lambda val: val)
+	settle(loop)
+	expect(loop.unhandled, [error, error])
+
+
+def check_asyncify_throw(loop: RecordingEventLoop) -> None:
+	error = ValueError("inside")
+
+	@asyncify
+	def recovers():
+		try:
+			yield Promise.reject(error)
+		except ValueError as err:
+			value = yield Promise.resolve(err)
+			return ("recovered", value)
+
+	@asyncify
+	def propagates():
+		yield Promise.reject(error)
+		return "unreachable"
+
+	@asyncify
+	def raises():
+		value = yield 1
+		raise KeyError(value)
+
+	@asyncify
+	def plain(val):
+		return val + 1
+
+	expect(recovers().run_until_completion(), ("recovered", error))
+	expect(propagates().catch(lambda err: err).run_until_completion(), error)
+	expect(type(raises().catch(lambda err: err).run_until_completion()), KeyError)
+	expect(plain(1).run_until_completion(), 2)
+	settle(loop)
+	expect(loop.unhandled, [])
+
+
+PromiseChecks: Dict[str, Callable[[RecordingEventLoop], None]] = {
+	"then-order": check_then_order,
+	"then-flattens": check_then_flattens,
+	"rejection-through-then": check_rejection_through_then,
+	"settles-once": check_settles_once,
+	"all-order": check_all_order,
+	"all-first-failure": check_all_first_failure,
+	"unhandled-rejection": check_unhandled_rejection,
+	"asyncify-throw": check_asyncify_throw,
+}
+
+
+def run_promise_checks(args: argparse.Namespace) -> None:
+	failures = 0
+	for name in args.names or PromiseChecks.keys():
+		if name not in PromiseChecks:
+			raise SystemExit(f"unknown check '{name}'")
+		loop = RecordingEventLoop()
+		previous = set_event_loop(loop)
+		try:
+			PromiseChecks[name](loop)
+			print(f"{name:<24} ok")
+		except Exception as err:
+			print(f"{name:<24} FAILED: {err!r}")
+			failures += 1
+		finally:
+			set_event_loop(previous)
+	if failures:
+		raise SystemExit(1)
+
+
+def main(argv: List[str] = None) -> None:
+	parser = argparse.ArgumentParser(description="Deckbuilder consistency checks")
+	commands = parser.add_subparsers(dest="command", required=True)
+	parallel = commands.add_parser("parallel", help="concurrent builds give the same results as serial ones")
+	parallel.add_argument("decks", nargs="*", help="more deck files to build, local data sources keep the check offline")
+	parallel.add_argument("--builds", type=int, default=8, help="builds started at once, spread over the decks")
+	parallel.add_argument("--workers", type=int, default=4, help="IO and render workers shared by the builds")
+	promise = commands.add_parser("promise", help="promises keep their ordering, rejection and reporting semantics")
+	promise.add_argument("names", nargs="*", help=f"checks to run, one of {', '.join(PromiseChecks.keys())}")
+	args = parser.parse_args(argv)
+	if args.command == "promise":
+		run_promise_checks(args)
+	else:
+		run_parallel_check(args)
+
+
+if __name__ == "__main__":
+	main()
@@ -1,5 +1,6 @@
 import os
-from typing import Dict, List, Optional, TYPE_CHECKING
+import threading
+from typing import Dict, Iterator, List, Optional, Any, TYPE_CHECKING
 
 from deckbuilder.utils import encode, ValidateError
 
@@ -14,6 +15,12 @@ class DeckContext:
 		self.styles: Dict[str, TextStyle] = dict()
 		self.decks: List[DeckTemplate] = []
 		self.inlines: Dict[str, InlineSymbol] = dict()
+		self.tables: Dict[str, DataTable] = dict()
+
+	def resolve_table(self, name: str) -> 'DataTable':
+		if name in self.tables:
+			return self.tables[name]
+		raise ValidateError(f"table '{encode(name)}' is not defined")
 
 	def resolve_inline(self, name: str) -> 'InlineSymbol':
 		if name in self.inlines:
@@ -42,9 +49,44 @@ class CardData:
 
 class CardBlock:
 	def __init__(self):
-		self.cards: List[CardData] = []
+		# the cards of each data source, in the order the sources appear in the block.
+		# sources are read at the same time, each fills in its own list as its rows arrive
+		self.sources: List[List[CardData]] = []
 		self.renderers: List[Stmt] = []
 
+	def add_source(self) -> List[CardData]:
+		cards: List[CardData] = []
+		self.sources.append(cards)
+		return cards
+
+	def cards(self) -> Iterator[CardData]:
+		for cards in self.sources:
+			yield from cards
+
+	def card_count(self) -> int:
+		return sum(len(cards) for cards in self.sources)
+
+
+class DataTable:
+	def __init__(self, name: str, key: str):
+		self.name: str = name
+		self.key: str = key
+		self.rows: Dict[str, Dict[str, Any]] = dict()
+		# rows are added by the threads reading the table's sources
+		self._mutex = threading.Lock()
+
+	def add_row(self, row: Dict[str, Any]) -> None:
+		if self.key not in row:
+			raise ValidateError(f"row has no key column '{encode(self.key)}'")
+		key = str(row[self.key])
+		with self._mutex:
+			if key in self.rows:
+				raise ValidateError(f"duplicate key '{encode(key)}' in table '{encode(self.name)}'")
+			self.rows[key] = row
+
+	def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+		return self.rows.get(key)
+
 
 class DeckTemplate:
 	def __init__(self, name: str, width: int, height: int):
@@ -52,6 +94,9 @@ class DeckTemplate:
 		self.width: int = width
 		self.height: int = height
 		self.scale: float = 1
+		self.tiers: List[float] = [1]
+		self.texture_budget: int = 0
+		self.atlas: Optional[str] = None
 		self.face_hidden: Optional[FaceTemplate] = None
 		self.back_default: Optional[FaceTemplate] = None
 		self.card_blocks: List[CardBlock] = []
@@ -1,6 +1,6 @@
 import html
 from enum import Enum
-from typing import Tuple, List, Optional, Dict, Any, Set
+from typing import Tuple, List, Optional, Dict, Any, Set, Iterable
 
 Rect = Tuple[float, float, float, float]
 Point = Tuple[float, float]
@@ -113,6 +113,7 @@ class CardFaceTemplate:
 		self.contents: List[str] = []
 		self.contents_str: Optional[str] = None
 		self.styles: Set[TextStyle] = set()
+		self.images: List[str] = []
 
 	def render(self) -> str:
 		if not self.contents_str:
@@ -135,14 +136,16 @@ class CardFaceTemplate:
 	def draw_image(self, pos: Point, image: str, align: Point = (0, 0)):
 		tx = -100 * align[0]
 		ty = -100 * align[1]
+		self.images.append(image)
 		self.contents.append(
 			f'<img class="image" ' +
 			f'style="left:{pos[0]}px;top:{pos[1]}px;transform:translateX({tx}%) translateY({ty}%);" ' +
 			f'src="{html.escape(image)}">'
 		)
 
-	def draw_text(self, rect: Rect, style: TextStyle, text: str):
+	def draw_text(self, rect: Rect, style: TextStyle, text: str, images: Iterable[str] = ()):
 		self.styles.add(style)
+		self.images.extend(images)
 		self.contents.append(
 			f'<div style="position:absolute;left:{rect[0]}px;top:{rect[1]}px;width:{rect[2]}px;height:{rect[3]}px;">'
 			f'<div class="text-field {style.class_id}" ' +
@@ -161,6 +164,9 @@ class Deck:
 		self.hidden_face: Optional[CardFaceTemplate] = None
 		self.default_back: Optional[CardFaceTemplate] = None
 		self.scale: float = 1
+		self.tiers: List[float] = [1]
+		self.texture_budget: int = 0
+		self.atlas: Optional[str] = None
 		self.data = {
 			"name": name,
 			"width": size[0],
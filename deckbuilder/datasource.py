@@ -1,13 +1,446 @@
 import csv
+import http.client
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from collections import defaultdict
 from io import StringIO
-import urllib.request
+from typing import Dict, List, Tuple, Optional, Callable, Iterator, Any, Sequence, Iterable
+from urllib.parse import urlsplit, urljoin, quote
 
+from deckbuilder.ast import Expr, ExprCall, ExprField, ExprID, ExprLit, ExprConcat
+from deckbuilder.executor import Executor, to_number
+from deckbuilder.utils import ValidateError, encode
 
-def download_google_sheet_as_dictionary(key, sheet):
-	response = urllib.request.urlopen(f"https://docs.google.com/spreadsheets/d/{key}/gviz/tq?tqx=out:csv&sheet={sheet}")
-	text = response.read()
-	reader = csv.DictReader(StringIO(text.decode("utf-8")))
-	rows = []
-	for row in reader:
-		rows.append(row)
-	return rows
\ No newline at end of file
+MaxConcurrentFetches = 4
+MaxFetchAttempts = 4
+MaxRedirects = 5
+FetchTimeout = 60
+RetryBackoff = 0.5
+
+RedirectCodes = frozenset([301, 302, 303, 307, 308])
+
+GvizCompareOps = {
+	"=": "=",
+	"!=": "!=",
+	"LT": "<",
+	"GT": ">",
+	"LE": "<=",
+	"GE": ">=",
+}
+GvizSwappedOps = {
+	"=": "=",
+	"!=": "!=",
+	"LT": "GT",
+	"GT": "LT",
+	"LE": "GE",
+	"GE": "LE",
+}
+RegexSpecialChars = frozenset(".^$*+?{}[]\\|()")
+
+# columns the builder itself interprets, kept even when not projected explicitly
+SpecialColumns = ("count", "name", "description")
+
+
+class FetchError(RuntimeError):
+	def __init__(self, message: str, retryable: bool = False):
+		super().__init__(message)
+		self.retryable: bool = retryable
+
+
+class HTTPFetcher:
+	"""
+	Shared HTTP client: keeps idle keep-alive connections per host,
+	limits the number of requests in flight and retries transient failures.
+	It is safe to call from different threads.
+	"""
+	def __init__(self, max_concurrent: int = MaxConcurrentFetches, max_attempts: int = MaxFetchAttempts):
+		self.max_attempts: int = max_attempts
+		self._slots: threading.BoundedSemaphore = threading.BoundedSemaphore(max_concurrent)
+		self._idle: Dict[Tuple[str, str], List[http.client.HTTPConnection]] = defaultdict(list)
+		self._mutex: threading.Lock = threading.Lock()
+
+	def configure(self, max_concurrent: int) -> None:
+		self._slots = threading.BoundedSemaphore(max_concurrent)
+
+	def get(self, url: str, log: Optional[Callable[[str], None]] = None) -> bytes:
+		time_begin = time.time()
+		with self._slots:
+			time_slot = time.time()
+			attempt = 0
+			while True:
+				attempt += 1
+				try:
+					data = self._get_following_redirects(url)
+					break
+				except FetchError as err:
+					if not err.retryable or attempt >= self.max_attempts:
+						raise
+					reason = err
+				except (OSError, http.client.HTTPException) as err:
+					if attempt >= self.max_attempts:
+						raise FetchError(f"failed to fetch {url}: {err}") from err
+					reason = err
+				delay = RetryBackoff * 2 ** (attempt - 1)
+				if log:
+					log(f"Attempt {attempt} failed ({reason}), retrying in {delay}s")
+				time.sleep(delay)
+		if log:
+			log(
+				f"Downloaded {len(data)} bytes in {time.time() - time_slot:.3f}s" +
+				f" (waited {time_slot - time_begin:.3f}s for a slot, {attempt} attempt(s))"
+			)
+		return data
+
+	def _get_following_redirects(self, url: str) -> bytes:
+		for _ in range(MaxRedirects + 1):
+			status, headers, data = self._request("GET", url)
+			if status in RedirectCodes and 'location' in headers:
+				url = urljoin(url, headers['location'])
+				continue
+			if status == 429 or status >= 500:
+				raise FetchError(f"HTTP {status} for {url}", True)
+			if status >= 400:
+				raise FetchError(f"HTTP {status} for {url}")
+			return data
+		raise FetchError(f"too many redirects for {url}")
+
+	def _request(self, method: str, url: str) -> Tuple[int, Dict[str, str], bytes]:
+		parts = urlsplit(url)
+		target = parts.path or "/"
+		if parts.query:
+			target += "?" + parts.query
+		key = (parts.scheme, parts.netloc)
+		conn, reused = self._acquire(key)
+		try:
+			conn.request(method, target, headers={"Connection": "keep-alive"})
+			response = conn.getresponse()
+			data = response.read()
+		except (OSError, http.client.HTTPException):
+			conn.close()
+			if not reused:
+				raise
+			# the server has dropped an idle connection, retry once on a fresh one
+			conn, _ = self._acquire(key, fresh=True)
+			try:
+				conn.request(method, target, headers={"Connection": "keep-alive"})
+				response = conn.getresponse()
+				data = response.read()
+			except:
+				conn.close()
+				raise
+		headers = {name.lower(): value for name, value in response.getheaders()}
+		if response.will_close:
+			conn.close()
+		else:
+			self._release(key, conn)
+		return response.status, headers, data
+
+	def _acquire(self, key: Tuple[str, str], fresh: bool = False) -> Tuple[http.client.HTTPConnection, bool]:
+		if not fresh:
+			with self._mutex:
+				if self._idle[key]:
+					return self._idle[key].pop(), True
+		scheme, netloc = key
+		if scheme == "https":
+			return http.client.HTTPSConnection(netloc, timeout=FetchTimeout), False
+		elif scheme == "http":
+			return http.client.HTTPConnection(netloc, timeout=FetchTimeout), False
+		raise FetchError(f"unsupported url scheme '{scheme}'")
+
+	def _release(self, key: Tuple[str, str], conn: http.client.HTTPConnection) -> None:
+		with self._mutex:
+			self._idle[key].append(conn)
+
+
+fetcher = HTTPFetcher()
+
+
+class Projection:
+	def __init__(self, columns: Optional[Sequence[str]]):
+		self.columns: Optional[List[str]] = None
+		if columns is not None:
+			self.columns = list(columns)
+			for column in SpecialColumns:
+				if column not in self.columns:
+					self.columns.append(column)
+
+	def check_header(self, header: Sequence[str]) -> None:
+		if self.columns is None:
+			return
+		for column in self.columns:
+			if column not in header and column not in SpecialColumns:
+				raise ValidateError(f"column '{encode(column)}' is not present in the data source")
+
+	def apply(self, row: Dict[str, Any]) -> Dict[str, Any]:
+		if self.columns is None:
+			return row
+		return {column: row[column] for column in self.columns if column in row}
+
+
+class RowFilter:
+	"""
+	Evaluates a filter expression against source rows, with the row bound to the 'card' variable.
+	"""
+	def __init__(self, expr: Expr):
+		self.expr: Expr = expr
+		self.fields: Optional[List[str]] = []
+		self.collect_fields(expr)
+		self.executor: Executor = Executor(None, None, None)
+
+	def collect_fields(self, expr: Expr) -> None:
+		if isinstance(expr, ExprField) and isinstance(expr.obj, ExprID) and expr.obj.s == "card":
+			if self.fields is not None and expr.field not in self.fields:
+				self.fields.append(expr.field)
+		elif isinstance(expr, ExprField):
+			self.collect_fields(expr.obj)
+		elif isinstance(expr, ExprID):
+			if expr.s == "card":
+				# the whole row is used, so every column is needed
+				self.fields = None
+		elif isinstance(expr, ExprCall):
+			for arg in expr.args:
+				self.collect_fields(arg)
+		elif isinstance(expr, ExprConcat):
+			for piece in expr.pieces:
+				self.collect_fields(piece)
+
+	def matches(self, row: Dict[str, Any]) -> bool:
+		self.executor.env['card'] = row
+		try:
+			return bool(to_number(self.executor.compute(self.expr)))
+		except (ValidateError, TypeError, ValueError) as err:
+			raise ValidateError(f"while filtering row {encode(json.dumps(row, ensure_ascii=False))}:\n{err}") from err
+
+
+def select_rows(
+	rows: Iterable[Dict[str, Any]],
+	projection: Projection,
+	row_filter: Optional[RowFilter]
+) -> Iterator[Dict[str, Any]]:
+	for row in rows:
+		if row_filter is None or row_filter.matches(row):
+			yield projection.apply(row)
+
+
+def to_cell(value: Any) -> Any:
+	if value is None:
+		return ""
+	if isinstance(value, (str, list, dict)):
+		return value
+	if isinstance(value, bool):
+		return "true" if value else "false"
+	return str(value)
+
+
+def read_csv_rows(
+	path: str,
+	delimiter: str = ",",
+	columns: Optional[Sequence[str]] = None,
+	row_filter: Optional[RowFilter] = None
+) -> Iterator[Dict[str, str]]:
+	projection = Projection(columns)
+	with open(path, "r", encoding="utf-8-sig", newline="") as fp:
+		reader = csv.DictReader(fp, delimiter=delimiter)
+		projection.check_header(reader.fieldnames or [])
+		yield from select_rows(reader, projection, row_filter)
+
+
+def read_jsonl_rows(
+	path: str,
+	columns: Optional[Sequence[str]] = None,
+	row_filter: Optional[RowFilter] = None
+) -> Iterator[Dict[str, Any]]:
+	def rows():
+		with open(path, "r", encoding="utf-8-sig") as fp:
+			for line_number, line in enumerate(fp, 1):
+				if len(line.strip()) == 0:
+					continue
+				try:
+					row = json.loads(line)
+				except ValueError as err:
+					raise ValidateError(f"invalid JSON in line {line_number}: {encode(str(err))}")
+				if not isinstance(row, dict):
+					raise ValidateError(f"expected JSON object in line {line_number}")
+				yield {key: to_cell(value) for key, value in row.items()}
+	return select_rows(rows(), Projection(columns), row_filter)
+
+
+def read_sqlite_rows(
+	path: str,
+	query: str,
+	columns: Optional[Sequence[str]] = None,
+	row_filter: Optional[RowFilter] = None
+) -> Iterator[Dict[str, str]]:
+	projection = Projection(columns)
+	conn = sqlite3.connect(pathlib.Path(os.path.abspath(path)).as_uri() + "?mode=ro", uri=True)
+	try:
+		try:
+			cursor = conn.execute(query)
+		except sqlite3.Error as err:
+			raise ValidateError(f"query failed: {encode(str(err))}")
+		header = [desc[0] for desc in cursor.description or []]
+		projection.check_header(header)
+		rows = ({key: to_cell(value) for key, value in zip(header, values)} for values in cursor)
+		yield from select_rows(rows, projection, row_filter)
+	finally:
+		conn.close()
+
+
+def read_rows(
+	rows: Iterable[Dict[str, Any]],
+	columns: Optional[Sequence[str]] = None,
+	row_filter: Optional[RowFilter] = None
+) -> Iterator[Dict[str, Any]]:
+	return select_rows(rows, Projection(columns), row_filter)
+
+
+class GvizColumn:
+	def __init__(self, id: str, label: str, type: str):
+		self.id: str = id
+		self.label: str = label
+		self.type: str = type
+
+
+def gviz_url(key: str, sheet: str, out: str, query: Optional[str] = None) -> str:
+	url = f"https://docs.google.com/spreadsheets/d/{quote(key)}/gviz/tq?tqx=out:{out}&sheet={quote(sheet)}"
+	if query is not None:
+		url += "&tq=" + quote(query)
+	return url
+
+
+def gviz_columns(key: str, sheet: str, log: Optional[Callable[[str], None]]) -> Dict[str, GvizColumn]:
+	text = fetcher.get(gviz_url(key, sheet, "json", "limit 0"), log).decode("utf-8")
+	# the response is wrapped into a javascript callback
+	response = json.loads(text[text.index("{"): text.rindex("}") + 1])
+	if response.get("status") == "error":
+		raise FetchError(f"query failed: {response.get('errors')}")
+	columns = dict()
+	for col in response["table"]["cols"]:
+		if col.get("label"):
+			columns[col["label"]] = GvizColumn(col["id"], col["label"], col.get("type", ""))
+	return columns
+
+
+def gviz_literal(column: GvizColumn, value: Any) -> Optional[str]:
+	if column.type == "number" and isinstance(value, (int, float)):
+		return str(value)
+	if column.type == "string" and isinstance(value, str):
+		if "'" not in value:
+			return f"'{value}'"
+		if '"' not in value:
+			return f'"{value}"'
+	return None
+
+
+def gviz_field(expr: Expr, columns: Dict[str, GvizColumn]) -> Optional[GvizColumn]:
+	if isinstance(expr, ExprField) and isinstance(expr.obj, ExprID) and expr.obj.s == "card":
+		return columns.get(expr.field)
+	return None
+
+
+def gviz_where(expr: Expr, columns: Dict[str, GvizColumn]) -> Optional[str]:
+	"""
+	Translates a filter into a gviz 'where' clause that selects a superset of the matching rows,
+	or returns None when nothing can be pushed down. The filter itself is still applied to the result.
+	"""
+	if not isinstance(expr, ExprCall) or len(expr.args) != 2:
+		return None
+	if expr.func == "and":
+		lhs = gviz_where(expr.args[0], columns)
+		rhs = gviz_where(expr.args[1], columns)
+		if lhs and rhs:
+			return f"({lhs} and {rhs})"
+		return lhs or rhs
+	if expr.func == "or":
+		lhs = gviz_where(expr.args[0], columns)
+		rhs = gviz_where(expr.args[1], columns)
+		if lhs and rhs:
+			return f"({lhs} or {rhs})"
+		return None
+	if expr.func in GvizCompareOps:
+		op = expr.func
+		field, lit = expr.args
+		if isinstance(field, ExprLit):
+			field, lit = lit, field
+			op = GvizSwappedOps[op]
+		column = gviz_field(field, columns)
+		if column is None or not isinstance(lit, ExprLit):
+			return None
+		value = gviz_literal(column, lit.s)
+		if value is None:
+			return None
+		if op == "=" and lit.s != "":
+			return f"{column.id} = {value}"
+		# empty cells come back as nulls, while locally they compare as empty strings
+		return f"({column.id} {GvizCompareOps[op]} {value} or {column.id} is null)"
+	if expr.func == "contains":
+		column = gviz_field(expr.args[0], columns)
+		needle = expr.args[1]
+		if column is None or not isinstance(needle, ExprLit) or not isinstance(needle.s, str):
+			return None
+		if any(ch in RegexSpecialChars for ch in needle.s):
+			return None
+		value = gviz_literal(column, needle.s)
+		if value is None:
+			return None
+		return f"{column.id} contains {value}"
+	return None
+
+
+def gviz_query(
+	columns: Dict[str, GvizColumn],
+	projection: Projection,
+	row_filter: Optional[RowFilter]
+) -> Optional[Tuple[str, List[str]]]:
+	selected: Optional[List[str]] = None
+	if projection.columns is not None and (row_filter is None or row_filter.fields is not None):
+		selected = []
+		for name in projection.columns + (row_filter.fields if row_filter else []):
+			if name in columns and name not in selected:
+				selected.append(name)
+		if len(selected) == 0:
+			return None
+	where = gviz_where(row_filter.expr, columns) if row_filter else None
+	if selected is None and where is None:
+		return None
+	query = "select " + (", ".join(columns[name].id for name in selected) if selected is not None else "*")
+	if where is not None:
+		query += " where " + where
+	return query, selected if selected is not None else list(columns.keys())
+
+
+def read_google_sheet_rows(
+	key: str,
+	sheet: str,
+	columns: Optional[Sequence[str]] = None,
+	row_filter: Optional[RowFilter] = None,
+	log: Optional[Callable[[str], None]] = None
+) -> Iterator[Dict[str, str]]:
+	projection = Projection(columns)
+	reader = None
+	if projection.columns is not None or row_filter is not None:
+		try:
+			sheet_columns = gviz_columns(key, sheet, log)
+			projection.check_header(list(sheet_columns.keys()))
+			pushdown = gviz_query(sheet_columns, projection, row_filter)
+			if pushdown is not None:
+				query, labels = pushdown
+				if log:
+					log(f"Pushing down query: {query}")
+				text = fetcher.get(gviz_url(key, sheet, "csv", query), log)
+				reader = csv.DictReader(StringIO(text.decode("utf-8")))
+				if any(label not in (reader.fieldnames or []) for label in labels):
+					raise FetchError(f"unexpected columns {reader.fieldnames}")
+		except (FetchError, ValueError, KeyError) as err:
+			if log:
+				log(f"Query pushdown failed ({err}), downloading the whole sheet")
+			reader = None
+	if reader is None:
+		text = fetcher.get(gviz_url(key, sheet, "csv"), log)
+		reader = csv.DictReader(StringIO(text.decode("utf-8")))
+		projection.check_header(reader.fieldnames or [])
+	yield from select_rows(reader, projection, row_filter)
@@ -1,8 +1,9 @@
+import functools
 import json
 import math
 import numbers
 import re
-from typing import Optional, Dict, Any, Callable, TypeVar
+from typing import Optional, Dict, Any, Callable, TypeVar, Iterator
 
 from deckbuilder import textparser
 from deckbuilder.ast import Stmt, StmtSequence, StmtDrawRect, StmtDrawText, StmtDrawImage, StmtFace, Expr, ExprLit, \
@@ -49,6 +50,63 @@ def to_int(val):
 
 re_split = re.compile("(?:\".*?\"|\S)+")
 
+@functools.lru_cache(maxsize=256)
+def compile_regex(pattern):
+	try:
+		return re.compile(pattern)
+	except re.error as err:
+		raise ValidateError(f"invalid regular expression '{encode(pattern)}': {encode(str(err))}")
+
+def is_number(val):
+	try:
+		to_number(val)
+		return True
+	except (ValidateError, TypeError):
+		return False
+
+def sort_list(lst):
+	if all(is_number(item) for item in lst):
+		return sorted(lst, key=to_number)
+	return sorted(lst, key=str)
+
+def unique_list(lst):
+	result = []
+	seen = set()
+	for item in lst:
+		key = json.dumps(item, sort_keys=True, ensure_ascii=False) if isinstance(item, (list, dict)) else item
+		if key not in seen:
+			seen.add(key)
+			result.append(item)
+	return result
+
+def index_of(lst, val):
+	for idx, item in enumerate(lst):
+		if str(item) == val:
+			return idx
+	return -1
+
+def pluck(lst, field):
+	result = []
+	for item in lst:
+		if not isinstance(item, dict):
+			raise ValidateError(f"cannot read property '{encode(field)}' of non-object")
+		result.append(item.get(field, None))
+	return result
+
+def sum_list(lst):
+	total = 0
+	for idx, item in enumerate(lst):
+		try:
+			total += to_number(item)
+		except (ValidateError, TypeError):
+			raise ValidateError(f"sum: item {idx} is not a number: '{encode(str(item))}'")
+	return total
+
+def lookup_field(row, field):
+	if row is None:
+		return None
+	return row.get(field, None)
+
 def coerce2(fn):
 	def worker(a, b):
 		if isinstance(a, float) or isinstance(b, float):
@@ -64,7 +122,9 @@ funcs = {
 	"join": {"args": [to_list, to_string], "call": lambda lst, s: s.join(lst)},
 	"repeat": {"args": [to_string, to_int], "call": lambda s, i: s * i},
 	"substring": {"args": [to_string, to_int, to_int], "call": lambda s, b, e: s[b: e]},
-	"contains": {"args": [to_string, to_string], "call": lambda s, n: len(re.findall(n, s)) > 0},
+	"contains": {"args": [to_string, to_string], "call": lambda s, n: compile_regex(n).search(s) is not None},
+	"matches": {"args": [to_string, to_string], "call": lambda s, p: [m.group(0) for m in compile_regex(p).finditer(s)]},
+	"find": {"args": [to_string, to_string], "call": lambda s, p: (lambda m: m.group(0) if m else "")(compile_regex(p).search(s))},
 	"negate": {"args": [to_number], "call": lambda s: -s},
 	"concat": {"args": [to_string, to_string], "call": lambda s1, s2: s1 + s2},
 	"tostr": {"args": [to_string], "call": lambda s: s},
@@ -79,6 +139,13 @@ funcs = {
 	"max": {"args": [to_number, to_number], "call": lambda x, y: max(x, y)},
 
 	"len": {"args": [to_list], "call": lambda s: len(s)},
+	"sum": {"args": [to_list], "call": sum_list},
+	"count": {"args": [to_list, to_string], "call": lambda lst, p: sum(1 for item in lst if compile_regex(p).search(str(item)))},
+	"filter": {"args": [to_list, to_string], "call": lambda lst, p: [item for item in lst if compile_regex(p).search(str(item))]},
+	"map": {"args": [to_list, to_string], "call": pluck},
+	"sort": {"args": [to_list], "call": sort_list},
+	"unique": {"args": [to_list], "call": unique_list},
+	"index_of": {"args": [to_list, to_string], "call": index_of},
 	"+": {"args": [to_number, to_number], "call": lambda x, y: x + y},
 	"-": {"args": [to_number, to_number], "call": lambda x, y: x - y},
 	"*": {"args": [to_number, to_number], "call": lambda x, y: x * y},
@@ -92,6 +159,17 @@ funcs = {
 	"GE": {"args": [to_any, to_any], "call": coerce2(lambda x, y: 1 if x >= y else 0)},
 	"and": {"args": [to_number, to_number], "call": lambda x, y: 1 if x and y else 0},
 	"or": {"args": [to_number, to_number], "call": lambda x, y: 1 if x or y else 0},
+
+	"lookup": {
+		"args": [to_string, to_string, to_string],
+		"context": True,
+		"call": lambda ctx, t, k, f: lookup_field(ctx.resolve_table(t).lookup(k), f)
+	},
+	"lookup_row": {
+		"args": [to_string, to_string],
+		"context": True,
+		"call": lambda ctx, t, k: ctx.resolve_table(t).lookup(k)
+	},
 }
 
 
@@ -127,6 +205,7 @@ class Executor:
 					self.eval_nullable(validators.parse_int, stmt.line_width, 1)
 				)
 			elif isinstance(stmt, StmtDrawText):
+				text = textparser.TextParser(self.ctx, self.eval(stmt.text))
 				self.get_face().draw_text(
 					(
 						validators.parse_int(self.eval(stmt.x)),
@@ -135,7 +214,8 @@ class Executor:
 						validators.parse_int(self.eval(stmt.height)),
 					),
 					self.ctx.resolve_style(self.eval(stmt.style)),
-					textparser.TextParser(self.ctx, self.eval(stmt.text)).parse()
+					text.parse(),
+					text.images
 				)
 			elif isinstance(stmt, StmtDrawImage):
 				self.get_face().draw_image(
@@ -286,6 +366,10 @@ class Executor:
 			converted_args = []
 			for param, arg in zip(params, args):
 				converted_args.append(param(arg))
+			if func_data.get('context'):
+				if self.ctx is None:
+					raise ValidateError(f"function '{func}' is not available here")
+				return func_data['call'](self.ctx, *converted_args)
 			return func_data['call'](*converted_args)
 		else:
 			raise ValidateError("invalid expression")
@@ -302,17 +386,35 @@ class DeckInstantiator:
 			self.instantiate_deck(db, deck)
 		return db
 
-	def instantiate_deck(self, db: Deckbuilder, template: DeckTemplate):
+	def instantiate_deck(self, db: Deckbuilder, template: DeckTemplate) -> Deck:
+		deck = self.start_deck(db, template)
+		for _ in self.build_cards(deck, template):
+			pass
+		return deck
+
+	def start_deck(self, db: Deckbuilder, template: DeckTemplate) -> Deck:
 		try:
 			deck = db.make_deck(template.name, (template.width, template.height))
 			deck.scale = template.scale
+			deck.tiers = template.tiers
+			deck.texture_budget = template.texture_budget
+			deck.atlas = template.atlas
 			if template.back_default:
 				deck.set_default_back(self.build_face(deck, template.back_default))
 			if template.face_hidden:
 				deck.set_hidden_face(self.build_face(deck, template.face_hidden))
+			return deck
+		except ValidateError as ve:
+			raise ValidateError(f"while building deck '{encode(template.name)}': {ve}") from ve
+
+	def build_cards(self, deck: Deck, template: DeckTemplate) -> Iterator[CardTemplate]:
+		"""
+		Builds the deck's cards one at a time, yielding each as soon as it is complete.
+		"""
+		try:
 			for card_block in template.card_blocks:
-				for card in card_block.cards:
-					self.build_card(deck, card, card_block)
+				for card in card_block.cards():
+					yield self.build_card(deck, card, card_block)
 		except ValidateError as ve:
 			raise ValidateError(f"while building deck '{encode(template.name)}': {ve}") from ve
 
@@ -327,7 +429,7 @@ class DeckInstantiator:
 		self.unique_faces[face_unique] = face
 		return face
 
-	def build_card(self, deck: Deck, card_data: CardData, block: CardBlock) -> None:
+	def build_card(self, deck: Deck, card_data: CardData, block: CardBlock) -> CardTemplate:
 		card = deck.make_card()
 		card.set_count(card_data.count)
 		if 'name' in card_data.data:
@@ -346,3 +448,4 @@ class DeckInstantiator:
 			raise ValidateError(f"no front face for card {json.dumps(card_data.data, ensure_ascii=False)}")
 		if not card.get_back():
 			raise ValidateError(f"no back face for card {json.dumps(card_data.data, ensure_ascii=False)}")
+		return card
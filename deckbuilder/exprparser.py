@@ -243,6 +243,14 @@ class ExprParser:
 				return ExprID(name)
 		elif ch in Digits:
 			return self.parse_number()
+		elif ch == '(':
+			self.advance()
+			r = self.parse_expr()
+			self.skip_ws()
+			if self.peek() != ')':
+				self.error("expected ')'")
+			self.advance()
+			return r
 		elif ch == '-':
 			self.advance()
 			r = self.parse_expr_at(PrecedenceUnary)
@@ -0,0 +1,282 @@
+import io
+import math
+import struct
+import zlib
+from typing import BinaryIO, Iterator, List, Optional, Tuple, Union
+
+from PIL import Image
+
+from deckbuilder.utils import HashingWriter
+
+PNGSignature = b"\x89PNG\r\n\x1a\n"
+# decoded rows held at once by a strip reader or writer, whatever the size of the image
+StripBytes = 8 * 1024 * 1024
+ReadSize = 64 * 1024
+IDATSize = 64 * 1024
+CompressLevel = 6
+LanczosSupport = 3
+
+# PNG color types with 8 bits per sample, and the Pillow mode each decodes to
+ColorTypes = {0: "L", 2: "RGB", 3: "P", 4: "LA", 6: "RGBA"}
+ModeColorTypes = {"L": 0, "RGB": 2, "LA": 4, "RGBA": 6}
+ModeChannels = {"L": 1, "P": 1, "LA": 2, "RGB": 3, "RGBA": 4}
+
+
+def write_chunk(fp: Union[BinaryIO, HashingWriter], kind: bytes, data: bytes) -> None:
+	fp.write(struct.pack(">I", len(data)))
+	fp.write(kind)
+	fp.write(data)
+	fp.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+
+def up_filter(row: int, previous: int, high_bits: int) -> int:
+	"""
+	Subtracts every byte of the previous row from the same byte of the row, modulo 256, both packed into ints.
+	The high bit of each byte is set aside, so no borrow crosses into the next byte, and fixed up afterwards.
+	"""
+	return ((row | high_bits) - (previous & ~high_bits)) ^ ((row ^ previous ^ high_bits) & high_bits)
+
+
+class PNGStripReader:
+	"""
+	Decodes a PNG image a few rows at a time.
+	Pillow does the unfiltering: each batch of rows is handed to it as a small PNG of its own,
+	headed by the last row of the previous batch, which the filters of the first new row refer to.
+	Only 8-bit, non-interlaced images can be read this way, others are decoded whole.
+	"""
+	def __init__(self, path: str):
+		self.path: str = path
+		self.fp: BinaryIO = open(path, 'rb')
+		if self.fp.read(8) != PNGSignature:
+			self.fp.close()
+			raise ValueError(f"{path} is not a PNG image")
+		self.header: bytes = b""
+		# chunks that have to come along for the rows to decode, like the palette
+		self.extra_chunks: List[Tuple[bytes, bytes]] = []
+		self.idat_left: int = self._read_header()
+		self.width, self.height, bit_depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", self.header)
+		self.streaming: bool = bit_depth == 8 and interlace == 0 and color_type in ColorTypes
+		self.mode: str = ColorTypes.get(color_type, "")
+		self.stride: int = self.width * ModeChannels.get(self.mode, 0)
+		self.decompressor = zlib.decompressobj()
+		self.previous_row: bytes = bytes(self.stride)
+		self.rows_read: int = 0
+		self.whole: Optional[Image.Image] = None
+		self.window: Optional[Image.Image] = None
+		self.window_top: int = 0
+
+	def __enter__(self) -> 'PNGStripReader':
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+		self.close()
+
+	def close(self) -> None:
+		self.fp.close()
+		self.whole = None
+		self.window = None
+
+	def _read_header(self) -> int:
+		while True:
+			length, kind = struct.unpack(">I4s", self.fp.read(8))
+			if kind == b"IDAT":
+				return length
+			data = self.fp.read(length)
+			self.fp.read(4)
+			if kind == b"IHDR":
+				self.header = data
+			elif kind in (b"PLTE", b"tRNS"):
+				self.extra_chunks.append((kind, data))
+			elif kind == b"IEND":
+				raise ValueError(f"{self.path} has no image data")
+
+	def _read_compressed(self) -> bytes:
+		while self.idat_left == 0:
+			self.fp.read(4)
+			length, kind = struct.unpack(">I4s", self.fp.read(8))
+			if kind != b"IDAT":
+				raise ValueError(f"{self.path} ends before all of its rows")
+			self.idat_left = length
+		data = self.fp.read(min(self.idat_left, ReadSize))
+		self.idat_left -= len(data)
+		return data
+
+	def read(self, count: int) -> Image.Image:
+		"""
+		Decodes the next count rows.
+		"""
+		count = min(count, self.height - self.rows_read)
+		if not self.streaming:
+			if self.whole is None:
+				with Image.open(self.path) as image:
+					self.whole = image.copy()
+			strip = self.whole.crop((0, self.rows_read, self.width, self.rows_read + count))
+			self.rows_read += count
+			return strip
+		needed = count * (self.stride + 1)
+		chunks = []
+		available = 0
+		while available < needed:
+			# input the last call did not get to, because its rows were complete, goes first
+			compressed = self.decompressor.unconsumed_tail or self._read_compressed()
+			data = self.decompressor.decompress(compressed, needed - available)
+			chunks.append(data)
+			available += len(data)
+		data = b"".join(chunks)
+		out = io.BytesIO()
+		out.write(PNGSignature)
+		write_chunk(out, b"IHDR", struct.pack(">II", self.width, count + 1) + self.header[8:])
+		for kind, chunk in self.extra_chunks:
+			write_chunk(out, kind, chunk)
+		# stored blocks, the data only has to get through to Pillow's decoder
+		write_chunk(out, b"IDAT", zlib.compress(b"\0" + self.previous_row + data[:needed], 0))
+		write_chunk(out, b"IEND", b"")
+		out.seek(0)
+		with Image.open(out) as image:
+			image.load()
+			strip = image.crop((0, 1, self.width, count + 1))
+		self.previous_row = strip.crop((0, count - 1, self.width, count)).tobytes()
+		self.rows_read += count
+		return strip
+
+	def rows(self, top: int, bottom: int) -> Image.Image:
+		"""
+		Returns rows top to bottom. Calls have to move down the image: rows above the previous top are gone.
+		"""
+		if self.window is None or top < self.window_top:
+			self.window = Image.new(self.mode or "RGBA", (self.width, 0))
+			self.window_top = self.rows_read
+		window_bottom = self.window_top + self.window.height
+		if top > window_bottom:
+			self.read(top - window_bottom)
+			self.window = Image.new(self.window.mode, (self.width, 0))
+			self.window_top = window_bottom = top
+		if bottom > window_bottom:
+			new_rows = self.read(bottom - window_bottom)
+			kept = self.window.crop((0, top - self.window_top, self.width, self.window.height))
+			window = Image.new(new_rows.mode, (self.width, kept.height + new_rows.height))
+			if new_rows.mode == "P":
+				window.putpalette(new_rows.getpalette())
+				if "transparency" in new_rows.info:
+					window.info["transparency"] = new_rows.info["transparency"]
+			window.paste(kept, (0, 0))
+			window.paste(new_rows, (0, kept.height))
+			self.window = window
+			self.window_top = top
+		return self.window.crop((0, top - self.window_top, self.width, bottom - self.window_top))
+
+	def strips(self) -> Iterator[Image.Image]:
+		rows = max(1, StripBytes // max(1, self.stride))
+		while self.rows_read < self.height:
+			yield self.read(rows)
+
+
+class PNGStripWriter:
+	"""
+	Encodes a PNG image a few rows at a time, so that it never has to be held whole.
+	Every row is written with the Up filter, which is computed on whole rows at once.
+	The file is hashed as it is written, its SHA-1 is in digest once it is closed.
+	"""
+	def __init__(self, path: str, width: int, height: int, mode: str):
+		if mode not in ModeColorTypes:
+			raise ValueError(f"cannot write {mode} images")
+		self.width: int = width
+		self.height: int = height
+		self.mode: str = mode
+		self.stride: int = width * ModeChannels[mode]
+		self.high_bits: int = int.from_bytes(b"\x80" * self.stride, 'big')
+		self.previous: int = 0
+		self.rows_written: int = 0
+		self.compressor = zlib.compressobj(CompressLevel)
+		self.buffer: List[bytes] = []
+		self.buffered: int = 0
+		self.digest: str = ""
+		self.fp: HashingWriter = HashingWriter(open(path, 'wb'))
+		self.fp.write(PNGSignature)
+		write_chunk(self.fp, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, ModeColorTypes[mode], 0, 0, 0))
+
+	def __enter__(self) -> 'PNGStripWriter':
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+		if exc_type is None:
+			self.close()
+		else:
+			self.fp.close()
+
+	def write(self, strip: Image.Image) -> None:
+		if strip.mode != self.mode or strip.width != self.width:
+			raise ValueError(f"expected {self.mode} rows {self.width} pixels wide, got {strip.mode} {strip.width}")
+		if self.rows_written + strip.height > self.height:
+			raise ValueError(f"image is only {self.height} rows high")
+		data = strip.tobytes()
+		for offset in range(0, len(data), self.stride):
+			row = int.from_bytes(data[offset:offset + self.stride], 'big')
+			filtered = up_filter(row, self.previous, self.high_bits)
+			self._emit(b"\x02" + filtered.to_bytes(self.stride, 'big'))
+			self.previous = row
+		self.rows_written += strip.height
+
+	def _emit(self, data: bytes) -> None:
+		compressed = self.compressor.compress(data)
+		if compressed:
+			self.buffer.append(compressed)
+			self.buffered += len(compressed)
+			if self.buffered >= IDATSize:
+				self._flush_idat()
+
+	def _flush_idat(self) -> None:
+		if self.buffered:
+			write_chunk(self.fp, b"IDAT", b"".join(self.buffer))
+			self.buffer = []
+			self.buffered = 0
+
+	def close(self) -> None:
+		try:
+			if self.rows_written != self.height:
+				raise ValueError(f"image is {self.height} rows high, but {self.rows_written} were written")
+			self.buffer.append(self.compressor.flush())
+			self.buffered += len(self.buffer[-1])
+			self._flush_idat()
+			write_chunk(self.fp, b"IEND", b"")
+			self.digest = self.fp.hexdigest()
+		finally:
+			self.fp.close()
+
+
+def downsample_png(source: str, target: str, size: Tuple[int, int]) -> str:
+	"""
+	Resamples a PNG image to the given size with a Lanczos filter, a strip of rows at a time.
+	Returns the SHA-1 of the written file.
+	"""
+	width, height = size
+	with PNGStripReader(source) as reader:
+		ratio = reader.height / height
+		# source rows beyond the ones an output strip maps to that the filter still reaches
+		margin = math.ceil(LanczosSupport * max(ratio, 1)) + 1
+		source_rows = max(1, StripBytes // max(1, reader.stride))
+		rows = max(1, int((source_rows - 2 * margin) / ratio))
+		writer: Optional[PNGStripWriter] = None
+		try:
+			for top in range(0, height, rows):
+				bottom = min(height, top + rows)
+				source_top = top * ratio
+				source_bottom = bottom * ratio
+				window_top = max(0, math.floor(source_top) - margin)
+				window = reader.rows(window_top, min(reader.height, math.ceil(source_bottom) + margin))
+				if window.mode not in ModeColorTypes:
+					window = window.convert("RGBA")
+				strip = window.resize(
+					(width, bottom - top),
+					Image.LANCZOS,
+					box=(0, source_top - window_top, reader.width, source_bottom - window_top)
+				)
+				if writer is None:
+					writer = PNGStripWriter(target, width, height, strip.mode)
+				writer.write(strip)
+			writer.close()
+			return writer.digest
+		except:
+			if writer is not None:
+				writer.fp.close()
+			raise
@@ -0,0 +1,163 @@
+import hashlib
+import itertools
+import os
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple, Any
+
+from deckbuilder.promise import CancellationToken
+
+MaxFinishedJobs = 64
+
+STATE_QUEUED = "queued"
+STATE_RUNNING = "running"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+STATE_CANCELLED = "cancelled"
+
+job_ids = itertools.count(1)
+
+
+class JobQueueFull(RuntimeError):
+	pass
+
+
+class BuildJob:
+	def __init__(self, key: Tuple[str, str], deck: str):
+		self.id: str = str(next(job_ids))
+		self.key: Tuple[str, str] = key
+		self.deck: str = deck
+		self.content_hash: str = key[1]
+		self.state: str = STATE_QUEUED
+		self.token: CancellationToken = CancellationToken()
+		# requests blocked on the result; a job nobody waits for is cancelled, unless it is pinned
+		self.waiters: int = 0
+		self.pinned: bool = False
+		self.result: Any = None
+		self.error: Optional[str] = None
+		self.time_submitted: float = time.time()
+		self.time_started: Optional[float] = None
+		self.time_finished: Optional[float] = None
+		self.finished: threading.Event = threading.Event()
+
+	def is_pending(self) -> bool:
+		return self.state == STATE_QUEUED or self.state == STATE_RUNNING
+
+	def wait(self, timeout: Optional[float] = None) -> bool:
+		return self.finished.wait(timeout)
+
+	def status(self) -> Dict[str, Any]:
+		now = time.time()
+		status = {
+			"id": self.id,
+			"deck": self.deck,
+			"state": self.state,
+			"queued": round((self.time_started or now) - self.time_submitted, 3),
+		}
+		if self.time_started is not None:
+			status["elapsed"] = round((self.time_finished or now) - self.time_started, 3)
+		if self.error is not None:
+			status["error"] = self.error
+		return status
+
+
+def hash_deck(deck: str) -> str:
+	with open(deck, 'rb') as fp:
+		return hashlib.sha1(fp.read()).hexdigest()
+
+
+class JobManager:
+	"""
+	Runs deck builds on a fixed number of worker threads.
+	Requests for a deck whose file has not changed attach to the build already queued or running.
+	"""
+	def __init__(self, build: Callable[[str, CancellationToken], Any], workers: int, max_queued: int):
+		self.build: Callable[[str, CancellationToken], Any] = build
+		self.max_queued: int = max_queued
+		self.queue: queue.Queue = queue.Queue()
+		self.jobs: Dict[str, BuildJob] = dict()
+		self.in_flight: Dict[Tuple[str, str], BuildJob] = dict()
+		self.finished: OrderedDict = OrderedDict()
+		self.mutex: threading.Lock = threading.Lock()
+		self.queued: int = 0
+		self.abandoned: int = 0
+		for idx in range(workers):
+			threading.Thread(target=self.worker, name=f"build-worker-{idx}", daemon=True).start()
+
+	def submit(self, deck: str, waiting: bool = False) -> BuildJob:
+		"""
+		Starts or joins a build. A waiting caller must call release() once it stops waiting,
+		other jobs are pinned and always run to completion.
+		"""
+		key = (os.path.abspath(deck), hash_deck(deck))
+		with self.mutex:
+			job = self.in_flight.get(key)
+			if job is None:
+				if self.queued >= self.max_queued:
+					raise JobQueueFull(f"build queue is full ({self.queued} builds waiting), try again later")
+				job = BuildJob(key, deck)
+				self.jobs[job.id] = job
+				self.in_flight[key] = job
+				self.queued += 1
+				self.queue.put(job)
+			if waiting:
+				job.waiters += 1
+			else:
+				job.pinned = True
+			return job
+
+	def release(self, job: BuildJob) -> None:
+		with self.mutex:
+			job.waiters -= 1
+			if job.waiters > 0 or job.pinned or not job.is_pending():
+				return
+			self.abandoned += 1
+			# later requests for the deck must start over instead of joining the cancelled build
+			if self.in_flight.get(job.key) is job:
+				del self.in_flight[job.key]
+		job.token.cancel("all clients waiting for the build have disconnected")
+
+	def get(self, job_id: str) -> Optional[BuildJob]:
+		with self.mutex:
+			return self.jobs.get(job_id)
+
+	def worker(self) -> None:
+		while True:
+			job = self.queue.get()
+			with self.mutex:
+				self.queued -= 1
+				job.state = STATE_RUNNING
+				job.time_started = time.time()
+			try:
+				job.token.check()
+				job.result = self.build(job.deck, job.token)
+				state = STATE_DONE
+			except:
+				job.error = str(sys.exc_info()[1])
+				state = STATE_CANCELLED if job.token.is_cancelled() else STATE_FAILED
+			with self.mutex:
+				job.state = state
+				job.time_finished = time.time()
+				if self.in_flight.get(job.key) is job:
+					del self.in_flight[job.key]
+				self.finished[job.id] = job
+				while len(self.finished) > MaxFinishedJobs:
+					old_id, _ = self.finished.popitem(last=False)
+					del self.jobs[old_id]
+			job.finished.set()
+
+	def metrics(self) -> Dict[str, Any]:
+		with self.mutex:
+			running = sum(1 for job in self.in_flight.values() if job.state == STATE_RUNNING)
+			finished = list(self.finished.values())
+			return {
+				"queued": self.queued,
+				"running": running,
+				"max_queued": self.max_queued,
+				"finished": len(finished),
+				"failed": sum(1 for job in finished if job.state == STATE_FAILED),
+				"abandoned": self.abandoned,
+			}
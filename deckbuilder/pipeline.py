@@ -0,0 +1,67 @@
+from typing import Any, Dict, List, Optional
+
+from deckbuilder.blobstore import BlobStore
+from deckbuilder.builddb import BuildDB
+from deckbuilder.context import DeckTemplate
+from deckbuilder.core import Deckbuilder
+from deckbuilder.executor import DeckInstantiator
+from deckbuilder.promise import Promise, asyncify
+from deckbuilder.renderer import RenderConfig, DeckRenderer
+from deckbuilder.renderinfo import DecksInfo
+from deckbuilder.xmlbuilder import XMLParser
+
+CardsPerStep = 16
+
+
+class BuildPipeline:
+	"""
+	Builds a deck file as a stream instead of phase after phase.
+	Each deck is instantiated as soon as its data is loaded, and its pages are sent to the renderer
+	while the rest of its cards are still being built.
+	"""
+	def __init__(self, path: str, cfg: RenderConfig, store: BlobStore, build_db: Optional[BuildDB] = None):
+		self.path: str = path
+		self.renderer: DeckRenderer = DeckRenderer(cfg, store, build_db)
+		self.db: Deckbuilder = Deckbuilder()
+		self.instantiator: Optional[DeckInstantiator] = None
+		self.decks_left: int = 0
+
+	def run(self) -> DecksInfo:
+		parser = XMLParser(self.path)
+		ctx, ready = parser.parse_streaming()
+		self.instantiator = DeckInstantiator(ctx)
+		self.renderer.prepare()
+		try:
+			tasks: List[Promise[Any]] = list(parser.pending_tasks)
+			self.renderer.expect_decks(ctx.decks)
+			self.decks_left = len(ctx.decks)
+			for template in ctx.decks:
+				tasks.append(self.build_deck(template, ready[template.name]))
+			Promise.all(tasks).run_until_completion()
+			self.renderer.finish_uploads()
+		finally:
+			self.renderer.cleanup()
+		# decks finish in whatever order their data arrives, the result lists them in the order of ctx.decks,
+		# by name, as a build that waits for all of its data does
+		order: Dict[str, int] = {template.name: idx for idx, template in enumerate(ctx.decks)}
+		self.renderer.info.decks.sort(key=lambda info: order[info.name])
+		self.renderer.info.atlases.sort(key=lambda info: info.name)
+		self.renderer.record_build()
+		return self.renderer.info
+
+	@asyncify
+	def build_deck(self, template: DeckTemplate, ready: Promise[Any]):
+		yield ready
+		deck = self.instantiator.start_deck(self.db, template)
+		stream = self.renderer.start_deck(deck, sum(block.card_count() for block in template.card_blocks))
+		for idx, card in enumerate(self.instantiator.build_cards(deck, template)):
+			stream.add(card)
+			if idx % CardsPerStep == CardsPerStep - 1:
+				# give finished downloads and renders a chance to be handled
+				yield None
+		stream.finish()
+		self.decks_left -= 1
+		if self.decks_left == 0:
+			# small sheets are held back to share pages across decks, nothing more will come after the last one
+			self.renderer.flush_batch()
+		yield Promise.all(stream.tasks)
@@ -4,11 +4,11 @@ import subprocess
 import sys
 import threading
 import time
-from typing import List, IO, Callable, TypeVar, Union
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, IO, Callable, TypeVar, Union, Dict, Any
 
-from deckbuilder.promise import Promise, EventLoop
-
-runner_index = 0
+from deckbuilder.build import current_build
+from deckbuilder.promise import Promise, CancellationToken, get_event_loop
 
 MaxLineLength = 256
 
@@ -17,6 +17,102 @@ NormalizeNewlines = re.compile("\r\n|\r|\n")
 MutexStdout = threading.Lock()
 MutexStderr = threading.Lock()
 
+TaskIO = "io"
+TaskRender = "render"
+TaskCommand = "command"
+TaskPipe = "pipe"
+
+DefaultWorkers = {
+	TaskIO: 8,
+	TaskRender: 1,
+	TaskCommand: 4,
+	# every command keeps two pipe readers busy, so this is always twice the command limit
+	TaskPipe: 8,
+}
+
+
+class TaskCategory:
+	def __init__(self, name: str, workers: int):
+		self.name: str = name
+		self.workers: int = workers
+		self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-worker")
+		self.mutex: threading.Lock = threading.Lock()
+		self.queued: int = 0
+		self.running: int = 0
+		self.completed: int = 0
+		self.total_wait: float = 0
+		self.total_run: float = 0
+		self.max_wait: float = 0
+
+	def submit(self, fn: Callable[[], T]) -> 'Future[T]':
+		time_queued = time.time()
+		with self.mutex:
+			self.queued += 1
+
+		def task():
+			time_started = time.time()
+			with self.mutex:
+				self.queued -= 1
+				self.running += 1
+				self.total_wait += time_started - time_queued
+				self.max_wait = max(self.max_wait, time_started - time_queued)
+			try:
+				return fn()
+			finally:
+				with self.mutex:
+					self.running -= 1
+					self.completed += 1
+					self.total_run += time.time() - time_started
+
+		return self.executor.submit(task)
+
+	def metrics(self) -> Dict[str, Any]:
+		with self.mutex:
+			return {
+				"workers": self.workers,
+				"queued": self.queued,
+				"running": self.running,
+				"completed": self.completed,
+				"avg_wait": round(self.total_wait / self.completed, 4) if self.completed else 0,
+				"max_wait": round(self.max_wait, 4),
+				"avg_run": round(self.total_run / self.completed, 4) if self.completed else 0,
+			}
+
+
+class WorkerPool:
+	"""
+	Shared worker threads, split into named categories with their own concurrency limits.
+	"""
+	def __init__(self):
+		self.categories: Dict[str, TaskCategory] = dict()
+		self.mutex: threading.Lock = threading.Lock()
+
+	def configure(self, name: str, workers: int) -> None:
+		with self.mutex:
+			old = self.categories.get(name)
+			self.categories[name] = TaskCategory(name, workers)
+		if old is not None:
+			old.executor.shutdown(wait=False)
+		if name == TaskCommand:
+			self.configure(TaskPipe, workers * 2)
+
+	def category(self, name: str) -> TaskCategory:
+		with self.mutex:
+			if name not in self.categories:
+				self.categories[name] = TaskCategory(name, DefaultWorkers.get(name, DefaultWorkers[TaskIO]))
+			return self.categories[name]
+
+	def submit(self, name: str, fn: Callable[[], T]) -> 'Future[T]':
+		return self.category(name).submit(fn)
+
+	def metrics(self) -> Dict[str, Dict[str, Any]]:
+		with self.mutex:
+			categories = list(self.categories.values())
+		return {category.name: category.metrics() for category in categories}
+
+
+worker_pool = WorkerPool()
+
 
 class OutputBuffer:
 	def __init__(self):
@@ -68,9 +164,10 @@ class OutputBuffer:
 
 
 class TaskProcess:
-	def __init__(self, description: str, runner_idx: int):
+	def __init__(self, description: str, runner_idx: str, token: CancellationToken):
 		self.description = description
 		self.runner_idx = runner_idx
+		self.token = token
 		self.time_start = None
 		self.time_end = None
 		self.stdout = OutputBuffer()
@@ -87,6 +184,12 @@ class TaskProcess:
 		with MutexStderr:
 			print(f"[{self.runner_idx}]- Completed in {self.time_end - self.time_start} s")
 
+	def check_cancelled(self) -> None:
+		self.token.check()
+
+	def log(self, line: str) -> None:
+		self.write_stdout(line + "\n")
+
 	def write_stdout(self, data: Union[bytes, str]) -> None:
 		for line in self.stdout.process(data):
 			self._out(sys.stdout, line)
@@ -114,48 +217,52 @@ def run_async_command(description: str, command: List[str], suppress_stderr=Fals
 		process = subprocess.Popen(executable=command[0], args=command, stdout=subprocess.PIPE, stderr=stderr_target)
 		stdout = process.stdout
 		stderr = process.stderr
-		def start_line_reader(stream: IO[bytes], writer: Callable[[Union[bytes, str]], None]):
+		def start_line_reader(stream: IO[bytes], writer: Callable[[Union[bytes, str]], None]) -> Future:
 			def line_reader_worker():
 				while not stream.closed:
 					bytes = stream.read()
 					if len(bytes) == 0:
 						break
 					writer(bytes)
-			thread = threading.Thread(target=line_reader_worker)
-			thread.start()
-			return thread
+			return worker_pool.submit(TaskPipe, line_reader_worker)
 		stdout_reader = start_line_reader(stdout, task_process.write_stdout)
 		if not suppress_stderr:
 			stderr_reader = start_line_reader(stderr, task_process.write_stderr)
 		else:
 			stderr.close()
-		process.wait()
-		stdout_reader.join()
+		remove_kill = task_process.token.on_cancel(process.kill)
+		try:
+			process.wait()
+		finally:
+			remove_kill()
+		stdout_reader.result()
 		if not suppress_stderr:
-			stderr_reader.join()
+			stderr_reader.result()
+		task_process.check_cancelled()
 		if process.returncode != 0:
 			raise RuntimeError(f"exit code {process.returncode}")
 		return 0
-	return run_threaded(description, worker)
+	return run_threaded(description, worker, TaskCommand)
 
 
-def run_threaded(description: str, callee: Callable[[TaskProcess], T]) -> Promise[T]:
-	global runner_index
-	runner_index += 1
-	task_process = TaskProcess(description, runner_index)
+def run_threaded(description: str, callee: Callable[[TaskProcess], T], category: str = TaskIO) -> Promise[T]:
+	build = current_build()
+	task_process = TaskProcess(description, build.next_task_label(), build.token)
+	loop = get_event_loop()
 	def fn(resolve, reject):
 		def worker():
 			try:
+				# tasks of a cancelled build are dropped without starting
+				task_process.check_cancelled()
 				task_process.start()
 				result = callee(task_process)
 				task_process.end()
-				EventLoop.schedule_thread(lambda: resolve(result))
+				loop.schedule_thread(lambda: resolve(result))
 			except:
 				exc = sys.exc_info()[1]
-				EventLoop.schedule_thread(lambda: reject(exc))
+				loop.schedule_thread(lambda: reject(exc))
 				return
-		thread = threading.Thread(target=worker)
-		thread.start()
+		worker_pool.submit(category, worker)
 	return Promise(fn)
 
 
@@ -1,7 +1,7 @@
 import inspect
 import sys
 import threading
-from typing import Callable, Union, TypeVar, Any, Generic, Optional, List, Iterable
+from typing import Callable, Union, TypeVar, Any, Generic, Optional, List, Iterable, Tuple
 
 
 class PromiseResolver:
@@ -29,8 +29,61 @@ PromiseOrT = Union['Promise[T]', T]
 PromiseOrX = Union['Promise[X]', X]
 
 
-class PromiseEventLoop:
+class TaskCancelled(Exception):
+	pass
+
+
+class CancellationToken:
+	"""
+	Set once the work it was handed to is no longer needed.
+	Long-running tasks check it between steps, queued tasks check it before starting.
+	"""
 	def __init__(self):
+		self.reason: Optional[str] = None
+		self._event: threading.Event = threading.Event()
+		self._callbacks: List[Callable[[], None]] = []
+		self._mutex: threading.Lock = threading.Lock()
+
+	def is_cancelled(self) -> bool:
+		return self._event.is_set()
+
+	def cancel(self, reason: str) -> None:
+		with self._mutex:
+			if self._event.is_set():
+				return
+			self.reason = reason
+			self._event.set()
+			callbacks, self._callbacks = self._callbacks, []
+		for callback in callbacks:
+			callback()
+
+	def check(self) -> None:
+		if self._event.is_set():
+			raise TaskCancelled(f"cancelled: {self.reason}")
+
+	def wait(self, timeout: Optional[float] = None) -> bool:
+		return self._event.wait(timeout)
+
+	def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+		"""
+		Calls callback on cancellation, from the cancelling thread. Returns a function that unregisters it.
+		"""
+		with self._mutex:
+			if not self._event.is_set():
+				self._callbacks.append(callback)
+
+				def remove():
+					with self._mutex:
+						if callback in self._callbacks:
+							self._callbacks.remove(callback)
+				return remove
+		callback()
+		return lambda: None
+
+
+class PromiseEventLoop:
+	def __init__(self, token: Optional[CancellationToken] = None):
+		self.token: CancellationToken = token or CancellationToken()
 		self._scheduled = []
 		self._scheduled_next = []
 		self._scheduled_offthread = []
@@ -62,11 +115,11 @@ class PromiseEventLoop:
 	def process(self):
 		self.pull_from_offthread()
 		while self._scheduled_next:
-			while self._scheduled_next:
-				self._scheduled, self._scheduled_next = self._scheduled_next, self._scheduled
-				for fn in self._scheduled:
-					fn()
-				self._scheduled.clear()
+			self._scheduled, self._scheduled_next = self._scheduled_next, self._scheduled
+			for fn in self._scheduled:
+				fn()
+			self._scheduled.clear()
+			# completions from worker threads are picked up every round, so a busy coroutine does not starve them
 			self.pull_from_offthread()
 
 	def wait(self):
@@ -81,6 +134,24 @@ class PromiseEventLoop:
 
 EventLoop = PromiseEventLoop()
 
+_current = threading.local()
+
+
+def get_event_loop() -> PromiseEventLoop:
+	"""
+	Returns the event loop new promises on this thread are bound to.
+	"""
+	return getattr(_current, "loop", None) or EventLoop
+
+
+def set_event_loop(loop: Optional[PromiseEventLoop]) -> Optional[PromiseEventLoop]:
+	"""
+	Binds promises created on this thread to the loop, returns the previously bound loop.
+	"""
+	previous = getattr(_current, "loop", None)
+	_current.loop = loop
+	return previous
+
 
 STATE_PENDING = 0
 STATE_RESOLVED = 1
@@ -88,12 +159,16 @@ STATE_REJECTED = 2
 
 
 class Promise(Generic[T]):
-	__slots__ = ("_listeners", "_state", "_value")
+	# listeners are either callables taking (success, value), or (promise, on_succ, on_fail) continuations
+	# added by then(), which settle the derived promise without allocating a closure per step
+	__slots__ = ("_listeners", "_state", "_value", "_loop", "_handled")
 
-	def __init__(self, func: Callable[[Callable[[PromiseOrT], None], Callable[[Any], None]], None]):
+	def __init__(self, func: Optional[Callable[[Callable[[PromiseOrT], None], Callable[[Any], None]], None]]):
 		self._listeners = None
 		self._state = STATE_PENDING
 		self._value = None
+		self._handled = False
+		self._loop = get_event_loop()
 		if func:
 			resolver = PromiseResolver(self)
 
@@ -103,17 +178,30 @@ class Promise(Generic[T]):
 				except:
 					resolver.reject(sys.exc_info()[1])
 
-			EventLoop.schedule(callable)
+			self._loop.schedule(callable)
 
 	@staticmethod
 	def resolve(value: PromiseOrT) -> 'Promise[T]':
 		if isinstance(value, Promise):
 			return value
-		return Promise(lambda res, _: res(value))
+		promise = Promise(None)
+		promise._settle(True, value)
+		return promise
 
 	@staticmethod
 	def reject(reason: Any) -> 'Promise[Any]':
-		return Promise(lambda _, rej: rej(reason))
+		promise = Promise(None)
+		promise._settle(False, reason)
+		return promise
+
+	@staticmethod
+	def deferred() -> Tuple['Promise[T]', Callable[[PromiseOrT], None], Callable[[Any], None]]:
+		"""
+		Returns a pending promise along with the functions that settle it.
+		"""
+		promise = Promise(None)
+		resolver = PromiseResolver(promise)
+		return promise, resolver.resolve, resolver.reject
 
 	@staticmethod
 	def all(seq: Iterable['Promise[Any]']) -> 'Promise[List[Any]]':
@@ -121,99 +209,85 @@ class Promise(Generic[T]):
 		if len(promise_list) == 0:
 			return Promise.resolve([])
 
-		def worker(resolve, reject):
-			result = [None] * len(promise_list)
-			pending = len(promise_list)
-			for idx, promise in enumerate(promise_list):
+		promise = Promise(None)
+		result = [None] * len(promise_list)
+		pending = len(promise_list)
+
+		def start():
+			for idx, item in enumerate(promise_list):
 				def fn(succ, val, idx=idx):
-					if not succ:
-						return reject(val)
 					nonlocal pending
+					if promise._state != STATE_PENDING:
+						return
+					if not succ:
+						return promise._settle(False, val)
 					result[idx] = val
 					pending -= 1
 					if pending <= 0:
-						resolve(result)
-				Promise.resolve(promise)._listen(fn)
+						promise._settle(True, result)
+				Promise.resolve(item)._listen(fn)
 
-		return Promise(worker)
+		promise._loop.schedule(start)
+		return promise
 
 	def then(
 		self,
-		on_succ: Callable[[T], PromiseOrX],
+		on_succ: Optional[Callable[[T], PromiseOrX]],
 		on_fail: Optional[Callable[[Any], PromiseOrX]] = None
 	) -> 'Promise[X]':
-		def cont(succ, val):
-			if succ:
-				if on_succ is not None:
-					return on_succ(val)
-				else:
-					return val
-			else:
-				if on_fail is not None:
-					return on_fail(val)
-				else:
-					return self
-		return self._chain(cont)
+		promise = Promise(None)
+		self._listen((promise, on_succ, on_fail))
+		return promise
 
 	def catch(self, on_fail: Callable[[Any], PromiseOrX]) -> 'Promise[X]':
-		def cont(succ, val):
-			if succ:
-				return val
-			else:
-				return on_fail(val)
-		return self._chain(cont)
-
-	def _chain(self, func: Callable[[bool, Union[T, Any]], PromiseOrX]) -> 'Promise[X]':
-		promise = Promise(lambda res, rej: None)
-
-		def cont(succ, val):
-			try:
-				promise._resolve(func(succ, val))
-			except:
-				promise._reject(sys.exc_info()[1])
-
-		self._listen(cont)
-		return promise
+		return self.then(None, on_fail)
 
 	def _listen(self, func: Callable[[bool, Union[T, Any]], None]) -> None:
-		if self._listeners is None:
+		self._handled = True
+		listeners = self._listeners
+		if listeners is None:
 			self._listeners = func
-			self._fire_if_settled()
+			if self._state != STATE_PENDING:
+				self._loop.schedule(self._dispatch)
+		elif type(listeners) is list:
+			listeners.append(func)
 		else:
-			if not isinstance(self._listeners, list):
-				self._listeners = [self._listeners]
-			self._listeners.append(func)
-			if len(self._listeners) == 1:
-				self._fire_if_settled()
-
-	def _fire_if_settled(self):
-		if self._state != STATE_PENDING:
-			EventLoop.schedule(self._dispatch)
+			self._listeners = [listeners, func]
 
 	def _dispatch(self):
-		if self._listeners is None:
-			if self._state == STATE_REJECTED:
-				EventLoop.unhandled_rejection(self, self._value)
+		listeners = self._listeners
+		if listeners is None:
+			if self._state == STATE_REJECTED and not self._handled:
+				# handlers attached later in the same round still count
+				self._loop.schedule(self._check_handled)
+			return
+		self._listeners = None
+		succ = self._state == STATE_RESOLVED
+		if type(listeners) is list:
+			for listener in listeners:
+				_notify(listener, succ, self._value)
 		else:
-			to_dispatch = []
-			if isinstance(self._listeners, list):
-				to_dispatch.extend(self._listeners)
-				self._listeners.clear()
-			else:
-				to_dispatch.append(self._listeners)
-				self._listeners = None
-			for listener in to_dispatch:
-				listener(self._state == STATE_RESOLVED, self._value)
+			_notify(listeners, succ, self._value)
+
+	def _check_handled(self):
+		if not self._handled:
+			self._loop.unhandled_rejection(self, self._value)
 
 	def always(self, func: Callable[[], None]) -> 'Promise[T]':
-		def cont(_, __):
+		def cont(_):
 			func()
 			return self
-		return self._chain(cont)
+		return self.then(cont, cont)
+
+	def __await__(self):
+		from deckbuilder.aiobridge import to_future
+		return to_future(self).__await__()
 
 	def run_until_completion(self) -> T:
+		# the caller handles the rejection, so it must not be reported as unhandled
+		self._handled = True
 		while self._state == STATE_PENDING:
-			EventLoop.wait()
+			self._loop.wait()
 		if self._state == STATE_RESOLVED:
 			return self._value
 		else:
@@ -226,11 +300,8 @@ class Promise(Generic[T]):
 		self._fulfill(False, reason)
 
 	def _fulfill(self, succ: bool, val: Union[T, Any]) -> None:
-		if succ:
-			if isinstance(val, Promise):
-				val._listen(self._fulfill)
-			else:
-				self._settle(succ, val)
+		if succ and isinstance(val, Promise):
+			val._listen(self._fulfill)
 		else:
 			self._settle(succ, val)
 
@@ -240,8 +311,25 @@ class Promise(Generic[T]):
 		else:
 			self._state = STATE_REJECTED
 		self._value = val
-		if self._listeners or self._state == STATE_REJECTED:
-			EventLoop.schedule(self._dispatch)
+		if self._listeners is not None or not succ:
+			self._loop.schedule(self._dispatch)
+
+
+def _notify(listener, succ: bool, value: Any) -> None:
+	if type(listener) is not tuple:
+		listener(succ, value)
+		return
+	promise, on_succ, on_fail = listener
+	handler = on_succ if succ else on_fail
+	if handler is None:
+		promise._fulfill(succ, value)
+		return
+	try:
+		result = handler(value)
+	except:
+		promise._settle(False, sys.exc_info()[1])
+		return
+	promise._fulfill(True, result)
 
 
 def asyncify(fn):
@@ -251,8 +339,12 @@ def asyncify(fn):
 				resolve(fn(*args, **kwargs))
 			else:
 				iter = fn(*args, **kwargs)
+				loop = get_event_loop()
+				token = loop.token
 
 				def spin_val(success, value):
+					if token.is_cancelled():
+						success, value = False, TaskCancelled(f"cancelled: {token.reason}")
 					try:
 						if success:
 							result = iter.send(value)
@@ -264,15 +356,13 @@ def asyncify(fn):
 						return reject(sys.exc_info()[1])
 
 					if isinstance(result, Promise):
-						result.then(
-							lambda val: spin_val(True, val),
-							lambda reason: spin_val(False, reason)
-						)
+						result._listen(spin_val)
+					elif inspect.isawaitable(result):
+						from deckbuilder.aiobridge import from_awaitable
+						from_awaitable(result)._listen(spin_val)
 					else:
-						Promise.resolve(result).then(lambda val: spin_val(True, val))
+						loop.schedule(lambda: spin_val(True, result))
 
 				spin_val(True, None)
 		return Promise(worker)
 	return wrapper
-
-
@@ -0,0 +1,137 @@
+import hashlib
+import http.client
+import os
+import threading
+import time
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+RemoteTimeout = 30
+# after a failed connection, the server is left alone for this long instead of every sheet waiting on it
+RetryDelay = 30
+
+
+class RemoteCacheError(RuntimeError):
+	pass
+
+
+class RemoteCache:
+	"""
+	Client for a cache of rendered images shared over HTTP, see deckbuilder.cacheserver for the protocol.
+	A miss or an unreachable server is never an error for the build, it just means the sheet is rendered locally.
+	"""
+	def __init__(self, url: str, timeout: float = RemoteTimeout):
+		parts = urlsplit(url)
+		if parts.scheme not in ("http", "https"):
+			raise RemoteCacheError(f"unsupported remote cache url '{url}'")
+		self.url: str = url
+		self.scheme: str = parts.scheme
+		self.netloc: str = parts.netloc
+		self.prefix: str = parts.path.rstrip("/")
+		self.timeout: float = timeout
+		self._mutex = threading.Lock()
+		self._idle: List[http.client.HTTPConnection] = []
+		self.down_until: float = 0
+		self.hits: int = 0
+		self.misses: int = 0
+		self.uploads: int = 0
+		self.errors: int = 0
+
+	def _count(self, counter: str) -> None:
+		with self._mutex:
+			setattr(self, counter, getattr(self, counter) + 1)
+
+	def _connect(self) -> http.client.HTTPConnection:
+		if self.scheme == "https":
+			return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+		return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+	def _request(self, method: str, path: str, body: Union[bytes, BinaryIO, None] = None, length: int = 0) -> Tuple[int, bytes]:
+		if time.time() < self.down_until:
+			raise RemoteCacheError(f"{self.url} did not respond recently, not trying again yet")
+		headers = {"Connection": "keep-alive"}
+		if body is not None:
+			headers["Content-Length"] = str(length)
+		with self._mutex:
+			conn = self._idle.pop() if self._idle else None
+		reused = conn is not None
+		if conn is None:
+			conn = self._connect()
+		try:
+			conn.request(method, self.prefix + path, body, headers)
+			response = conn.getresponse()
+			data = response.read()
+		except (OSError, http.client.HTTPException) as err:
+			conn.close()
+			# an idle connection the server has dropped is retried once, unless the body has been read
+			if not reused or (body is not None and not isinstance(body, bytes)):
+				self._count("errors")
+				if isinstance(err, OSError):
+					self.down_until = time.time() + RetryDelay
+				raise RemoteCacheError(f"{method} {self.url}{path} failed: {err}") from err
+			return self._request(method, path, body, length)
+		if response.will_close:
+			conn.close()
+		else:
+			with self._mutex:
+				self._idle.append(conn)
+		return response.status, data
+
+	def _check(self, method: str, path: str, status: int) -> None:
+		if status >= 400:
+			self._count("errors")
+			raise RemoteCacheError(f"{method} {self.url}{path} returned HTTP {status}")
+
+	def get_key(self, key: str) -> Optional[str]:
+		"""
+		Returns the hash of the image stored for a sheet key, or None if the cache has not seen the key.
+		"""
+		status, data = self._request("GET", f"/keys/{key}")
+		if status == 404:
+			self._count("misses")
+			return None
+		self._check("GET", f"/keys/{key}", status)
+		return data.decode("ascii").strip()
+
+	def put_key(self, key: str, hash: str) -> None:
+		data = hash.encode("ascii")
+		status, _ = self._request("PUT", f"/keys/{key}", data, len(data))
+		self._check("PUT", f"/keys/{key}", status)
+
+	def get_blob(self, hash: str) -> Optional[bytes]:
+		"""
+		Returns the image with the given hash, or None if the cache no longer has it.
+		"""
+		status, data = self._request("GET", f"/blobs/{hash}")
+		if status == 404:
+			self._count("misses")
+			return None
+		self._check("GET", f"/blobs/{hash}", status)
+		if hashlib.sha1(data).hexdigest() != hash:
+			self._count("errors")
+			raise RemoteCacheError(f"image {hash} from {self.url} does not match its hash")
+		self._count("hits")
+		return data
+
+	def has_blob(self, hash: str) -> bool:
+		status, _ = self._request("HEAD", f"/blobs/{hash}")
+		if status == 404:
+			return False
+		self._check("HEAD", f"/blobs/{hash}", status)
+		return True
+
+	def put_blob(self, hash: str, path: str) -> None:
+		with open(path, 'rb') as fp:
+			status, _ = self._request("PUT", f"/blobs/{hash}", fp, os.path.getsize(path))
+		self._check("PUT", f"/blobs/{hash}", status)
+		self._count("uploads")
+
+	def metrics(self) -> Dict[str, Any]:
+		with self._mutex:
+			return {
+				"url": self.url,
+				"hits": self.hits,
+				"misses": self.misses,
+				"uploads": self.uploads,
+				"errors": self.errors,
+			}
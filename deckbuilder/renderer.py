@@ -1,41 +1,693 @@
+import abc
+import base64
+import functools
+import hashlib
+import itertools
 import os
 import shutil
+import tempfile
+import threading
 import time
 from collections import defaultdict
-from typing import List, Any, Dict, Optional, Tuple, Set
+from contextlib import contextmanager
+from typing import List, Any, Dict, Optional, Tuple, Set, Iterator, Callable, TypeVar, Union, Iterable
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.common.by import By
-from PIL import Image
+from PIL import Image, ImageDraw
 
+from deckbuilder.blobstore import BlobStore
+from deckbuilder.build import current_build
+from deckbuilder.builddb import BuildDB, RenderVersion
+from deckbuilder.context import DeckTemplate
 from deckbuilder.core import Deckbuilder, Deck, CardFaceTemplate, CardTemplate, TextStyle
-from deckbuilder.process import run_async_command
-from deckbuilder.promise import Promise, asyncify
-from deckbuilder.renderinfo import DecksInfo, DeckInfo, DeckSheetInfo, CardInfo
-from deckbuilder.utils import sha1file
-from threading import Lock
+from deckbuilder.imaging import PNGStripWriter, StripBytes, downsample_png
+from deckbuilder.process import run_threaded, run_async_command, TaskProcess, TaskRender, TaskIO
+from deckbuilder.promise import Promise, PromiseOrX, asyncify
+from deckbuilder.remotecache import RemoteCache, RemoteCacheError
+from deckbuilder.renderinfo import DecksInfo, DeckInfo, DeckSheetInfo, CardInfo, SheetTierInfo, AtlasInfo
+from deckbuilder.utils import sha1file, ValidateError, encode
+
+T = TypeVar("T")
 
 MaxSize = 8192
 MaxCards = 70
+# textures are uploaded as uncompressed RGBA
+BytesPerPixel = 4
+CancelPollInterval = 0.5
+HarnessTimeout = 60
+# sheets up to this many pixels are batched onto shared pages of up to MaxBatchSize squared
+MaxBatchedSheetPixels = 2048 * 2048
+MaxBatchSize = 8192
 
-chrome_mutex = Lock()
-driver = None
+BackendWebDriver = "webdriver"
+BackendCLI = "cli"
+BackendStub = "stub"
+Backends = [BackendWebDriver, BackendCLI, BackendStub]
+
+
+HarnessScript = """
+var css = arguments[0], markup = arguments[1], width = arguments[2], height = arguments[3], done = arguments[4];
+document.getElementById('sheet-style').textContent = css;
+var deck = document.getElementById('deck');
+deck.style.width = width + 'px';
+deck.style.height = height + 'px';
+deck.innerHTML = markup;
+var images = Array.prototype.map.call(deck.getElementsByTagName('img'), function(img) {
+	return img.decode().catch(function() {});
+});
+Promise.all(images).then(function() {
+	return document.fonts.ready;
+}).then(function() {
+	var rect = deck.getBoundingClientRect();
+	done([
+		Math.round(rect.left + window.scrollX),
+		Math.round(rect.top + window.scrollY),
+		Math.ceil(rect.right + window.scrollX),
+		Math.ceil(rect.bottom + window.scrollY)
+	]);
+});
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def base_css() -> str:
+	with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "style.css"), 'r') as style_fp:
+		return style_fp.read()
+
+
+def harness_html() -> str:
+	return "".join((
+		"<!DOCTYPE html>",
+		"<html>",
+		"<head>",
+		'<meta charset="utf-8">',
+		"<style>",
+		base_css(),
+		"</style>",
+		'<style id="sheet-style"></style>',
+		"</head>",
+		"<body>",
+		'<div id="deck" class="deck"></div>',
+		"</body>",
+		"</html>"
+	))
+
+
+def sheet_styles(sheet: 'CardSheet') -> str:
+	return "".join(style.render_css() for style in sorted(sheet.all_styles, key=lambda style: style.class_id))
+
+
+def write_sheet_html(sheet: 'CardSheet', html_file: str, extra_css: str = "") -> None:
+	with open(html_file, 'w', encoding="utf-8") as out:
+		out.write("<!DOCTYPE html>")
+		out.write("<html>")
+		out.write("<head>")
+		out.write('<meta charset="utf-8">')
+		out.write('<style>')
+		out.write(base_css())
+		out.write("\n")
+		out.write(sheet_styles(sheet))
+		out.write(extra_css)
+		out.write('</style>')
+		out.write("</head>")
+		out.write("<body>")
+		out.write(f'<div id="deck" class="deck" style="width:{sheet.layout.width}px;height:{sheet.layout.height}px">')
+		for piece in sheet.contents:
+			out.write(piece)
+		out.write('</div>')
+		out.write("</body>")
+		out.write("</html>")
+
+
+def process_tree_rss(pid: int) -> Optional[int]:
+	"""
+	Resident memory of the process and all of its descendants in bytes, or None where /proc is not available.
+	"""
+	if not os.path.isdir("/proc"):
+		return None
+	children: Dict[int, List[int]] = defaultdict(lambda: [])
+	for entry in os.listdir("/proc"):
+		if not entry.isdigit():
+			continue
+		try:
+			with open(f"/proc/{entry}/stat", 'r') as fp:
+				stat = fp.read()
+		except OSError:
+			continue
+		# the process name is parenthesized and may contain spaces, the parent pid is the second field after it
+		fields = stat[stat.rindex(")") + 2:].split()
+		children[int(fields[1])].append(int(entry))
+	page_size = os.sysconf("SC_PAGE_SIZE")
+	total = 0
+	pending = [pid]
+	while pending:
+		current = pending.pop()
+		try:
+			with open(f"/proc/{current}/statm", 'r') as fp:
+				total += int(fp.read().split()[1]) * page_size
+		except OSError:
+			pass
+		pending.extend(children.get(current, []))
+	return total
+
+
+class ChromeWorker:
+	"""
+	A Chrome WebDriver instance along with what is known about its current page and window.
+	"""
+	def __init__(self, id: int, driver: webdriver.Chrome):
+		self.id: int = id
+		self.driver: webdriver.Chrome = driver
+		self.harness_loaded: bool = False
+		self.extra_size: Tuple[int, int] = (0, 0)
+		self.window_size: Optional[Tuple[int, int]] = None
+		self.renders: int = 0
+		self.time_started: float = time.time()
+
+	def measure_window(self) -> None:
+		self.driver.get("about:blank")
+		self.extra_size = (
+			self.driver.execute_script('return window.outerWidth - window.innerWidth'),
+			self.driver.execute_script('return window.outerHeight - window.innerHeight')
+		)
+
+	def resize(self, process: TaskProcess, width: int, height: int) -> None:
+		required = (width + self.extra_size[0], height + self.extra_size[1])
+		if required == self.window_size:
+			return
+		process.log(f"Requested window size is {required[0]}x{required[1]}, including extra {self.extra_size[0]}x{self.extra_size[1]}")
+		self.driver.set_window_size(*required)
+		self.window_size = required
+		size = self.driver.get_window_size()
+		process.log(f"Actual window size is {size['width']}x{size['height']}")
+
+	def is_alive(self) -> bool:
+		try:
+			return self.driver.service.process.poll() is None and self.driver.execute_script("return 1") == 1
+		except WebDriverException:
+			return False
+
+	def rss(self) -> Optional[int]:
+		try:
+			return process_tree_rss(self.driver.service.process.pid)
+		except (AttributeError, OSError):
+			return None
+
+	def quit(self) -> None:
+		try:
+			self.driver.quit()
+		except Exception:
+			pass
+
+
+class ChromePool:
+	"""
+	Chrome WebDriver instances shared by all builds.
+	Each driver is leased to one render task at a time, checked before it is handed out,
+	and replaced once it fails, has rendered too many sheets or grown too large.
+	"""
+	def __init__(self, size: int, recycle_renders: int = 0, recycle_rss: int = 0, retries: int = 1):
+		self.size: int = size
+		self.recycle_renders: int = recycle_renders
+		self.recycle_rss: int = recycle_rss
+		self.retries: int = retries
+		self._slots: threading.BoundedSemaphore = threading.BoundedSemaphore(size)
+		self._idle: List[ChromeWorker] = []
+		self._workers: Set[ChromeWorker] = set()
+		self._mutex: threading.Lock = threading.Lock()
+		self._harness_path: Optional[str] = None
+		self._worker_ids = itertools.count(1)
+		self.started: int = 0
+		self.restarts: int = 0
+		self.recycled: int = 0
+		self.retried: int = 0
+
+	def run(self, process: TaskProcess, fn: Callable[[ChromeWorker], T]) -> T:
+		"""
+		Calls fn with a leased worker. If Chrome fails on the way, the call is repeated on a fresh one.
+		"""
+		attempt = 0
+		while True:
+			try:
+				with self.worker(process) as chrome:
+					return fn(chrome)
+			except WebDriverException as err:
+				if attempt >= self.retries:
+					raise
+				attempt += 1
+				with self._mutex:
+					self.retried += 1
+				process.log(f"Chrome failed ({str(err).strip()}), retrying on a new instance")
+
+	@contextmanager
+	def worker(self, process: TaskProcess) -> Iterator[ChromeWorker]:
+		while not self._slots.acquire(timeout=CancelPollInterval):
+			process.check_cancelled()
+		try:
+			process.check_cancelled()
+			worker = self._lease(process)
+			try:
+				yield worker
+			except WebDriverException:
+				process.log(f"Chrome instance #{worker.id} failed, shutting it down")
+				with self._mutex:
+					self.restarts += 1
+				self._discard(worker)
+				raise
+			except:
+				self._release(process, worker)
+				raise
+			else:
+				worker.renders += 1
+				self._release(process, worker)
+		finally:
+			self._slots.release()
+
+	def _lease(self, process: TaskProcess) -> ChromeWorker:
+		while True:
+			with self._mutex:
+				worker = self._idle.pop() if self._idle else None
+			if worker is None:
+				return self._start(process)
+			if worker.is_alive():
+				return worker
+			process.log(f"Chrome instance #{worker.id} is not responding, replacing it")
+			with self._mutex:
+				self.restarts += 1
+			self._discard(worker)
+
+	def _start(self, process: TaskProcess) -> ChromeWorker:
+		process.log(f"Starting new Chrome process")
+		options = Options()
+		options.headless = True
+		driver = webdriver.Chrome(options)
+		driver.set_window_size(800, 600)
+		worker = ChromeWorker(next(self._worker_ids), driver)
+		with self._mutex:
+			self.started += 1
+			self._workers.add(worker)
+		return worker
+
+	def _release(self, process: TaskProcess, worker: ChromeWorker) -> None:
+		reason = None
+		if self.recycle_renders and worker.renders >= self.recycle_renders:
+			reason = f"after {worker.renders} renders"
+		elif self.recycle_rss:
+			rss = worker.rss()
+			if rss is not None and rss >= self.recycle_rss:
+				reason = f"at {rss // (1024 * 1024)} MB"
+		if reason is None:
+			with self._mutex:
+				self._idle.append(worker)
+			return
+		process.log(f"Recycling Chrome instance #{worker.id} {reason}")
+		with self._mutex:
+			self.recycled += 1
+		self._discard(worker)
+
+	def _discard(self, worker: ChromeWorker) -> None:
+		with self._mutex:
+			self._workers.discard(worker)
+		worker.quit()
+
+	def metrics(self) -> Dict[str, Any]:
+		with self._mutex:
+			workers = sorted(self._workers, key=lambda worker: worker.id)
+			idle = len(self._idle)
+			counters = {
+				"started": self.started,
+				"restarts": self.restarts,
+				"recycled": self.recycled,
+				"retried": self.retried,
+			}
+		now = time.time()
+		instances = []
+		for worker in workers:
+			rss = worker.rss()
+			instances.append({
+				"id": worker.id,
+				"renders": worker.renders,
+				"age": round(now - worker.time_started, 1),
+				"rss_mb": round(rss / (1024 * 1024), 1) if rss is not None else None,
+			})
+		return {"size": self.size, "idle": idle, **counters, "instances": instances}
+
+	def harness_path(self) -> str:
+		"""
+		The page sheets are injected into. It has to be a file, so that cards can load local images.
+		"""
+		with self._mutex:
+			if self._harness_path is None:
+				path = os.path.join(tempfile.gettempdir(), f"deckbuilder-harness-{os.getpid()}.html")
+				with open(path + ".tmp", 'w', encoding="utf-8") as out:
+					out.write(harness_html())
+				os.replace(path + ".tmp", path)
+				self._harness_path = path
+			return self._harness_path
+
+
+class RenderBackend(abc.ABC):
+	"""
+	Turns card sheets into images. DeckRenderer lays the sheets out and publishes the results,
+	a backend only has to produce a PNG of exactly the sheet's size.
+	"""
+	name: str = ""
+
+	@abc.abstractmethod
+	def render_sheet(self, renderer: 'DeckRenderer', sheet: 'CardSheet', path: str) -> Promise[str]:
+		"""
+		Starts rendering the sheet and returns a promise of the published image path.
+		"""
+
+	def flush(self, renderer: 'DeckRenderer') -> None:
+		"""
+		Starts the renders the backend has been holding back for the build, no more sheets will follow.
+		"""
+		pass
+
+	def metrics(self) -> Dict[str, Any]:
+		return {"backend": self.name}
+
+
+class WebDriverBackend(RenderBackend):
+	"""
+	Renders sheets in Chrome instances driven by Selenium, either by injecting them into a harness page
+	loaded once per instance, or by opening a separate HTML file per sheet.
+	"""
+	name = BackendWebDriver
+
+	def __init__(self, pool: ChromePool, harness: bool):
+		self.pool: ChromePool = pool
+		self.harness: bool = harness
+
+	def render_sheet(self, renderer: 'DeckRenderer', sheet: 'CardSheet', path: str) -> Promise[str]:
+		width = sheet.layout.width
+		height = sheet.layout.height
+		if self.harness and width * height <= MaxBatchedSheetPixels:
+			return self.batch_sheet(renderer, sheet, path)
+		sheet_css = sheet_styles(sheet)
+
+		if self.harness:
+			markup = "".join(sheet.contents)
+			description = f"Rendering {path}"
+		else:
+			html_file = renderer.html_path(path)
+			write_sheet_html(sheet, html_file)
+			description = f"Rendering {html_file}"
+
+		def worker(process: TaskProcess) -> str:
+			preview_path = renderer.preview_path(path)
+
+			def capture(chrome: ChromeWorker) -> None:
+				time_begin = time.time()
+				if self.harness:
+					self.capture_harness(process, chrome, sheet_css, markup, width, height, preview_path)
+				else:
+					self.capture_page(process, chrome, html_file, preview_path)
+				renderer.check_size(process, preview_path, width, height)
+				process.log(f"Rendering complete in {time.time() - time_begin}s")
+
+			self.pool.run(process, capture)
+			return renderer.publish(preview_path)
+
+		return run_threaded(description, worker, TaskRender)
+
+	def batch_sheet(self, renderer: 'DeckRenderer', sheet: 'CardSheet', path: str) -> Promise[str]:
+		if renderer.batch is None or not renderer.batch.add(sheet, path):
+			self.flush(renderer)
+			renderer.batch = SheetBatch()
+			renderer.batch.add(sheet, path)
+		return renderer.batch.items[-1].promise
+
+	def flush(self, renderer: 'DeckRenderer') -> None:
+		"""
+		Sends the small sheets collected so far to Chrome as one page.
+		"""
+		batch = renderer.batch
+		renderer.batch = None
+		if batch is None:
+			return
+
+		def worker(process: TaskProcess) -> List[str]:
+			time_begin = time.time()
+
+			def capture(chrome: ChromeWorker) -> List[str]:
+				self.load_harness(chrome)
+				left, top, _, _ = chrome.driver.execute_async_script(
+					HarnessScript, batch.css(), batch.markup(), batch.width, batch.height
+				)
+				previews = []
+				for item in batch.items:
+					process.check_cancelled()
+					preview_path = renderer.preview_path(item.path)
+					capture = chrome.driver.execute_cdp_cmd("Page.captureScreenshot", {
+						"format": "png",
+						"captureBeyondViewport": True,
+						"clip": {
+							"x": left + item.x,
+							"y": top + item.y,
+							"width": item.sheet.layout.width,
+							"height": item.sheet.layout.height,
+							"scale": 1
+						}
+					})
+					with open(preview_path, 'wb') as fp:
+						fp.write(base64.b64decode(capture["data"]))
+					renderer.check_size(process, preview_path, item.sheet.layout.width, item.sheet.layout.height)
+					previews.append(preview_path)
+				return previews
+
+			previews = self.pool.run(process, capture)
+			process.log(f"Rendered {len(batch.items)} sheets on a {batch.width}x{batch.height} page in {time.time() - time_begin}s")
+			return [renderer.publish(preview) for preview in previews]
+
+		def resolve(paths: List[str]) -> None:
+			for item, target_path in zip(batch.items, paths):
+				item.resolve(target_path)
+
+		def reject(err: Any) -> None:
+			for item in batch.items:
+				item.reject(err)
+
+		description = f"Rendering {', '.join(item.path for item in batch.items)}"
+		run_threaded(description, worker, TaskRender).then(resolve, reject)
+
+	def capture_harness(
+		self,
+		process: TaskProcess,
+		chrome: ChromeWorker,
+		sheet_css: str,
+		markup: str,
+		width: int,
+		height: int,
+		preview_path: str
+	) -> None:
+		driver = chrome.driver
+		self.load_harness(chrome)
+
+		_, _, required_width, required_height = driver.execute_async_script(HarnessScript, sheet_css, markup, width, height)
+		process.check_cancelled()
+
+		chrome.resize(process, required_width, required_height)
+
+		process.check_cancelled()
+		driver.find_element(by=By.ID, value='deck').screenshot(preview_path)
+
+	def load_harness(self, chrome: ChromeWorker) -> None:
+		if chrome.harness_loaded:
+			return
+		chrome.measure_window()
+		chrome.driver.get("file://" + self.pool.harness_path())
+		chrome.driver.set_script_timeout(HarnessTimeout)
+		chrome.harness_loaded = True
+
+	def capture_page(self, process: TaskProcess, chrome: ChromeWorker, html_file: str, preview_path: str) -> None:
+		driver = chrome.driver
+		chrome.harness_loaded = False
+		chrome.measure_window()
+
+		original_size = driver.get_window_size()
+
+		driver.get("file://" + html_file)
+		process.check_cancelled()
+
+		required_width = driver.execute_script('return document.body.parentNode.scrollWidth')
+		required_height = driver.execute_script('return document.body.parentNode.scrollHeight')
+		chrome.resize(process, required_width, required_height)
+
+		process.check_cancelled()
+		driver.find_element(by=By.ID, value='deck').screenshot(preview_path)
+
+		driver.set_window_size(original_size['width'], original_size['height'])
+		chrome.window_size = None
+
+	def metrics(self) -> Dict[str, Any]:
+		return {"backend": self.name, "harness": self.harness, **self.pool.metrics()}
+
+
+class CLIBackend(RenderBackend):
+	"""
+	Renders each sheet with a headless Chrome process of its own, which screenshots the whole window.
+	"""
+	name = BackendCLI
 
-class RenderConfig:
 	def __init__(self, chrome_bin: str):
 		self.chrome_bin: str = chrome_bin
 
+	def render_sheet(self, renderer: 'DeckRenderer', sheet: 'CardSheet', path: str) -> Promise[str]:
+		width = sheet.layout.width
+		height = sheet.layout.height
+		html_file = renderer.html_path(path)
+		preview_path = renderer.preview_path(path)
+		# the sheet has to start at the top left corner, as the screenshot covers the whole window
+		write_sheet_html(sheet, html_file, "body{margin:0;overflow:hidden;}")
+		command = [
+			self.chrome_bin,
+			"--headless",
+			"--disable-gpu",
+			"--hide-scrollbars",
+			"--no-first-run",
+			"--force-device-scale-factor=1",
+			# concurrent processes sharing a profile would hand their work over to the first one
+			f"--user-data-dir={os.path.abspath(os.path.join(renderer.work_dir, path + '.profile'))}",
+			f"--window-size={width},{height}",
+			f"--screenshot={preview_path}",
+			"file://" + html_file
+		]
+
+		def store(process: TaskProcess) -> str:
+			renderer.check_size(process, preview_path, width, height)
+			return renderer.publish(preview_path)
+
+		return run_async_command(f"Rendering {html_file}", command).then(
+			lambda _: run_threaded(f"Storing {path}", store)
+		)
+
+
+class StubBackend(RenderBackend):
+	"""
+	Draws a placeholder instead of rendering the cards: a solid colour derived from the sheet's markup,
+	with the outline of every card cell. The image has the sheet's exact size and the same markup always
+	gives the same image, so everything around rendering can be run and benchmarked without a browser.
+	"""
+	name = BackendStub
+
+	def render_sheet(self, renderer: 'DeckRenderer', sheet: 'CardSheet', path: str) -> Promise[str]:
+		digest = hashlib.sha1()
+		digest.update(sheet_styles(sheet).encode("utf-8"))
+		for piece in sheet.contents:
+			digest.update(piece.encode("utf-8"))
+		color = tuple(digest.digest()[:3])
+
+		def worker(process: TaskProcess) -> str:
+			preview_path = renderer.preview_path(path)
+			width = sheet.layout.width
+			height = sheet.layout.height
+			card_width = sheet.layout.card_width
+			card_height = sheet.layout.card_height
+			outline = tuple(255 - channel for channel in color)
+			rows = max(1, StripBytes // (width * 3))
+			with PNGStripWriter(preview_path, width, height, "RGB") as writer:
+				for top in range(0, height, rows):
+					strip = Image.new("RGB", (width, min(rows, height - top)), color)
+					draw = ImageDraw.Draw(strip)
+					for idx, card in enumerate(sheet.cards):
+						if card is None:
+							continue
+						x = idx % sheet.layout.cols * card_width
+						y = idx // sheet.layout.cols * card_height - top
+						if y < strip.height and y + card_height > 0:
+							draw.rectangle((x, y, x + card_width - 1, y + card_height - 1), outline=outline)
+					writer.write(strip)
+			return renderer.publish(preview_path, writer.digest)
+
+		return run_threaded(f"Rendering {path}", worker, TaskRender)
+
+
+class RenderConfig:
+	def __init__(
+		self,
+		chrome_bin: str,
+		workers: int = 1,
+		harness: bool = True,
+		backend: str = BackendWebDriver,
+		recycle_renders: int = 0,
+		recycle_rss_mb: int = 0,
+		retries: int = 1,
+		texture_budget_mb: float = 0,
+		remote_cache_url: str = ""
+	):
+		if backend not in Backends:
+			raise ValueError(f"unknown render backend '{backend}', expected one of {', '.join(Backends)}")
+		self.chrome_bin: str = chrome_bin
+		# decks without a texture-budget of their own are fitted into this one, 0 leaves them at full size
+		self.texture_budget: int = int(texture_budget_mb * 1024 * 1024)
+		# images rendered by anyone sharing the remote cache are downloaded instead of being rendered again
+		self.remote_cache: Optional[RemoteCache] = RemoteCache(remote_cache_url) if remote_cache_url else None
+		self.backend: RenderBackend
+		if backend == BackendCLI:
+			self.backend = CLIBackend(chrome_bin)
+		elif backend == BackendStub:
+			self.backend = StubBackend()
+		else:
+			pool = ChromePool(workers, recycle_renders, recycle_rss_mb * 1024 * 1024, retries)
+			self.backend = WebDriverBackend(pool, harness)
+
 
 class DeckLayout:
-	def __init__(self, deck: Deck):
-		self.max_per_row: int = MaxSize // int(deck.size[0])
-		self.max_per_col: int = MaxSize // int(deck.size[1])
+	def __init__(self, deck: Deck, card_width: Optional[int] = None):
+		self.width: int = card_width or int(deck.size[0])
+		self.height: int = max(1, round(int(deck.size[1]) * self.width / int(deck.size[0])))
+		# cards are drawn at their native size, and scaled down when the sheets are laid out at a smaller one
+		self.render_scale: float = self.width / int(deck.size[0])
+		self.max_per_row: int = MaxSize // self.width
+		self.max_per_col: int = MaxSize // self.height
 		self.need_face_card: bool = deck.hidden_face is not None
 		self.max_per_page: int = min(self.max_per_row * self.max_per_col - self.need_face_card, MaxCards)
-		self.width: int = int(deck.size[0])
-		self.height: int = int(deck.size[1])
+		# the full size render always comes first, lower tiers are resampled from it
+		self.tiers: List[float] = sorted(set(deck.tiers) | {1}, reverse=True)
 		self.pages: int = 0
 
+	def texture_bytes(self, num_cards: int, unique_backs: bool) -> int:
+		"""
+		Estimates the texture memory taken by the sheets of a deck with this many cards.
+		"""
+		total = 0
+		while num_cards > 0:
+			cards = min(num_cards, self.max_per_page)
+			num_cards -= cards
+			face = CardSheetLayout(self, cards + self.need_face_card, False)
+			back = face if unique_backs else CardSheetLayout(self, cards + self.need_face_card, True)
+			total += (face.width * face.height + back.width * back.height) * BytesPerPixel
+		return total
+
+
+def fit_texture_budget(deck: Deck, num_cards: int, budget: int) -> DeckLayout:
+	"""
+	Lays the deck out at the largest card size whose sheets fit into the budget.
+	"""
+	# without a default back every card brings its own, so the back sheets are assumed to be as large as the faces
+	unique_backs = deck.default_back is None
+	layout = DeckLayout(deck)
+	if layout.texture_bytes(num_cards, unique_backs) <= budget:
+		return layout
+	smallest = DeckLayout(deck, 1).texture_bytes(num_cards, unique_backs)
+	if smallest > budget:
+		raise ValidateError(
+			f"deck '{encode(deck.name)}' does not fit its texture budget of {budget} bytes," +
+			f" its sheets take {smallest} bytes even with cards 1 pixel wide"
+		)
+	low, high = 1, layout.width - 1
+	while low < high:
+		middle = (low + high + 1) // 2
+		if DeckLayout(deck, middle).texture_bytes(num_cards, unique_backs) <= budget:
+			low = middle
+		else:
+			high = middle - 1
+	return DeckLayout(deck, low)
+
 
 class CardSheetLayout:
 	def __init__(self, deck_layout: DeckLayout, num_cards: int, single: bool):
@@ -52,23 +704,31 @@ class CardSheetLayout:
 			rows, cols = min(candidates, key=lambda t: (t[0] * t[1], t[0]))
 			self.rows = rows
 			self.cols = cols
+		self.card_width: int = deck_layout.width
+		self.card_height: int = deck_layout.height
 		self.width = deck_layout.width * self.cols
 		self.height = deck_layout.height * self.rows
 
 
 class CardSheet:
-	def __init__(self, deck: 'Deck', cards: List[Optional[CardFaceTemplate]], layout: CardSheetLayout):
+	def __init__(self, deck: 'Deck', cards: List[Optional[CardFaceTemplate]], layout: CardSheetLayout, name: str):
 		self.deck: Deck = deck
+		self.name: str = name
 		self.layout: layout = layout
 		self.cards: List[CardFaceTemplate] = cards
 		self.all_styles: Set[TextStyle] = set()
 		self.contents: List[str] = []
+		# what the image is looked up by in the build database, set once the sheet is sent to render
+		self.key: Optional[str] = None
 		self.compute_contents()
 
 	def compute_contents(self) -> None:
 		contents: List[str] = self.contents
-		width: int = int(self.deck.size[0])
-		height: int = int(self.deck.size[1])
+		width: int = self.layout.card_width
+		height: int = self.layout.card_height
+		native_width: int = int(self.deck.size[0])
+		native_height: int = int(self.deck.size[1])
+		scaled: bool = width != native_width or height != native_height
 		for idx, card in enumerate(self.cards):
 			if card is None:
 				continue
@@ -81,7 +741,15 @@ class CardSheet:
 					f'<div class="card" ' +
 					f'style="left:{x}px;top:{y}px;width:{width}px;height:{height}px;">'
 			))
-			contents.append(card.render())
+			if scaled:
+				contents.append((
+					f'<div style="position:absolute;width:{native_width}px;height:{native_height}px;' +
+					f'transform:scale({width / native_width},{height / native_height});transform-origin:0 0;">'
+				))
+				contents.append(card.render())
+				contents.append(f'</div>')
+			else:
+				contents.append(card.render())
 			contents.append(f'</div>')
 
 
@@ -98,43 +766,88 @@ def cleardir(path: str):
 			print('Failed to delete %s. Reason: %s' % (file_path, e))
 
 
-class DeckRenderer:
-	def __init__(self, cfg: RenderConfig, out_dir: str):
-		self.cfg: RenderConfig = cfg
-		self.out_dir: str = out_dir
-		self.info: DecksInfo = DecksInfo()
+class BatchItem:
+	def __init__(self, sheet: CardSheet, path: str, x: int, y: int):
+		self.sheet: CardSheet = sheet
+		self.path: str = path
+		self.x: int = x
+		self.y: int = y
+		self.promise, self.resolve, self.reject = Promise.deferred()
+
+
+class SheetBatch:
+	"""
+	Small sheets laid out in rows on one page, to be captured as separate clipped screenshots.
+	"""
+	def __init__(self):
+		self.items: List[BatchItem] = []
+		self.width: int = 0
+		self.height: int = 0
+		self.row_x: int = 0
+		self.row_y: int = 0
+
+	def add(self, sheet: CardSheet, path: str) -> bool:
+		width = sheet.layout.width
+		height = sheet.layout.height
+		x, y = self.row_x, self.row_y
+		if x + width > MaxBatchSize:
+			x, y = 0, self.height
+		if y + height > MaxBatchSize:
+			return False
+		self.items.append(BatchItem(sheet, path, x, y))
+		self.row_x, self.row_y = x + width, y
+		self.width = max(self.width, x + width)
+		self.height = max(self.height, y + height)
+		return True
+
+	def css(self) -> str:
+		styles: Set[TextStyle] = set()
+		for item in self.items:
+			styles.update(item.sheet.all_styles)
+		return "".join(style.render_css() for style in sorted(styles, key=lambda style: style.class_id))
+
+	def markup(self) -> str:
+		pieces: List[str] = []
+		for item in self.items:
+			layout = item.sheet.layout
+			pieces.append(
+				f'<div class="deck" style="position:absolute;left:{item.x}px;top:{item.y}px;' +
+				f'width:{layout.width}px;height:{layout.height}px">'
+			)
+			pieces.extend(item.sheet.contents)
+			pieces.append('</div>')
+		return "".join(pieces)
+
+
+class DeckStream:
+	"""
+	Lays out a deck's cards as they arrive, rendering each page as soon as no later card can change it.
+	"""
+	def __init__(self, renderer: 'DeckRenderer', deck: Deck, info: Union[DeckInfo, AtlasInfo], layout: DeckLayout, name: str):
+		self.renderer: DeckRenderer = renderer
+		self.deck: Deck = deck
+		self.info: Union[DeckInfo, AtlasInfo] = info
+		self.layout: DeckLayout = layout
+		self.name: str = name
+		self.cards_by_back: Dict[CardFaceTemplate, List[CardTemplate]] = defaultdict(lambda: [])
 		self.tasks: List[Promise[Any]] = []
 
-	def render(self, db: Deckbuilder) -> DecksInfo:
-		cleardir(self.out_dir)
-		for deck in db.decks:
-			self.render_deck(deck)
-		Promise.all(self.tasks).run_until_completion()
-		return self.info
+	def add(self, card: CardTemplate) -> None:
+		for _ in range(card.count):
+			self.info.stack.append(card.index)
+		self.place(card)
 
-	def render_deck(self, deck: Deck) -> None:
-		info: DeckInfo = DeckInfo(deck.name, int(deck.size[0]), int(deck.size[1]))
-		info.scale = deck.scale
-		self.info.decks.append(info)
-		layout: DeckLayout = DeckLayout(deck)
+	def place(self, card: CardTemplate) -> None:
+		cards = self.cards_by_back[card.get_back()]
+		cards.append(card)
+		# the leftovers of each back are packed together at the end, so a full page goes out only once it overflows
+		if len(cards) > self.layout.max_per_page:
+			self.render_page(cards[:self.layout.max_per_page])
+			del cards[:self.layout.max_per_page]
 
-		cards_by_back: Dict[CardFaceTemplate, List[CardTemplate]] = defaultdict(lambda: [])
-		cards_to_layout: List[List[CardTemplate]] = []
-		for card in deck.cards:
-			cards_by_back[card.get_back()].append(card)
-			for _ in range(card.count):
-				info.stack.append(card.index)
-		for back, cards in cards_by_back.items():
-			card_instances = []
-			for card in cards:
-				card_instances.append(card)
-			pos = 0
-			while len(card_instances) - pos > layout.max_per_page:
-				self.render_page(card_instances[pos:pos + layout.max_per_page], deck, layout, info)
-				pos += layout.max_per_page
-			if pos != 0:
-				card_instances = card_instances[pos:]
-			cards_to_layout.append(card_instances)
+	def finish(self) -> None:
+		layout = self.layout
+		cards_to_layout: List[List[CardTemplate]] = list(self.cards_by_back.values())
 		current_sheet: List[CardTemplate] = []
 		current_sheet_tained: bool = False
 
@@ -142,7 +855,7 @@ class DeckRenderer:
 			nonlocal current_sheet_tained
 			if len(current_sheet) == 0:
 				return
-			self.render_page(current_sheet, deck, layout, info)
+			self.render_page(current_sheet)
 			current_sheet.clear()
 			current_sheet_tained = False
 
@@ -161,8 +874,181 @@ class DeckRenderer:
 				flush_current_sheet()
 				current_sheet.extend(cards[more_cards:])
 		flush_current_sheet()
+		self.cards_by_back.clear()
+
+	def render_page(self, cards: List[CardTemplate]) -> None:
+		self.tasks.append(self.renderer.render_page(cards, self.deck, self.layout, self.info, self.name))
+
+
+class AtlasStream(DeckStream):
+	"""
+	Lays out the cards of several decks of the same size together, so that they share sheets.
+	Pages that are not full go out once every deck of the atlas has finished.
+	Cards are placed deck by deck in the order of the member names, whichever deck's data arrives first,
+	so that the same decks always give the same sheets. A deck's cards wait until the decks before it are done.
+	"""
+	def __init__(self, renderer: 'DeckRenderer', deck: Deck, info: AtlasInfo, members: List[str]):
+		# sheet names cannot clash with a deck's, deck names cannot contain '@'
+		super().__init__(renderer, deck, info, DeckLayout(deck), f"atlas@{info.name}")
+		self.members: List[str] = sorted(members)
+		self.turn: int = 0
+		self.waiting: Dict[str, List[CardTemplate]] = defaultdict(lambda: [])
+		self.finished: Set[str] = set()
+		self.decks: Dict[str, DeckInfo] = dict()
+
+	def join(self, deck: Deck, info: DeckInfo) -> 'AtlasMemberStream':
+		if deck.hidden_face is not self.deck.hidden_face:
+			raise ValidateError(f"decks in atlas '{encode(self.info.name)}' must have the same face-hidden")
+		info.atlas = self.info.name
+		self.decks[deck.name] = info
+		return AtlasMemberStream(self, info)
+
+	def render_page(self, cards: List[CardTemplate]) -> None:
+		decks = [self.decks[name] for name in sorted({card.deck.name for card in cards})]
+
+		def link(sheet_idx: int) -> None:
+			for info in decks:
+				info.atlas_sheets.append(sheet_idx)
+				info.atlas_sheets.sort()
+
+		promise = self.renderer.render_page(cards, self.deck, self.layout, self.info, self.name).then(link)
+		self.tasks.append(promise)
+
+	def place_member(self, name: str, card: CardTemplate) -> None:
+		if self.members[self.turn] == name:
+			self.place(card)
+		else:
+			self.waiting[name].append(card)
+
+	def finish_member(self, name: str) -> None:
+		self.finished.add(name)
+		while self.turn < len(self.members) and self.members[self.turn] in self.finished:
+			self.turn += 1
+			if self.turn < len(self.members):
+				for card in self.waiting.pop(self.members[self.turn], []):
+					self.place(card)
+		if self.turn == len(self.members):
+			self.finish()
+
+
+class AtlasMemberStream:
+	"""
+	Feeds one deck's cards into its atlas.
+	"""
+	def __init__(self, atlas: AtlasStream, info: DeckInfo):
+		self.atlas: AtlasStream = atlas
+		self.info: DeckInfo = info
+		# the last deck to finish waits for every page of the atlas
+		self.tasks: List[Promise[Any]] = atlas.tasks
+
+	def add(self, card: CardTemplate) -> None:
+		for _ in range(card.count):
+			self.info.stack.append(card.index)
+		self.atlas.place_member(self.info.name, card)
+
+	def finish(self) -> None:
+		self.atlas.finish_member(self.info.name)
 
-	def render_page(self, cards: List[CardTemplate], deck: Deck, deck_layout: DeckLayout, deck_info: DeckInfo) -> None:
+
+class DeckRenderer:
+	def __init__(self, cfg: RenderConfig, store: BlobStore, build_db: Optional[BuildDB] = None):
+		self.cfg: RenderConfig = cfg
+		self.store: BlobStore = store
+		self.build_db: Optional[BuildDB] = build_db
+		# intermediate files are kept apart, so builds running at the same time, here or in
+		# another process sharing the store, do not overwrite each other's
+		self.work_dir: str = os.path.join(store.temp_dir, f"build-{os.getpid()}-{current_build().id}")
+		# hashes of the images this build has stored, they are kept from eviction until it is done
+		self.published: List[str] = []
+		# images of this build by sheet key, for the build database
+		self.sheet_hashes: Dict[str, str] = dict()
+		self.revisions: Dict[str, str] = dict()
+		# sheets only go to the backend once the remote cache has missed them, batches wait for that
+		self.remote_lookups: int = 0
+		self.flush_requested: bool = False
+		# sheets are handed out without waiting for their upload, the build waits for them all at the end
+		self.uploads: List[Promise[str]] = []
+		self.info: DecksInfo = DecksInfo()
+		self.tasks: List[Promise[Any]] = []
+		self.batch: Optional[SheetBatch] = None
+		self.atlas_members: Dict[str, List[str]] = defaultdict(lambda: [])
+		self.atlases: Dict[str, AtlasStream] = dict()
+
+	def prepare(self) -> None:
+		cleardir(self.work_dir)
+
+	def cleanup(self) -> None:
+		shutil.rmtree(self.work_dir, ignore_errors=True)
+		self.store.release(self.published)
+
+	def render(self, db: Deckbuilder) -> DecksInfo:
+		self.prepare()
+		try:
+			self.expect_decks(db.decks)
+			for deck in db.decks:
+				self.render_deck(deck)
+			self.flush_batch()
+			Promise.all(self.tasks).run_until_completion()
+			self.finish_uploads()
+		finally:
+			self.cleanup()
+		return self.info
+
+	def finish_uploads(self) -> None:
+		"""
+		Waits for the images of this build to reach the remote cache, while they are still pinned in the store.
+		"""
+		Promise.all(self.uploads).run_until_completion()
+
+	def render_deck(self, deck: Deck) -> None:
+		stream = self.start_deck(deck, len(deck.cards))
+		for card in deck.cards:
+			stream.add(card)
+		stream.finish()
+		self.tasks.extend(stream.tasks)
+
+	def expect_decks(self, decks: Iterable[Union[Deck, DeckTemplate]]) -> None:
+		"""
+		Announces the decks of the build, so that each atlas knows which decks to wait for.
+		"""
+		for deck in decks:
+			if deck.atlas is not None:
+				self.atlas_members[deck.atlas].append(deck.name)
+
+	def start_deck(self, deck: Deck, num_cards: int) -> Union[DeckStream, AtlasMemberStream]:
+		info: DeckInfo = DeckInfo(deck.name, int(deck.size[0]), int(deck.size[1]))
+		info.scale = deck.scale
+		self.info.decks.append(info)
+		if deck.atlas is not None:
+			return self.join_atlas(deck, info)
+		budget = deck.texture_budget or self.cfg.texture_budget
+		layout = fit_texture_budget(deck, num_cards, budget) if budget else DeckLayout(deck)
+		info.render_scale = layout.render_scale
+		info.tiers = list(layout.tiers)
+		return DeckStream(self, deck, info, layout, deck.name)
+
+	def join_atlas(self, deck: Deck, info: DeckInfo) -> AtlasMemberStream:
+		atlas = self.atlases.get(deck.atlas)
+		if atlas is None:
+			atlas_info = AtlasInfo(deck.atlas, int(deck.size[0]), int(deck.size[1]))
+			self.info.atlases.append(atlas_info)
+			atlas = AtlasStream(self, deck, atlas_info, self.atlas_members[deck.atlas])
+			atlas_info.tiers = list(atlas.layout.tiers)
+			self.atlases[deck.atlas] = atlas
+		info.tiers = list(atlas.layout.tiers)
+		return atlas.join(deck, info)
+
+	def render_page(
+		self,
+		cards: List[CardTemplate],
+		deck: Deck,
+		deck_layout: DeckLayout,
+		deck_info: Union[DeckInfo, AtlasInfo],
+		name: str
+	) -> Promise[int]:
+		"""
+		Renders a page of cards, and returns the index its sheet gets in deck_info.
+		"""
 		unique_backs: bool = False
 		for card in cards:
 			if card.get_back() != cards[0].get_back():
@@ -192,20 +1078,33 @@ class DeckRenderer:
 			backs.append(deck.hidden_face)
 		else:
 			back_layout = CardSheetLayout(deck_layout, len(faces) + deck_layout.need_face_card, True)
-			backs.append(deck.default_back)
+			backs.append(cards[0].get_back())
 
 		deck_layout.pages += 1
 		page_id = deck_layout.pages
+		# the sheet's place is taken up front, so sheets are listed in page order whichever finishes first
+		sheet_idx = len(deck_info.sheets)
+		deck_info.sheets.append(None)
+		deck_info.texture_bytes += (face_layout.width * face_layout.height + back_layout.width * back_layout.height) * BytesPerPixel
 
-		face_sheet = CardSheet(deck, faces, face_layout)
-		face_file = self.render_sheet(face_sheet, f"{deck.name}.{page_id}.face")
+		face_sheet = CardSheet(deck, faces, face_layout, name)
+		face_file = self.render_sheet(face_sheet, f"{name}.{page_id}.face")
 
-		back_sheet = CardSheet(deck, backs, back_layout)
-		back_file = self.render_sheet(back_sheet, f"{deck.name}.{page_id}.back")
+		back_sheet = CardSheet(deck, backs, back_layout, name)
+		back_file = self.render_sheet(back_sheet, f"{name}.{page_id}.back")
+
+		tier_files = [
+			(
+				scale,
+				self.downsample(face_sheet, f"{name}.{page_id}.face", face_file, scale),
+				self.downsample(back_sheet, f"{name}.{page_id}.back", back_file, scale)
+			)
+			for scale in deck_layout.tiers[1:]
+		]
 
 		cards_info = []
 		for card in cards:
-			card_info = CardInfo(card.index, card.name, card.description)
+			card_info = CardInfo(card.index, card.name, card.description, card.deck.name)
 			cards_info.append(card_info)
 
 		@asyncify
@@ -223,95 +1122,200 @@ class DeckRenderer:
 			)
 			for card_info in cards_info:
 				info.cards_info.append(card_info)
-			deck_info.sheets.append(info)
-		self.tasks.append(get_info())
+			info.tiers.append(SheetTierInfo(1, face_path, back_path))
+			for scale, tier_face, tier_back in tier_files:
+				tier_face_path = yield tier_face
+				tier_back_path = yield tier_back
+				info.tiers.append(SheetTierInfo(scale, tier_face_path, tier_back_path))
+			deck_info.sheets[sheet_idx] = info
+			return sheet_idx
+		return get_info()
 
 	def render_sheet(self, sheet: CardSheet, path: str) -> Promise[str]:
-		html_file = os.path.abspath(os.path.join(self.out_dir, path + ".html"))
-		width = sheet.layout.width
-		height = sheet.layout.height
+		if self.build_db is not None or self.cfg.remote_cache is not None:
+			sheet.key = self.sheet_key(sheet)
+		promise = self.cached(sheet.key, lambda: self.cfg.backend.render_sheet(self, sheet, path))
+		self.tasks.append(promise)
+		return promise
 
-		with open(html_file, 'w', encoding="utf-8") as out:
-			out.write("<!DOCTYPE html>")
-			out.write("<html>")
-			out.write("<head>")
-			out.write('<meta charset="utf-8">')
-			out.write('<style>')
-			with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "style.css"), 'r') as style_fp:
-				out.write(style_fp.read())
-			out.write("\n")
-			for style in sorted(sheet.all_styles, key=lambda style: style.class_id):
-				out.write(style.render_css())
-			out.write('</style>')
-			out.write("</head>")
-			out.write("<body>")
-			out.write(f'<div id="deck" class="deck" style="width:{width}px;height:{height}px">')
-			for piece in sheet.contents:
-				out.write(piece)
-			out.write('</div>')
-			out.write("</body>")
-			out.write("</html>")
+	def cached(self, key: Optional[str], render: Callable[[], Promise[str]]) -> Promise[str]:
+		"""
+		Returns the image for a sheet key from the store, then from the remote cache, and only then renders it.
+		"""
+		promise = self.reuse(key)
+		if promise is not None:
+			return promise
+		if key is None or self.cfg.remote_cache is None:
+			return self.remember(key, render())
+		self.remote_lookups += 1
 
-		@asyncify
-		def run():
-			global driver
+		def lookup_done(target_path: Optional[str]) -> PromiseOrX[str]:
+			result = target_path if target_path is not None else self.remember(key, render())
+			self.remote_lookups -= 1
+			if self.remote_lookups == 0 and self.flush_requested:
+				self.flush_requested = False
+				self.cfg.backend.flush(self)
+			return result
+		return self.fetch_remote(key).then(lookup_done)
 
-			preview_path = os.path.abspath(os.path.join(self.out_dir, path)) + ".png"
+	def fetch_remote(self, key: str) -> Promise[Optional[str]]:
+		remote = self.cfg.remote_cache
 
-			with chrome_mutex:
-				print(f"Rendering {html_file}...")
-				time_begin = time.time()
+		def worker(process: TaskProcess) -> Optional[str]:
+			try:
+				hash = remote.get_key(key)
+				if hash is None:
+					return None
+				target_path = self.store.acquire(hash)
+				if target_path is not None:
+					self.published.append(hash)
+				else:
+					data = remote.get_blob(hash)
+					if data is None:
+						return None
+					# identical sheets of the build look up the same key, each download gets a file of its own
+					fd, preview_path = tempfile.mkstemp(".png", f"remote-{hash}-", self.work_dir)
+					with os.fdopen(fd, 'wb') as fp:
+						fp.write(data)
+					target_path = self.publish(preview_path, hash)
+				self.sheet_hashes[key] = hash
+				return target_path
+			except RemoteCacheError as err:
+				process.log(f"Remote cache is not available, rendering instead: {err}")
+				return None
+
+		return run_threaded(f"Looking up {key[:12]} in the remote cache", worker, TaskIO)
 
-				if not driver:
-					print(f"Starting new Chrome process")
+	def upload(self, key: str, target_path: str) -> Promise[str]:
+		"""
+		Shares a freshly rendered image through the remote cache. Failing to is not an error.
+		"""
+		remote = self.cfg.remote_cache
+		hash = self.store.blob_hash(target_path)
 
-					options = Options()
-					options.headless = True
+		def worker(process: TaskProcess) -> str:
+			try:
+				if not remote.has_blob(hash):
+					remote.put_blob(hash, target_path)
+				remote.put_key(key, hash)
+			except (RemoteCacheError, OSError) as err:
+				process.log(f"Could not upload to the remote cache: {err}")
+			return target_path
 
-					driver = webdriver.Chrome(options)
-					driver.set_window_size(800, 600)
+		return run_threaded(f"Uploading {key[:12]} to the remote cache", worker, TaskIO)
 
+	def reuse(self, key: Optional[str]) -> Optional[Promise[str]]:
+		"""
+		Returns the image an earlier build rendered for the sheet key, if the store still has it.
+		"""
+		if key is None or self.build_db is None:
+			return None
+		hash = self.build_db.find_sheet(key)
+		if hash is None:
+			return None
+		target_path = self.store.acquire(hash)
+		if target_path is None:
+			self.build_db.forget_sheets([hash])
+			return None
+		self.published.append(hash)
+		self.sheet_hashes[key] = hash
+		return Promise.resolve(target_path)
 
-				driver.get("about:blank")
+	def remember(self, key: Optional[str], promise: Promise[str]) -> Promise[str]:
+		if key is None:
+			return promise
 
-				original_size = driver.get_window_size()
+		def store_hash(target_path: str) -> str:
+			self.sheet_hashes[key] = self.store.blob_hash(target_path)
+			if self.cfg.remote_cache is not None:
+				self.uploads.append(self.upload(key, target_path))
+			return target_path
+		return promise.then(store_hash)
 
-				extra_height = driver.execute_script('return window.outerHeight - window.innerHeight')
-				extra_width = driver.execute_script('return window.outerWidth - window.innerWidth')
+	def file_revision(self, path: str) -> str:
+		revision = self.revisions.get(path)
+		if revision is None:
+			try:
+				stat = os.stat(path)
+				revision = f"{stat.st_mtime_ns}:{stat.st_size}"
+			except OSError:
+				revision = ""
+			self.revisions[path] = revision
+		return revision
 
-				driver.get("file://" + html_file)
+	def sheet_key(self, sheet: CardSheet) -> str:
+		"""
+		Hashes everything that goes into a sheet's image: how it is rendered, its size and markup,
+		and the revisions of the image files its cards draw.
+		"""
+		digest = hashlib.sha1(f"{RenderVersion}\0{self.cfg.backend.name}\0{sheet.layout.width}x{sheet.layout.height}\0".encode("utf-8"))
+		digest.update(base_css().encode("utf-8"))
+		digest.update(sheet_styles(sheet).encode("utf-8"))
+		for piece in sheet.contents:
+			digest.update(piece.encode("utf-8"))
+		for card in sheet.cards:
+			if card is None:
+				continue
+			for image in card.images:
+				digest.update(f"\0{image}\0{self.file_revision(image)}".encode("utf-8"))
+		return digest.hexdigest()
 
-				required_width = driver.execute_script('return document.body.parentNode.scrollWidth') + extra_width
-				required_height = driver.execute_script('return document.body.parentNode.scrollHeight') + extra_height
+	def record_build(self) -> None:
+		"""
+		Stores what this build rendered in the build database, so that later builds can reuse it.
+		"""
+		if self.build_db is not None:
+			self.build_db.record_build(self.sheet_hashes)
 
-				print(f"Requested window size is {required_width}x{required_height}, including extra {extra_width}x{extra_height}")
-				driver.set_window_size(required_width, required_height)
+	def flush_batch(self) -> None:
+		if self.remote_lookups > 0:
+			# sheets the remote cache misses still have to join the last batch
+			self.flush_requested = True
+			return
+		self.cfg.backend.flush(self)
 
-				size = driver.get_window_size()
-				print(f"Actual window size is {size['width']}x{size['height']}")
+	def downsample(self, sheet: CardSheet, path: str, source: Promise[str], scale: float) -> Promise[str]:
+		"""
+		Produces a lower resolution tier of a sheet by resampling its full size render.
+		"""
+		# every card is scaled to the same whole number of pixels, so the sheet still splits evenly
+		card_width = max(1, round(sheet.layout.width // sheet.layout.cols * scale))
+		card_height = max(1, round(sheet.layout.height // sheet.layout.rows * scale))
+		size = (card_width * sheet.layout.cols, card_height * sheet.layout.rows)
 
-				driver.find_element(by=By.ID, value='deck').screenshot(preview_path)
+		def worker(process: TaskProcess, source_path: str) -> str:
+			preview_path = self.preview_path(f"{path}@{scale:g}")
+			return self.publish(preview_path, downsample_png(source_path, preview_path, size))
 
-				with Image.open(preview_path) as image:
-					image_width, image_height = image.size
-					if width != image_width or height != image_height:
-						print(f"WARNING! Image size is {image_width}x{image_height}, but expected {width}x{height}")
-						print(f"This is probably a bug in the Selenium rendering process")
-						raise RuntimeError(f"Image size mismatch, expected {width}x{height}, got {image_width}x{image_height}")
+		key = f"{sheet.key}@{scale:g}" if sheet.key is not None else None
+		promise = self.cached(key, lambda: source.then(lambda source_path: run_threaded(
+			f"Downsampling {path} to {scale:g}x",
+			lambda process: worker(process, source_path)
+		)))
+		self.tasks.append(promise)
+		return promise
 
-				driver.set_window_size(original_size['width'], original_size['height'])
+	def html_path(self, path: str) -> str:
+		return os.path.abspath(os.path.join(self.work_dir, path + ".html"))
 
-				print(f"Rendering complete in {time.time() - time_begin}s")
+	def preview_path(self, path: str) -> str:
+		return os.path.abspath(os.path.join(self.work_dir, path)) + ".png"
 
-			hash = sha1file(preview_path)
-			target_path = os.path.abspath(os.path.join(self.out_dir, sheet.deck.name + "." + hash[:12] + ".png"))
-			try:
-				os.remove(target_path)
-			except:
-				pass
-			shutil.copy(preview_path, target_path)
-			return target_path
+	def check_size(self, process: TaskProcess, preview_path: str, width: int, height: int) -> None:
+		# opening an image only reads its header, the pixels are never decoded here
+		with Image.open(preview_path) as image:
+			image_width, image_height = image.size
+			if width != image_width or height != image_height:
+				process.log(f"WARNING! Image size is {image_width}x{image_height}, but expected {width}x{height}")
+				process.log(f"This is probably a bug in the Selenium rendering process")
+				raise RuntimeError(f"Image size mismatch, expected {width}x{height}, got {image_width}x{image_height}")
 
-		promise = run()
-		self.tasks.append(promise)
-		return promise
+	def publish(self, preview_path: str, digest: Optional[str] = None) -> str:
+		"""
+		Moves a finished image into the store, identical images of any deck or build end up as the same file.
+		"""
+		hash = digest or sha1file(preview_path)
+		target_path = self.store.put(preview_path, hash)
+		# only a successful put pins the blob, and each pin is released once
+		self.published.append(hash)
+		return target_path
@@ -2,10 +2,18 @@ from typing import List, Optional
 
 
 class CardInfo:
-	def __init__(self, index: int, name: Optional[str], description: Optional[str]):
+	def __init__(self, index: int, name: Optional[str], description: Optional[str], deck: str):
 		self.index: int = index
 		self.name: Optional[str] = name
 		self.description: Optional[str] = description
+		self.deck: str = deck
+
+
+class SheetTierInfo:
+	def __init__(self, scale: float, face: str, back: str):
+		self.scale: float = scale
+		self.face: str = face
+		self.back: str = back
 
 
 class DeckSheetInfo:
@@ -27,6 +35,7 @@ class DeckSheetInfo:
 		self.count: int = count
 		self.has_face_hidden: bool = has_face_hidden
 		self.cards_info: List[CardInfo] = []
+		self.tiers: List[SheetTierInfo] = []
 
 class DeckInfo:
 	def __init__(self, name: str, width: int, height: int):
@@ -36,7 +45,24 @@ class DeckInfo:
 		self.sheets: List[DeckSheetInfo] = []
 		self.stack: List[int] = []
 		self.scale: float = 1
+		self.tiers: List[float] = [1]
+		# the sheets' card size relative to width and height, the in-game size only depends on scale
+		self.render_scale: float = 1
+		self.texture_bytes: int = 0
+		# decks in an atlas have no sheets of their own, their cards are on the atlas' sheets listed here
+		self.atlas: Optional[str] = None
+		self.atlas_sheets: List[int] = []
+
+class AtlasInfo:
+	def __init__(self, name: str, width: int, height: int):
+		self.name: str = name
+		self.width: int = width
+		self.height: int = height
+		self.sheets: List[DeckSheetInfo] = []
+		self.tiers: List[float] = [1]
+		self.texture_bytes: int = 0
 
 class DecksInfo:
 	def __init__(self):
 		self.decks: List[DeckInfo] = []
+		self.atlases: List[AtlasInfo] = []
@@ -1,27 +1,31 @@
-import hashlib
 import html
 import json
 import os
+import select
+import socket
 import sys
 from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 
-from deckbuilder.executor import DeckInstantiator
-from deckbuilder.renderer import RenderConfig, DeckRenderer
-from deckbuilder.renderinfo import DeckSheetInfo, CardInfo, DeckInfo
-from deckbuilder.xmlbuilder import XMLParser
+from deckbuilder.blobstore import BlobStore
+from deckbuilder.build import BuildContext
+from deckbuilder.builddb import BuildDB
+from deckbuilder.datasource import fetcher
+from deckbuilder.jobs import JobManager, JobQueueFull, BuildJob
+from deckbuilder.pipeline import BuildPipeline
+from deckbuilder.process import worker_pool, TaskIO, TaskRender, TaskCommand
+from deckbuilder.promise import PromiseEventLoop, CancellationToken
+from deckbuilder.renderer import RenderConfig
+from deckbuilder.renderinfo import DeckSheetInfo, CardInfo, DeckInfo, DecksInfo, SheetTierInfo, AtlasInfo
 import configparser
 
 
-def sha1(s):
-	return hashlib.sha1(s.encode('utf-8')).hexdigest()
-
-
 def convert_card(card: CardInfo):
 	return {
 		"index": card.index,
 		"name": card.name,
-		"description": card.description
+		"description": card.description,
+		"deck": card.deck
 	}
 
 def add_slash(s: str) -> str:
@@ -29,6 +33,13 @@ def add_slash(s: str) -> str:
 		return s
 	return '/' + s
 
+def convert_tier(tier: SheetTierInfo):
+	return {
+		"scale": tier.scale,
+		"face": "file://" + add_slash(tier.face),
+		"back": "file://" + add_slash(tier.back)
+	}
+
 def convert_sheet(sheet: DeckSheetInfo):
 	return {
 		"face": "file://" + add_slash(sheet.face),
@@ -38,7 +49,8 @@ def convert_sheet(sheet: DeckSheetInfo):
 		"height": sheet.height,
 		"unique_backs": sheet.unique_backs,
 		"has_face_hidden": sheet.has_face_hidden,
-		"cards": [convert_card(card) for card in sheet.cards_info]
+		"cards": [convert_card(card) for card in sheet.cards_info],
+		"tiers": [convert_tier(tier) for tier in sheet.tiers]
 	}
 
 def convert_deck(deck: DeckInfo):
@@ -48,26 +60,171 @@ def convert_deck(deck: DeckInfo):
 		"height": deck.height,
 		"sheets": [convert_sheet(sheet) for sheet in deck.sheets],
 		"stack": deck.stack,
-		"scale": deck.scale
+		"scale": deck.scale,
+		"tiers": deck.tiers,
+		"render_scale": deck.render_scale,
+		"texture_bytes": deck.texture_bytes,
+		"atlas": deck.atlas,
+		"atlas_sheets": deck.atlas_sheets
+	}
+
+def convert_atlas(atlas: AtlasInfo):
+	return {
+		"name": atlas.name,
+		"width": atlas.width,
+		"height": atlas.height,
+		"sheets": [convert_sheet(sheet) for sheet in atlas.sheets],
+		"tiers": atlas.tiers,
+		"texture_bytes": atlas.texture_bytes
 	}
 
 
 config = configparser.ConfigParser()
 config['general'] = {
 	"chrome_bin": r"C:\Program Files (x86)\Google\Chrome\Application\chrome.exe",
-	"cache_path": r".",
-	"port": "17352"
+	"store_path": r".cache",
+	"store_max_mb": "4096",
+	"port": "17352",
+	"fetch_concurrency": "4",
+	"render_workers": "1",
+	"render_harness": "yes",
+	"render_backend": "webdriver",
+	"render_recycle_after": "200",
+	"render_recycle_rss_mb": "2048",
+	"render_retries": "1",
+	"build_workers": "2",
+	"build_queue": "8",
+	"io_workers": "8",
+	"command_workers": "4",
+	"texture_budget_mb": "0",
+	"remote_cache": ""
 }
 config.read("config.ini")
 
 CHROME_BIN = config['general']['chrome_bin']
-CACHE_PATH = config['general']['cache_path']
+STORE_PATH = config['general']['store_path']
+STORE_MAX_MB = config.getfloat('general', 'store_max_mb')
 PORT = config.getint('general', 'port')
+FETCH_CONCURRENCY = config.getint('general', 'fetch_concurrency')
+RENDER_WORKERS = config.getint('general', 'render_workers')
+RENDER_HARNESS = config.getboolean('general', 'render_harness')
+RENDER_BACKEND = config['general']['render_backend']
+RENDER_RECYCLE_AFTER = config.getint('general', 'render_recycle_after')
+RENDER_RECYCLE_RSS_MB = config.getint('general', 'render_recycle_rss_mb')
+RENDER_RETRIES = config.getint('general', 'render_retries')
+BUILD_WORKERS = config.getint('general', 'build_workers')
+BUILD_QUEUE = config.getint('general', 'build_queue')
+IO_WORKERS = config.getint('general', 'io_workers')
+COMMAND_WORKERS = config.getint('general', 'command_workers')
+TEXTURE_BUDGET_MB = config.getfloat('general', 'texture_budget_mb')
+REMOTE_CACHE = config['general']['remote_cache']
 
-render_cfg = RenderConfig(CHROME_BIN)
+DisconnectPollInterval = 0.5
+
+render_cfg = RenderConfig(
+	CHROME_BIN,
+	RENDER_WORKERS,
+	RENDER_HARNESS,
+	RENDER_BACKEND,
+	RENDER_RECYCLE_AFTER,
+	RENDER_RECYCLE_RSS_MB,
+	RENDER_RETRIES,
+	TEXTURE_BUDGET_MB,
+	REMOTE_CACHE
+)
+store = BlobStore(STORE_PATH, int(STORE_MAX_MB * 1024 * 1024))
+build_db = BuildDB(os.path.join(store.path, "builds.sqlite"))
+fetcher.configure(FETCH_CONCURRENCY)
+worker_pool.configure(TaskIO, IO_WORKERS)
+worker_pool.configure(TaskRender, RENDER_WORKERS)
+worker_pool.configure(TaskCommand, COMMAND_WORKERS)
+
+
+def build_deck(deck: str, token: CancellationToken) -> DecksInfo:
+	print(f"BUILDING {json.dumps(deck)}")
+	with BuildContext(deck, PromiseEventLoop(token)):
+		deck_info = BuildPipeline(deck, render_cfg, store, build_db).run()
+	print(f"BUILDING {json.dumps(deck)} SUCCESSFULLY COMPLETED!")
+	return deck_info
+
+
+jobs = JobManager(build_deck, BUILD_WORKERS, BUILD_QUEUE)
 
 
 class RequestHandler(BaseHTTPRequestHandler):
+	def client_disconnected(self) -> bool:
+		readable, _, _ = select.select([self.connection], [], [], 0)
+		if not readable:
+			return False
+		try:
+			# a closed connection reads as end of stream, a pipelined request leaves data to peek at
+			return len(self.connection.recv(1, socket.MSG_PEEK)) == 0
+		except OSError:
+			return True
+
+	def wait_for_job(self, job: BuildJob) -> bool:
+		"""
+		Waits for a job submitted with waiting=True, returns False if the client went away first.
+		"""
+		try:
+			while not job.wait(DisconnectPollInterval):
+				if self.client_disconnected():
+					print(f"Client disconnected while waiting for job {job.id}")
+					return False
+			return True
+		finally:
+			jobs.release(job)
+
+	def send_json(self, code, data):
+		self.send_response(code)
+		self.send_header("Content-type", "application/json;encoding=UTF-8")
+		self.end_headers()
+		self.wfile.write(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+	def send_decks(self, deck_info: DecksInfo):
+		decks = []
+		for deck in deck_info.decks:
+			decks.append(convert_deck(deck))
+		self.send_json(200, {
+			"response": {
+				"decks": decks,
+				"atlases": [convert_atlas(atlas) for atlas in deck_info.atlases]
+			}
+		})
+
+	def send_preview(self, deck_info: DecksInfo):
+		self.send_response(200)
+		self.send_header("Content-type", "text/html;encoding=UTF-8")
+		self.end_headers()
+		imgs = []
+		for deck in deck_info.decks:
+			imgs.append(f"<p>{html.escape(deck.name)}<br>")
+			imgs.append(f"Faces:<br>")
+			for face in set((sheet.face for sheet in deck.sheets)):
+				imgs.append(f"<img src=\"img?src={html.escape(face)}\">")
+			imgs.append(f"<br>Backs:<br>")
+			for back in set((sheet.back for sheet in deck.sheets)):
+				imgs.append(f"<img src=\"img?src={html.escape(back)}\">")
+		for atlas in deck_info.atlases:
+			imgs.append(f"<p>Atlas {html.escape(atlas.name)}<br>")
+			imgs.append(f"Faces:<br>")
+			for face in set((sheet.face for sheet in atlas.sheets)):
+				imgs.append(f"<img src=\"img?src={html.escape(face)}\">")
+			imgs.append(f"<br>Backs:<br>")
+			for back in set((sheet.back for sheet in atlas.sheets)):
+				imgs.append(f"<img src=\"img?src={html.escape(back)}\">")
+		self.wfile.write('\n'.join((
+			"<html>",
+			"<head>",
+			'<meta charset="utf-8">',
+			'<style>* {font-size: 60px;}</style>',
+			"</head>"
+			"<body>",
+			*imgs,
+			"</body>",
+			"</html>"
+		)).encode('utf-8'))
+
 	def serve_image(self, request):
 		query = parse_qs(request.query, keep_blank_values=True)
 		if 'src' not in query or len(query['src']) == 0:
@@ -79,65 +236,80 @@ class RequestHandler(BaseHTTPRequestHandler):
 		with open(src, 'rb') as fp:
 			self.wfile.write(fp.read())
 
+	def find_job(self, query) -> BuildJob:
+		if 'id' not in query or len(query['id']) == 0:
+			raise RuntimeError("no 'id' param")
+		job = jobs.get(query['id'][0])
+		if job is None:
+			raise RuntimeError(f"unknown job {query['id'][0]}")
+		return job
+
+	def serve_job_submit(self, query):
+		if 'deck' not in query or len(query['deck']) == 0:
+			raise RuntimeError("no 'deck' param")
+		job = jobs.submit(query['deck'][0])
+		self.send_json(202, {"job": job.status()})
+
+	def serve_job_status(self, query):
+		self.send_json(200, {"job": self.find_job(query).status()})
+
+	def serve_job_result(self, query):
+		job = self.find_job(query)
+		if job.is_pending():
+			self.send_json(202, {"job": job.status()})
+		elif job.error is not None:
+			self.send_json(500, {"error": job.error})
+		elif 'preview' in query:
+			self.send_preview(job.result)
+		else:
+			self.send_decks(job.result)
+
 	def do_GET(self):
 		try:
 			request = urlparse(self.path)
+			query = parse_qs(request.query, keep_blank_values=True)
 			if request.path == "/img":
 				return self.serve_image(request)
-			query = parse_qs(request.query, keep_blank_values=True)
+			if request.path == "/jobs/submit":
+				return self.serve_job_submit(query)
+			if request.path == "/jobs/status":
+				return self.serve_job_status(query)
+			if request.path == "/jobs/result":
+				return self.serve_job_result(query)
+			if request.path == "/metrics":
+				return self.send_json(200, {
+					"jobs": jobs.metrics(),
+					"workers": worker_pool.metrics(),
+					"render": render_cfg.backend.metrics(),
+					"store": store.metrics(),
+					"build_db": build_db.metrics(),
+					"remote_cache": render_cfg.remote_cache.metrics() if render_cfg.remote_cache is not None else None
+				})
 			if 'deck' not in query or len(query['deck']) == 0:
 				raise RuntimeError("no 'deck' param")
 			deck = query['deck'][0]
 			print(f"REQUESTED BUILDING {json.dumps(deck)}")
-			db = DeckInstantiator(XMLParser(deck).parse()).run()
-			deck_info = DeckRenderer(render_cfg, os.path.join(os.path.dirname(deck), CACHE_PATH, ".cache/" + sha1(deck))).render(db)
-			print(f"BUILDING {json.dumps(deck)} SUCCESSFULLY COMPLETED!")
+			job = jobs.submit(deck, waiting=True)
+			if not self.wait_for_job(job):
+				return
+			if job.error is not None:
+				raise RuntimeError(job.error)
 			if 'preview' in query:
-				self.send_response(200)
-				self.send_header("Content-type", "text/html;encoding=UTF-8")
-				self.end_headers()
-				imgs = []
-				for deck in deck_info.decks:
-					imgs.append(f"<p>{html.escape(deck.name)}<br>")
-					imgs.append(f"Faces:<br>")
-					for face in set((sheet.face for sheet in deck.sheets)):
-						imgs.append(f"<img src=\"img?src={html.escape(face)}\">")
-					imgs.append(f"<br>Backs:<br>")
-					for back in set((sheet.back for sheet in deck.sheets)):
-						imgs.append(f"<img src=\"img?src={html.escape(back)}\">")
-				self.wfile.write('\n'.join((
-					"<html>",
-					"<head>",
-					'<meta charset="utf-8">',
-					'<style>* {font-size: 60px;}</style>',
-					"</head>"
-					"<body>",
-					*imgs,
-					"</body>",
-					"</html>"
-				)).encode('utf-8'))
+				self.send_preview(job.result)
 			else:
-				decks = []
-				for deck in deck_info.decks:
-					decks.append(convert_deck(deck))
-				self.send_response(200)
-				self.send_header("Content-type", "application/json;encoding=UTF-8")
-				self.end_headers()
-				self.wfile.write(json.dumps({
-					"response": {
-						"decks": decks
-					}
-				}, ensure_ascii=False).encode('utf-8'))
+				self.send_decks(job.result)
+		except JobQueueFull as err:
+			print(f"{err}")
+			self.send_json(503, {
+				"error": str(err)
+			})
 		except:
 			print(f"{sys.exc_info()[1]}")
-			self.send_response(500)
-			self.send_header("Content-type", "application/json;encoding=UTF-8")
-			self.end_headers()
-			self.wfile.write(json.dumps({
+			self.send_json(500, {
 				"error": str(sys.exc_info()[1])
-			}, ensure_ascii=False).encode('utf-8'))
+			})
 
 
 print(f"Starting server on port {PORT}")
 print(f"Open http://localhost:{PORT}/?preview&deck=example/deck.xml for an example deck")
-ThreadingHTTPServer(("localhost", PORT), RequestHandler).serve_forever()
\ No newline at end of file
+ThreadingHTTPServer(("localhost", PORT), RequestHandler).serve_forever()
@@ -15,6 +15,8 @@ class TextParser:
 		self.s: str = s
 		self.pos: int = 0
 		self.fragments: List[str] = []
+		# files of the inline symbols in the text, their revisions are part of the sheet's cache key
+		self.images: List[str] = []
 
 	def peek(self) -> Optional[str]:
 		if self.pos >= len(self.s):
@@ -61,7 +63,9 @@ class TextParser:
 		style = ""
 		if inline.offset_y != 0:
 			style = f'style="transform: translateY({inline.offset_y}px);"'
-		self.fragments.append(f'<img src="{html.escape(self.ctx.resolve_path(inline.src))}" class="icon-inline" {style}>')
+		src = self.ctx.resolve_path(inline.src)
+		self.images.append(src)
+		self.fragments.append(f'<img src="{html.escape(src)}" class="icon-inline" {style}>')
 
 	def parse_star(self):
 		count = 1
@@ -1,5 +1,8 @@
 import hashlib
 import html
+from typing import BinaryIO
+
+HashBlockSize = 1024 * 1024
 
 
 class ValidateError(RuntimeError):
@@ -11,5 +14,27 @@ def encode(s):
 
 
 def sha1file(path):
+	digest = hashlib.sha1()
 	with open(path, 'rb') as fp:
-		return hashlib.sha1(fp.read()).hexdigest()
\ No newline at end of file
+		for block in iter(lambda: fp.read(HashBlockSize), b""):
+			digest.update(block)
+	return digest.hexdigest()
+
+
+class HashingWriter:
+	"""
+	Writes to a file and hashes the data on the way, so the file does not have to be read back to be hashed.
+	"""
+	def __init__(self, fp: BinaryIO):
+		self.fp: BinaryIO = fp
+		self.digest = hashlib.sha1()
+
+	def write(self, data: bytes) -> int:
+		self.digest.update(data)
+		return self.fp.write(data)
+
+	def close(self) -> None:
+		self.fp.close()
+
+	def hexdigest(self) -> str:
+		return self.digest.hexdigest()
@@ -24,6 +24,25 @@ def parse_expr(value):
 def parse_string(value):
 	return value
 
+def parse_string_list(value):
+	return [item.strip() for item in value.split(",") if len(item.strip()) > 0]
+
+def parse_tiers(value):
+	tiers = []
+	for item in parse_string_list(value):
+		tier = parse_float(item)
+		if not 0 < tier <= 1:
+			raise ValidateError("expected resolution tiers greater than 0 and at most 1")
+		tiers.append(tier)
+	return tiers
+
+def parse_char(value):
+	if value == "\\t":
+		return "\t"
+	if len(value) != 1:
+		raise ValidateError("expected a single character")
+	return value
+
 def parse_name(value):
 	if not re_style_name.match(value):
 		raise ValidateError("expected name (allowed characters are a-z, A-Z, 0-9, and '_', starts with a letter)")
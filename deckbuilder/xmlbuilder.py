@@ -3,22 +3,25 @@ import sys
 
 from deckbuilder.ast import StmtForEach, StmtSetName, StmtSetDescription, StmtWhile, StmtFor, StmtCase, StmtIf, \
 	StmtSetVar, WhenBlock, StmtBack
-from deckbuilder.context import DeckTemplate, DeckContext, CardBlock, CardData, FaceTemplate, InlineSymbol
-from deckbuilder.datasource import download_google_sheet_as_dictionary
+from deckbuilder.context import DeckTemplate, DeckContext, CardBlock, CardData, FaceTemplate, InlineSymbol, DataTable
+from deckbuilder.datasource import read_google_sheet_rows, read_csv_rows, read_jsonl_rows, read_sqlite_rows, \
+	read_rows, RowFilter
 from deckbuilder.executor import StmtSequence, StmtFace, StmtDrawText, StmtDrawRect, StmtDrawImage
 from deckbuilder.process import run_threaded, TaskProcess
 from deckbuilder.promise import Promise, asyncify
 from deckbuilder.utils import ValidateError, encode
 from deckbuilder.validators import parse_expr, parse_int, parse_name, parse_font_name, \
-	parse_color, parse_bool, parse_halign, parse_valign, parse_float, parse_string, parse_fstring
+	parse_color, parse_bool, parse_halign, parse_valign, parse_float, parse_string, parse_fstring, parse_string_list, \
+	parse_char, parse_tiers
 
 sys.modules['_elementtree'] = None
 import xml.etree.ElementTree as ElementTree
-from typing import Dict, Optional, List, Callable, Any, TypeVar, Tuple, NoReturn
+from typing import Dict, Optional, List, Callable, Any, TypeVar, Tuple, NoReturn, Iterable, Union
 from xml.etree.ElementTree import Element
 from deckbuilder.core import TextStyle
 
 T = TypeVar("T")
+RowTarget = Union[CardBlock, DataTable]
 
 
 class LineNumberingParser(ElementTree.XMLParser):
@@ -80,22 +83,60 @@ setdescription_scheme = ElementScheme({
 	"value": parse_fstring,
 }, ["value"])
 
+table_scheme = ElementScheme({
+	"name": parse_name,
+	"key": parse_string
+}, ["name", "key"])
+
 deck_scheme = ElementScheme({
 	"name": parse_name,
 	"width": parse_int,
 	"height": parse_int,
-	"scale": parse_float
+	"scale": parse_float,
+	"tiers": parse_tiers,
+	"texture-budget": parse_float,
+	"atlas": parse_name
 }, ["name", "width", "height"])
 
 google_scheme = ElementScheme({
 	"key": parse_string,
 	"sheet": parse_string,
+	"columns": parse_string_list,
+	"filter": parse_expr
 }, ["key", "sheet"])
 
 imageset_scheme = ElementScheme({
-	"path": parse_string
+	"path": parse_string,
+	"columns": parse_string_list,
+	"filter": parse_expr
+}, ["path"])
+
+csv_scheme = ElementScheme({
+	"path": parse_string,
+	"delimiter": parse_char,
+	"columns": parse_string_list,
+	"filter": parse_expr
+}, ["path"])
+
+tsv_scheme = ElementScheme({
+	"path": parse_string,
+	"columns": parse_string_list,
+	"filter": parse_expr
+}, ["path"])
+
+jsonl_scheme = ElementScheme({
+	"path": parse_string,
+	"columns": parse_string_list,
+	"filter": parse_expr
 }, ["path"])
 
+sqlite_scheme = ElementScheme({
+	"path": parse_string,
+	"query": parse_string,
+	"columns": parse_string_list,
+	"filter": parse_expr
+}, ["path", "query"])
+
 draw_text_scheme = ElementScheme({
 	"x": parse_expr,
 	"y": parse_expr,
@@ -146,10 +187,16 @@ class XMLParser:
 	def __init__(self, path: str):
 		self.path: str = path
 		self.base_path: str = os.path.dirname(path)
+		# local files the decks are built from, besides the images they draw
 		self.styles: Dict[str, Dict[str, any]] = dict()
 		self.inlines: Dict[str, InlineSymbol] = dict()
 		self.decks: Dict[str, DeckTemplate] = dict()
+		self.atlases: Dict[str, DeckTemplate] = dict()
+		self.tables: Dict[str, DataTable] = dict()
 		self.pending_tasks: List[Promise[Any]] = []
+		self.table_tasks: List[Promise[Any]] = []
+		self.deck_tasks: Dict[str, List[Promise[Any]]] = dict()
+		self.current_deck: Optional[str] = None
 		self.resolved_styles: Dict[str, Optional[TextStyle]] = dict()
 
 	def resolve_path(self, path: str) -> str:
@@ -181,17 +228,31 @@ class XMLParser:
 		raise ValidateError(f"unexpected child <{elt.tag}> at line {loc[0]}, col {loc[1]}")
 
 	def parse(self) -> DeckContext:
+		ctx, _ = self.parse_streaming()
+		Promise.all(self.pending_tasks).run_until_completion()
+		return ctx
+
+	def parse_streaming(self) -> Tuple[DeckContext, Dict[str, Promise[Any]]]:
+		"""
+		Parses the deck file without waiting for the data sources.
+		Along with the context, returns a promise per deck that settles once its cards and all tables are loaded.
+		"""
 		xml: Element = ElementTree.parse(self.path, parser=LineNumberingParser()).getroot()
 		self.process_element(xml, self.parse_root)
-		Promise.all(self.pending_tasks).run_until_completion()
+		ready: Dict[str, Promise[Any]] = dict()
+		for name, tasks in self.deck_tasks.items():
+			# any card may look up any table, so every deck waits for all of them
+			ready[name] = Promise.all(tasks + self.table_tasks)
 		ctx = DeckContext(self.base_path)
 		for name, inline in self.inlines.items():
 			ctx.inlines[name] = inline
+		for name, table in self.tables.items():
+			ctx.tables[name] = table
 		for name, style in self.styles.items():
 			ctx.styles[name] = self.resolve_style(name)
 		for deck in sorted(self.decks.values(), key=lambda deck: deck.name):
 			ctx.decks.append(deck)
-		return ctx
+		return ctx, ready
 
 	def resolve_style(self, name: str) -> TextStyle:
 		if name in self.resolved_styles:
@@ -216,6 +277,8 @@ class XMLParser:
 				self.process_element(elt, self.parse_inline)
 			elif elt.tag == "deck":
 				self.process_element(elt, self.parse_deck)
+			elif elt.tag == "table":
+				self.process_element(elt, self.parse_table)
 			else:
 				raise self.unexpected_elt(elt)
 
@@ -243,87 +306,229 @@ class XMLParser:
 		deck = DeckTemplate(name, params['width'], params['height'])
 		if 'scale' in params:
 			deck.scale = params['scale']
+		if 'tiers' in params:
+			deck.tiers = params['tiers']
+		if 'texture-budget' in params:
+			deck.texture_budget = int(params['texture-budget'] * 1024 * 1024)
+		if 'atlas' in params:
+			deck.atlas = params['atlas']
+			first = self.atlases.setdefault(deck.atlas, deck)
+			if (first.width, first.height) != (deck.width, deck.height) or first.tiers != deck.tiers:
+				raise ValidateError(f"decks in atlas '{deck.atlas}' must have the same width, height and tiers")
 		self.decks[name] = deck
-		for elt in deck_elt:
-			if elt.tag == "cards":
-				self.process_element(elt, self.parse_cards, deck)
-			elif elt.tag == "back-default":
-				deck.back_default = self.process_element(elt, self.parse_template)
-			elif elt.tag == "face-hidden":
-				deck.face_hidden = self.process_element(elt, self.parse_template)
-			else:
-				raise self.unexpected_elt(elt)
+		self.deck_tasks[name] = []
+		self.current_deck = name
+		try:
+			for elt in deck_elt:
+				if elt.tag == "cards":
+					self.process_element(elt, self.parse_cards, deck)
+				elif elt.tag == "back-default":
+					deck.back_default = self.process_element(elt, self.parse_template)
+				elif elt.tag == "face-hidden":
+					deck.face_hidden = self.process_element(elt, self.parse_template)
+				else:
+					raise self.unexpected_elt(elt)
+		finally:
+			self.current_deck = None
 
 	def parse_cards(self, cards_elt: Element, deck: DeckTemplate):
 		self.parse_scheme(cards_elt, cards_scheme)
 		block = CardBlock()
 		deck.card_blocks.append(block)
 		for elt in cards_elt:
-			if elt.tag == "card":
-				self.process_element(elt, self.parse_card_data, block)
-			elif elt.tag == "google-sheet":
-				self.process_element(elt, self.parse_google_sheet, block)
-			elif elt.tag == "image-set":
-				self.process_element(elt, self.parse_image_set, block)
-			elif elt.tag == "render":
+			if elt.tag == "render":
 				stmt = self.process_element(elt, self.parse_stmt_block)
 				block.renderers.append(stmt)
-			else:
+			elif not self.parse_data_source(elt, block):
 				raise self.unexpected_elt(elt)
 
-	def parse_google_sheet(self, google_elt: Element, block: CardBlock):
+	def parse_table(self, table_elt: Element):
+		params = self.parse_scheme(table_elt, table_scheme)
+		name = params['name']
+		if name in self.tables:
+			raise ValidateError(f"duplicate table '{name}'")
+		table = DataTable(name, params['key'])
+		self.tables[name] = table
+		for elt in table_elt:
+			if not self.parse_data_source(elt, table):
+				raise self.unexpected_elt(elt)
+
+	def parse_data_source(self, elt: Element, target: RowTarget) -> bool:
+		if elt.tag == "card":
+			self.process_element(elt, self.parse_card_data, target)
+		elif elt.tag == "google-sheet":
+			self.process_element(elt, self.parse_google_sheet, target)
+		elif elt.tag == "image-set":
+			self.process_element(elt, self.parse_image_set, target)
+		elif elt.tag == "csv":
+			self.process_element(elt, self.parse_csv, target)
+		elif elt.tag == "tsv":
+			self.process_element(elt, self.parse_tsv, target)
+		elif elt.tag == "jsonl":
+			self.process_element(elt, self.parse_jsonl, target)
+		elif elt.tag == "sqlite":
+			self.process_element(elt, self.parse_sqlite, target)
+		else:
+			return False
+		return True
+
+	def parse_google_sheet(self, google_elt: Element, target: RowTarget):
 		params = self.parse_scheme(google_elt, google_scheme)
-		try:
-			def worker(process: TaskProcess):
-				data = download_google_sheet_as_dictionary(params['key'], params['sheet'])
-				return data
-			@asyncify
-			def run():
-				data = yield run_threaded(f"Downloading {params['key']}/{params['sheet']}", worker)
-				for row in data:
-					self.add_card(block, row)
-			self.pending_tasks.append(run())
-		except BaseException as err:
-			raise ValidateError(f"failed to download google spreadsheet: {err}")
-
-	def parse_image_set(self, imageset_elt: Element, block: CardBlock):
+		self.add_source(
+			google_elt,
+			target,
+			f"Downloading {params['key']}/{params['sheet']}",
+			"failed to download google spreadsheet",
+			lambda process: read_google_sheet_rows(
+				params['key'],
+				params['sheet'],
+				params.get('columns'),
+				self.make_filter(params),
+				process.log
+			)
+		)
+
+	def parse_image_set(self, imageset_elt: Element, target: RowTarget):
 		params = self.parse_scheme(imageset_elt, imageset_scheme)
-		try:
-			path = params['path']
-			def worker(process: TaskProcess):
-				data = []
-				base_path = self.resolve_path(path)
-				for root, dirs, files in os.walk(base_path):
-					for file in files:
-						if file.endswith(".png") or file.endswith(".jpg") or file.endswith(".jpeg"):
-							data.append({
-								"path": os.path.abspath(os.path.join(root, file)),
-								"filename": file,
-								"name": os.path.splitext(file)[0]
-							})
-				return data
-			@asyncify
-			def run():
-				data = yield run_threaded(f"Collecting images in {path}", worker)
-				for row in data:
-					self.add_card(block, row)
-			self.pending_tasks.append(run())
-		except BaseException as err:
-			raise ValidateError(f"failed to load image  set: {err}")
-
-	def add_card(self, block: CardBlock, data: Dict[str, str]):
+		path = params['path']
+		def images():
+			base_path = self.resolve_path(path)
+			for root, dirs, files in os.walk(base_path):
+				for file in files:
+					if file.endswith(".png") or file.endswith(".jpg") or file.endswith(".jpeg"):
+						yield {
+							"path": os.path.abspath(os.path.join(root, file)),
+							"filename": file,
+							"name": os.path.splitext(file)[0]
+						}
+		self.add_source(
+			imageset_elt,
+			target,
+			f"Collecting images in {path}",
+			"failed to load image set",
+			lambda process: read_rows(images(), params.get('columns'), self.make_filter(params))
+		)
+
+	def parse_csv(self, csv_elt: Element, target: RowTarget):
+		params = self.parse_scheme(csv_elt, csv_scheme)
+		path = self.resolve_path(params['path'])
+		self.add_source(
+			csv_elt,
+			target,
+			f"Reading {params['path']}",
+			"failed to read csv file",
+			lambda process: read_csv_rows(
+				path,
+				params.get('delimiter', ','),
+				params.get('columns'),
+				self.make_filter(params)
+			)
+		)
+
+	def parse_tsv(self, tsv_elt: Element, target: RowTarget):
+		params = self.parse_scheme(tsv_elt, tsv_scheme)
+		path = self.resolve_path(params['path'])
+		self.add_source(
+			tsv_elt,
+			target,
+			f"Reading {params['path']}",
+			"failed to read tsv file",
+			lambda process: read_csv_rows(path, '\t', params.get('columns'), self.make_filter(params))
+		)
+
+	def parse_jsonl(self, jsonl_elt: Element, target: RowTarget):
+		params = self.parse_scheme(jsonl_elt, jsonl_scheme)
+		path = self.resolve_path(params['path'])
+		self.add_source(
+			jsonl_elt,
+			target,
+			f"Reading {params['path']}",
+			"failed to read json lines file",
+			lambda process: read_jsonl_rows(path, params.get('columns'), self.make_filter(params))
+		)
+
+	def parse_sqlite(self, sqlite_elt: Element, target: RowTarget):
+		params = self.parse_scheme(sqlite_elt, sqlite_scheme)
+		path = self.resolve_path(params['path'])
+		self.add_source(
+			sqlite_elt,
+			target,
+			f"Querying {params['path']}",
+			"failed to query sqlite database",
+			lambda process: read_sqlite_rows(
+				path,
+				params['query'],
+				params.get('columns'),
+				self.make_filter(params)
+			)
+		)
+
+	def make_filter(self, params: Dict[str, Any]) -> Optional[RowFilter]:
+		if 'filter' not in params:
+			return None
+		return RowFilter(params['filter'])
+
+	def add_source(
+		self,
+		elt: Element,
+		target: RowTarget,
+		description: str,
+		failure: str,
+		rows: Callable[[TaskProcess], Iterable[Dict[str, str]]]
+	):
+		# taken here rather than in the worker, so a block's cards keep the order of its sources
+		store = self.row_sink(target)
+
+		def worker(process: TaskProcess) -> None:
+			count = 0
+			for row in rows(process):
+				store(self.convert_row(target, row))
+				count += 1
+			process.log(f"Loaded {count} rows")
+
+		@asyncify
+		def run():
+			try:
+				yield run_threaded(description, worker)
+			except ValidateError as ve:
+				loc = self.getloc(elt)
+				raise ValidateError(f"in <{encode(elt.tag)}> at line {loc[0]}, col {loc[1]}:\n{ve}") from ve
+			except Exception as err:
+				loc = self.getloc(elt)
+				raise ValidateError(f"in <{encode(elt.tag)}> at line {loc[0]}, col {loc[1]}:\n{failure}: {encode(str(err))}") from err
+		task = run()
+		self.pending_tasks.append(task)
+		if isinstance(target, DataTable):
+			self.table_tasks.append(task)
+		else:
+			self.deck_tasks[self.current_deck].append(task)
+
+	def convert_row(self, target: RowTarget, row: Dict[str, str]) -> Any:
+		if isinstance(target, CardBlock):
+			return self.make_card(row)
+		return row
+
+	def row_sink(self, target: RowTarget) -> Callable[[Any], None]:
+		"""
+		Returns the function rows of a new data source are stored with, one at a time as they are read.
+		"""
+		if isinstance(target, CardBlock):
+			return target.add_source().append
+		return target.add_row
+
+	def make_card(self, data: Dict[str, str]) -> CardData:
 		card_data = CardData()
 		for key, value in data.items():
 			if key == "count":
 				try:
 					card_data.count = int(value)
-				except ValueError:
-					raise ValidateError(f"invalid 'count' value of {encode(value)}")
+				except (ValueError, TypeError):
+					raise ValidateError(f"invalid 'count' value of {encode(str(value))}")
 			card_data.data[key] = value
-		block.cards.append(card_data)
+		return card_data
 
-	def parse_card_data(self, card_elt: Element, block: CardBlock):
-		self.add_card(block, card_elt.attrib)
+	def parse_card_data(self, card_elt: Element, target: RowTarget):
+		self.row_sink(target)(self.convert_row(target, dict(card_elt.attrib)))
 		for elt in card_elt:
 			raise self.unexpected_elt(elt)
 
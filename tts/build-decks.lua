@@ -5,6 +5,11 @@ function on_input(obj, color, input)
 	deck_path = input
 end
 
+local server_url = "http://localhost:17352"
+local poll_interval = 1
+-- resolution tier to spawn sheets at, decks that were not built at this tier use the full size sheets
+local tier_scale = 1
+
 function load_and_build()
 	print("QUERYING FOR DECKS...")
 	
@@ -16,7 +21,30 @@ function load_and_build()
 		startLuaCoroutine(self, "build_decks")
 	end
 	
-	WebRequest.get("http://localhost:17352/?deck=" .. deck_path, build_decks)
+	local function poll(job_id)
+		WebRequest.get(server_url .. "/jobs/status?id=" .. job_id, function(response)
+			local data = JSON.decode(response.text)
+			if data.error then
+				print("Server error: ", data.error)
+				return
+			end
+			if data.job.state == "queued" or data.job.state == "running" then
+				Wait.time(function() poll(job_id) end, poll_interval)
+			else
+				WebRequest.get(server_url .. "/jobs/result?id=" .. job_id, build_decks)
+			end
+		end)
+	end
+	
+	WebRequest.get(server_url .. "/jobs/submit?deck=" .. deck_path, function(response)
+		local data = JSON.decode(response.text)
+		if data.error then
+			print("Server error: ", data.error)
+			return
+		end
+		print("Build job ", data.job.id, " is ", data.job.state)
+		poll(data.job.id)
+	end)
 end
 
 function build_decks()
@@ -34,20 +62,33 @@ function build_decks()
 	
 	pos.x = pos.x + 2
 	
+	local padding = 0.4
+	local spread_elevation = 5
+	local spread_layer_height = 0.5
+	
+	-- spawned cards of every deck, by deck name and card index
+	local libraries = {}
+	
+	-- atlas sheets hold the cards of several decks, they are spread behind the builder first
+	local atlas_pos = {x=pos.x, y=pos.y, z=pos.z - 40}
+	for _, atlas in ipairs(data.response.atlases or {}) do
+		print("Building atlas ", atlas.name)
+		local atlas_width, atlas_height = card_size(atlas, 1)
+		local pos_deck = {x=atlas_pos.x, y=atlas_pos.y + spread_elevation, z=atlas_pos.z}
+		local pos_spread = {x=atlas_pos.x + padding + atlas_width, y=atlas_pos.y + spread_elevation, z=atlas_pos.z}
+		local off_spread = {x=padding + atlas_width, y=spread_layer_height, z=padding + atlas_height}
+		local order = 0
+		for sheet_idx, sheet in ipairs(atlas.sheets) do
+			print("Spawning atlas sheet ", sheet_idx)
+			order = spawn_sheet(sheet, 1, pos_deck, pos_spread, off_spread, order, libraries)
+		end
+		atlas_pos.z = atlas_pos.z - 20
+	end
+	
 	for _, deck in ipairs(decks) do
 		print("Building deck ", deck.name)
 		
-		local deck_width = 3.2 * deck.scale
-		local deck_height = 3.2 * deck.scale
-		local padding = 0.4
-		local spread_elevation = 5
-		local spread_layer_height = 0.5
-		
-		if deck.width > deck.height then
-			deck_height = deck_height * (deck.height / deck.width)
-		else
-			deck_width = deck_width * (deck.width / deck.height)
-		end
+		local deck_width, deck_height = card_size(deck, deck.scale)
 		
 		pos.x = pos.x + deck_width * 0.5
 		
@@ -55,61 +96,16 @@ function build_decks()
 		local pos_spread = {x=pos.x + padding + deck_width, y=pos.y + spread_elevation, z=pos.z + padding + deck_height * 0.5}
 		local off_spread = {x=padding + deck_width, y=spread_layer_height, z=padding + deck_height}
 		
-		local rows = 10
-		local cols = 10
 		local order = 0
 		
-		local card_library = {}
-		
 		-- load and spread sheets
 		for sheet_idx, sheet in ipairs(deck.sheets) do
 			print("Spawning sheet ", sheet_idx)
-			local sheet_deck = spawnObject({
-				type = "DeckCustom",
-				position = {x=pos_deck.x, y=pos_deck.y, z=pos_deck.z},
-				scale = {deck.scale, deck.scale, deck.scale}
-			})
-			local data = {
-				face = sheet.face,
-				back = sheet.back,
-				width = sheet.width,
-				height = sheet.height,
-				number = sheet.count,
-				back_is_hidden = not sheet.has_face_hidden,
-				unique_back = sheet.unique_backs
-			}
-			sheet_deck.setCustomObject(data)
-			sheet_deck.setLock(true)
-			wait_frames(10)
-			print("Spreading sheet")
-			for card_idx, card_info in irpairs(sheet.cards) do
-				local col = order % cols
-				local row = math.floor(order / cols) % rows
-				local layer = math.floor(order / (cols * rows))
-				local card = sheet_deck.takeObject {
-					position = {
-						x = pos_spread.x + off_spread.x * col,
-						y = pos_spread.y + off_spread.y * layer,
-						z = pos_spread.z + off_spread.z * row
-					},
-					smooth = false
-				}
-				if sheet.unique_backs then
-					card.hide_when_face_down = false
-				end
-				card.setLock(true)
-				if card_info.name then
-					card.setName(card_info.name)
-				end
-				if card_info.description then
-					card.setDescription(card_info.description)
-				end
-				card_library[card_info.index] = card
-				order = order + 1
-			end
-			wait_frames(10)
+			order = spawn_sheet(sheet, deck.scale, pos_deck, pos_spread, off_spread, order, libraries)
 		end
 		
+		local card_library = libraries[deck.name] or {}
+		
 		print("Building stack")		
 		local stack_offset = 0.2
 		local stack_elev = 1.75
@@ -128,6 +124,10 @@ function build_decks()
 			}
 			card_clone.setPosition(spawn_pos)
 			card_clone.setRotation({0, 180, 0})
+			if deck.atlas then
+				-- atlas sheets are spawned at scale 1
+				card_clone.setScale({deck.scale, deck.scale, deck.scale})
+			end
 			card_clone.setLock(true)
 			next_card_idx = next_card_idx + 1
 			return card_clone
@@ -211,6 +211,74 @@ function build_decks()
 	return 1
 end
 
+function card_size(deck, scale)
+	local width = 3.2 * scale
+	local height = 3.2 * scale
+	if deck.width > deck.height then
+		height = height * (deck.height / deck.width)
+	else
+		width = width * (deck.width / deck.height)
+	end
+	return width, height
+end
+
+function spawn_sheet(sheet, scale, pos_deck, pos_spread, off_spread, order, libraries)
+	local rows = 10
+	local cols = 10
+	local sheet_deck = spawnObject({
+		type = "DeckCustom",
+		position = {x=pos_deck.x, y=pos_deck.y, z=pos_deck.z},
+		scale = {scale, scale, scale}
+	})
+	local face, back = sheet.face, sheet.back
+	for _, tier in ipairs(sheet.tiers or {}) do
+		if tier.scale == tier_scale then
+			face, back = tier.face, tier.back
+		end
+	end
+	local data = {
+		face = face,
+		back = back,
+		width = sheet.width,
+		height = sheet.height,
+		number = sheet.count,
+		back_is_hidden = not sheet.has_face_hidden,
+		unique_back = sheet.unique_backs
+	}
+	sheet_deck.setCustomObject(data)
+	sheet_deck.setLock(true)
+	wait_frames(10)
+	print("Spreading sheet")
+	for card_idx, card_info in irpairs(sheet.cards) do
+		local col = order % cols
+		local row = math.floor(order / cols) % rows
+		local layer = math.floor(order / (cols * rows))
+		local card = sheet_deck.takeObject {
+			position = {
+				x = pos_spread.x + off_spread.x * col,
+				y = pos_spread.y + off_spread.y * layer,
+				z = pos_spread.z + off_spread.z * row
+			},
+			smooth = false
+		}
+		if sheet.unique_backs then
+			card.hide_when_face_down = false
+		end
+		card.setLock(true)
+		if card_info.name then
+			card.setName(card_info.name)
+		end
+		if card_info.description then
+			card.setDescription(card_info.description)
+		end
+		libraries[card_info.deck] = libraries[card_info.deck] or {}
+		libraries[card_info.deck][card_info.index] = card
+		order = order + 1
+	end
+	wait_frames(10)
+	return order
+end
+
 function wait_frames(frames)
     for _ = 1, frames do
 		coroutine.yield(0)